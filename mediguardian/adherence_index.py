@@ -0,0 +1,109 @@
+"""Time-bucketed prefix sums of Taken/Missed doses.
+
+Every (medication, status) pair, plus an overall total per status, has a
+Fenwick tree over fixed-width time buckets. Recording a dose and counting
+doses in any window are both O(log n) in the number of buckets covered, so
+"last 7 days" or "this month" never scans the history.
+"""
+import threading
+from array import array
+from datetime import datetime
+
+# Width of one bucket; window queries are exact to this resolution
+BUCKET_SECONDS = 3600
+
+class FenwickCounts:
+    """Fenwick tree over consecutive buckets that grows in either direction"""
+
+    def __init__(self):
+        self.origin = None
+        self.values = array('q')
+        self.tree = array('q')
+
+    def _rebuild(self, first, last):
+        # Double the span so repeated growth stays amortised O(1) per bucket
+        size = max(16, len(self.values))
+        while size < last - first + 1:
+            size *= 2
+        if self.origin is not None and first < self.origin:
+            first = min(first, self.origin + len(self.values) - size)
+        values = array('q', bytes(8 * size))
+        if self.origin is not None:
+            shift = self.origin - first
+            values[shift:shift + len(self.values)] = self.values
+        tree = array('q', values)
+        for i in range(size):
+            parent = i | (i + 1)
+            if parent < size:
+                tree[parent] += tree[i]
+        self.origin, self.values, self.tree = first, values, tree
+
+    def add(self, bucket, count=1):
+        if self.origin is None:
+            self._rebuild(bucket, bucket)
+        elif bucket < self.origin:
+            self._rebuild(bucket, self.origin + len(self.values) - 1)
+        elif bucket >= self.origin + len(self.values):
+            self._rebuild(self.origin, bucket)
+        i = bucket - self.origin
+        self.values[i] += count
+        size = len(self.tree)
+        while i < size:
+            self.tree[i] += count
+            i |= i + 1
+
+    def prefix(self, bucket):
+        """Sum of every bucket up to and including bucket"""
+        if self.origin is None or bucket < self.origin:
+            return 0
+        i = min(bucket - self.origin, len(self.tree) - 1)
+        total = 0
+        while i >= 0:
+            total += self.tree[i]
+            i = (i & (i + 1)) - 1
+        return total
+
+    def range(self, first, last):
+        if last < first:
+            return 0
+        return self.prefix(last) - self.prefix(first - 1)
+
+def bucket_of(when):
+    if isinstance(when, str):
+        when = datetime.strptime(when, "%Y-%m-%d %H:%M")
+    return int(when.timestamp()) // BUCKET_SECONDS
+
+class AdherenceIndex:
+    """Taken/Missed counts per medication and overall, queryable by time range"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (medication or None for all, status) -> FenwickCounts
+        self.trees = {}
+
+    def add(self, medication, status, when, count=1):
+        bucket = bucket_of(when)
+        with self.lock:
+            for key in ((medication, status), (None, status)):
+                tree = self.trees.get(key)
+                if tree is None:
+                    tree = self.trees[key] = FenwickCounts()
+                tree.add(bucket, count)
+
+    def count(self, start, end, medication=None, status="Missed"):
+        """Doses with the given status between start and end, both inclusive"""
+        with self.lock:
+            tree = self.trees.get((medication, status))
+            if tree is None:
+                return 0
+            return tree.range(bucket_of(start), bucket_of(end))
+
+    def window(self, start, end, medication=None):
+        taken = self.count(start, end, medication, "Taken")
+        missed = self.count(start, end, medication, "Missed")
+        total = taken + missed
+        return {
+            "Taken": taken,
+            "Missed": missed,
+            "compliance_rate": round(taken / total * 100) if total else 100
+        }
@@ -0,0 +1,342 @@
+"""Optional asyncio serving mode.
+
+Exposes the dashboard routes as an ASGI application whose dose scheduler
+runs as an asyncio task instead of a daemon thread. Blocking work (template
+rendering, history log scans, anything that takes the app's state lock) is
+handed to the default executor so the event loop keeps serving while it
+runs. Validation and responses come from the same functions the Flask
+routes use.
+
+    uvicorn asgi:app          # any ASGI server
+    python asgi.py            # uvicorn if installed, else a stdlib server
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import traceback
+from datetime import datetime
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+# Must be set before importing the app so it doesn't start its own thread
+os.environ.setdefault('MEDIGUARDIAN_SCHEDULER', 'asyncio')
+
+import mediguardian as mg
+import ingest
+from flask import render_template
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def scheduler():
+    while True:
+        checked = await run_blocking(mg.run_scheduler_tick, datetime.now())
+        await asyncio.sleep(15 if checked else 5)
+
+def json_response(payload, status=200):
+    return status, 'application/json', mg.app.json.dumps(payload).encode('utf-8')
+
+async def html_response(template, context, *args):
+    """Builds context(*args) and renders template with it off the event loop"""
+    def render():
+        with mg.app.app_context():
+            return render_template(template, **context(*args)).encode('utf-8')
+    return 200, 'text/html; charset=utf-8', await run_blocking(render)
+
+async def shared_response(func, *args):
+    """Runs one of the app's (payload, status) functions off the event loop"""
+    return json_response(*await run_blocking(func, *args))
+
+def request_json(request):
+    try:
+        return json.loads(request["body"] or b'null')
+    except ValueError:
+        return None
+
+def query_args(request):
+    return {name: values[0] for name, values in request["query"].items()}
+
+async def dashboard(request):
+    return await html_response('dashboard.html', mg.dashboard_context)
+
+async def fragment_state(request):
+    return json_response({
+        "versions": mg.fragment_versions,
+        "status": mg.system_state["status"],
+        "next_dose_time": mg.system_state["next_dose_time"].strftime('%Y-%m-%dT%H:%M:%S')
+    })
+
+async def fragment(request, name):
+    return await html_response(f'fragments/{name}.html', mg.fragment_context, name)
+
+def query_int(request, name, default):
+    try:
+        return int(request["query"].get(name, [default])[0])
+    except (TypeError, ValueError):
+        return default
+
+async def history(request):
+    return await html_response('history.html', mg.history_page, query_int(request, 'page', 1))
+
+async def history_export(request):
+    query = query_args(request)
+    try:
+        start, end = mg.history_range(query.get('start'), query.get('end'))
+    except ValueError:
+        return json_response({"success": False, "error": mg.HISTORY_RANGE_ERROR}, 400)
+    rows = await run_blocking(lambda: ''.join(mg.export_rows(start, end, query.get('medication'))))
+    return 200, 'text/csv', rows.encode('utf-8')
+
+async def history_archive(request):
+    return await shared_response(mg.history_query, mg.archive_query, query_args(request))
+
+async def history_window(request):
+    return await shared_response(mg.history_query, mg.window_query, query_args(request))
+
+async def history_adherence(request):
+    return json_response(await run_blocking(mg.adherence_query, query_args(request)))
+
+async def facility_page(request):
+    return await html_response('facility.html', mg.facility_overview,
+                               request["query"].get('sort', [None])[0],
+                               request["query"].get('risk', [None])[0],
+                               query_int(request, 'limit', mg.FACILITY_PAGE_LIMIT))
+
+async def facility_data(request):
+    return json_response(await run_blocking(mg.facility_overview,
+                                            request["query"].get('sort', [None])[0],
+                                            request["query"].get('risk', [None])[0],
+                                            query_int(request, 'limit', None)))
+
+async def data(request):
+    # Built at most once per state version, then the same bytes for every poller
+    version = mg.state_version()
+    args = (version,
+            request["headers"].get('accept-encoding', ''),
+            request["headers"].get('if-none-match', ''))
+    if mg.data_cache.current(version):
+        status, body, headers = mg.data_cache.respond(*args)
+    else:
+        # A rebuild waits for the state lock and serializes the whole payload
+        status, body, headers = await run_blocking(mg.data_cache.respond, *args)
+    return status, 'application/json', body, headers
+
+async def risk_data(request):
+    return json_response(await run_blocking(mg.risk_overview,
+                                            query_int(request, 'patient', None),
+                                            query_int(request, 'limit', None)))
+
+async def add_medication(request):
+    return await shared_response(mg.add_medication_request, request_json(request))
+
+async def delete_medication(request):
+    return await shared_response(mg.delete_medication_request, request_json(request))
+
+async def medications_batch(request):
+    return await shared_response(mg.medications_batch_request, request_json(request))
+
+async def mark_alert_read(request, alert_id):
+    # Takes the app's state lock, so it runs off the event loop
+    await run_blocking(mg.mark_alerts_read, [alert_id])
+    return json_response({"success": True})
+
+async def mark_alerts_read_bulk(request):
+    return await shared_response(mg.mark_alerts_request, request_json(request))
+
+async def notification_log(request):
+    return json_response({"deliveries": list(mg.notifier.log),
+                          "emergency_latency": mg.notifier.latency_summary(),
+                          "invalid_contacts": mg.notifier.invalid_contacts})
+
+async def scans(request):
+    try:
+        future = await run_blocking(mg.submit_scans, request["body"],
+                                    request["headers"].get('content-type', ''))
+        outcomes = await asyncio.wait_for(asyncio.wrap_future(future), mg.SCAN_ACK_TIMEOUT)
+    except ingest.IngestError as e:
+        headers = [('Retry-After', '1')] if e.status in (429, 503) else []
+        return (*json_response({"success": False, "error": str(e)}, e.status), headers)
+    except Exception as e:
+        return (*json_response({"success": False, "error": f"scans not written: {e!r}"}, 503),
+                [('Retry-After', '1')])
+    return json_response(dict(ingest.summarize(outcomes), success=True))
+
+async def scan_stats(request):
+    return json_response(dict(mg.scan_ingestor.stats, pending=mg.scan_ingestor.pending))
+
+async def trigger_emergency(request):
+    await run_blocking(lambda: mg.send_alert("emergency", "", emergency=True, raised_at=time.perf_counter()))
+    return json_response({"success": True})
+
+ROUTES = {
+    ('GET', '/'): dashboard,
+    ('GET', '/fragments'): fragment_state,
+    ('GET', '/history'): history,
+    ('GET', '/history/export'): history_export,
+    ('GET', '/history/archive'): history_archive,
+    ('GET', '/history/window'): history_window,
+    ('GET', '/history/adherence'): history_adherence,
+    ('GET', '/facility'): facility_page,
+    ('GET', '/facility/data'): facility_data,
+    ('GET', '/risk'): risk_data,
+    ('GET', '/data'): data,
+    ('POST', '/add_medication'): add_medication,
+    ('POST', '/delete_medication'): delete_medication,
+    ('POST', '/medications/batch'): medications_batch,
+    ('POST', '/mark_alerts_read'): mark_alerts_read_bulk,
+    ('GET', '/notifications'): notification_log,
+    ('POST', '/scans'): scans,
+    ('GET', '/scans/stats'): scan_stats,
+    ('POST', '/trigger_emergency'): trigger_emergency
+}
+
+async def route(request):
+    # The interval check is cheap; reading and validating the file is not
+    if time.monotonic() - mg.catalog_status["last_check"] >= mg.CATALOG_CHECK_INTERVAL:
+        await run_blocking(mg.reload_medications_if_changed)
+    handler = ROUTES.get((request["method"], request["path"]))
+    if handler:
+        return await handler(request)
+    if request["method"] == 'GET' and request["path"].startswith('/mark_alert_read/'):
+        alert_id = request["path"][len('/mark_alert_read/'):]
+        if alert_id.isdigit():
+            return await mark_alert_read(request, int(alert_id))
+    if request["method"] == 'GET' and request["path"].startswith('/fragments/'):
+        name = request["path"][len('/fragments/'):]
+        if name in mg.fragment_versions:
+            return await fragment(request, name)
+    if any(path == request["path"] for _, path in ROUTES):
+        return 405, 'text/plain', b'Method Not Allowed'
+    return 404, 'text/plain', b'Not Found'
+
+async def lifespan(receive, send):
+    task = None
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            task = asyncio.create_task(scheduler())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if task:
+                task.cancel()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    request = {
+        "method": scope['method'],
+        "path": scope['path'],
+        "query": parse_qs(scope.get('query_string', b'').decode('latin-1')),
+        "headers": {name.decode('latin-1').lower(): value.decode('latin-1')
+                    for name, value in scope.get('headers', [])},
+        "body": body
+    }
+    # Handlers return (status, content_type, payload) plus optional extra headers
+    try:
+        status, content_type, payload, *extra = await route(request)
+    except Exception:
+        traceback.print_exc()
+        status, content_type, payload = json_response({"success": False, "error": "internal server error"}, 500)
+        extra = []
+    headers = [(b'content-type', content_type.encode('latin-1')),
+               (b'content-length', str(len(payload)).encode('latin-1'))]
+    for name, value in (extra[0] if extra else []):
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+async def handle_connection(reader, writer):
+    """Minimal HTTP/1.1 keep-alive front end for the ASGI app"""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, target, version = request_line.decode('latin-1').split()
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers.append((name.strip().lower().encode('latin-1'),
+                                value.strip().encode('latin-1')))
+            header_map = dict(headers)
+            length = int(header_map.get(b'content-length', b'0'))
+            body = await reader.readexactly(length) if length else b''
+
+            path, _, query = target.partition('?')
+            scope = {
+                'type': 'http',
+                'http_version': version.split('/')[-1],
+                'method': method.upper(),
+                'path': path,
+                'query_string': query.encode('latin-1'),
+                'headers': headers
+            }
+            messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+            async def receive():
+                return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                    head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}".encode('latin-1')]
+                    head += [name + b': ' + value for name, value in message['headers']]
+                    writer.write(b'\r\n'.join(head) + b'\r\n\r\n')
+                else:
+                    writer.write(message.get('body', b''))
+
+            await app(scope, receive, send)
+            await writer.drain()
+            if version == 'HTTP/1.0' or header_map.get(b'connection', b'').lower() == b'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host='127.0.0.1', port=5000):
+    scheduler_task = asyncio.create_task(scheduler())
+    server = await asyncio.start_server(handle_connection, host, port, backlog=4096)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        scheduler_task.cancel()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve MediGuardian on asyncio")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--builtin', action='store_true',
+                        help="use the stdlib server even if uvicorn is installed")
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        uvicorn = None
+    if uvicorn and not args.builtin:
+        uvicorn.run(app, host=args.host, port=args.port)
+    else:
+        asyncio.run(serve(args.host, args.port))
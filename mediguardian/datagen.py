@@ -0,0 +1,230 @@
+"""Synthetic dataset generator for large-scale testing.
+
+Builds N patients x M medications x D days of dose slots, outcomes and the
+alerts they would raise, fully vectorized with NumPy, and writes them
+straight into the app's storage formats:
+
+    OUT/medications.json                  generated catalog
+    OUT/history_log/                      every dose, one record each
+    OUT/history_archive/rollups.json      patient 0's daily counts past retention
+    OUT/history_archive/compacted_before  so the app only loads recent days
+
+Miss probability is drawn per patient around --miss-rate and shifted by
+medication, evening slots, weekends and a preceding miss, so the data has
+the streaks and patterns real adherence data has.
+
+    python datagen.py --out /tmp/facility --patients 1000 --medications 8 --days 365 --seed 1
+    cd /tmp/facility && python /path/to/mediguardian.py
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import history_archive
+import history_log
+
+SHAPES = ["round", "oval", "capsule", "oblong"]
+COLORS = ["white", "yellow", "pink", "blue", "orange", "green"]
+# Half-hour dose times between 06:00 and 22:00
+SLOT_MINUTES = np.arange(6 * 60, 22 * 60 + 1, 30)
+
+EVENING_FACTOR = 1.5
+WEEKEND_FACTOR = 1.3
+AFTER_MISS_FACTOR = 2.0
+# Rough number of events generated per chunk, to bound memory
+CHUNK_EVENTS = 1 << 22
+
+RECORD_DTYPE = np.dtype(history_log.RECORD_FIELDS)
+
+def make_catalog(rng, medications, critical_fraction):
+    catalog = {}
+    for i in range(medications):
+        doses = int(rng.integers(1, 4))
+        minutes = np.sort(rng.choice(SLOT_MINUTES, size=doses, replace=False))
+        catalog[f"Med-{i + 1:03d}"] = {
+            "shape": SHAPES[int(rng.integers(len(SHAPES)))],
+            "color": COLORS[int(rng.integers(len(COLORS)))],
+            "imprint": f"G{i + 1}",
+            "schedule": ["%02d:%02d" % divmod(int(m), 60) for m in minutes],
+            "critical": bool(rng.random() < critical_fraction),
+            "dose": f"{int(rng.integers(1, 20)) * 5} mg",
+            "icon": "💊"
+        }
+    return catalog
+
+def string_table(catalog):
+    """Log string table: names, then Taken, no-scan and wrong-pill details per medication"""
+    names = list(catalog)
+    pills = [f"{catalog[n]['shape']} {catalog[n]['color']}" for n in names]
+    wrong = pills[1:] + pills[:1]
+    return (names
+            + [f"Expected: {p}, Scanned: {p}" for p in pills]
+            + [f"Expected: {p}, Scanned: None" for p in pills]
+            + [f"Expected: {p}, Scanned: {w}" for p, w in zip(pills, wrong)])
+
+def generate(out_dir, patients=1, medications=5, days=30, miss_rate=0.15,
+             critical_fraction=0.4, seed=None, retention_days=14, now=None):
+    """Write a dataset to out_dir and return counts of what was generated"""
+    log_dir = os.path.join(out_dir, 'history_log')
+    archive_dir = os.path.join(out_dir, 'history_archive')
+    if os.path.exists(log_dir) and os.listdir(log_dir):
+        raise FileExistsError(f"{log_dir} already has a history log")
+    os.makedirs(log_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    now = (now or datetime.now()).replace(second=0, microsecond=0)
+
+    catalog = make_catalog(rng, medications, critical_fraction)
+    with open(os.path.join(out_dir, 'medications.json'), 'w') as f:
+        json.dump(catalog, f, indent=4)
+    with open(os.path.join(log_dir, history_log.STRINGS_FILE), 'w', encoding='utf-8') as f:
+        f.writelines(text + '\n' for text in string_table(catalog))
+
+    # Every (medication, minute) slot of a day, in time order
+    names = list(catalog)
+    slot_med = np.array([i for i, n in enumerate(names) for _ in catalog[n]["schedule"]], dtype=np.uint32)
+    slot_minute = np.array([int(t[:2]) * 60 + int(t[3:]) for n in names for t in catalog[n]["schedule"]])
+    order = np.argsort(slot_minute, kind='stable')
+    slot_med, slot_minute = slot_med[order], slot_minute[order]
+    slots = len(slot_med)
+    critical = np.array([catalog[n]["critical"] for n in names])
+
+    # Miss probability: patient rate around miss_rate, scaled per medication,
+    # evening slot and weekend. Factors are normalized to average 1, and the
+    # base rate lowered so misses after a miss still average out to miss_rate.
+    concentration = 20.0
+    patient_rate = rng.beta(miss_rate * concentration, (1 - miss_rate) * concentration, size=patients)
+    patient_rate = patient_rate / (1 + patient_rate * (AFTER_MISS_FACTOR - 1))
+    med_factor = rng.lognormal(0.0, 0.3, size=medications)
+    slot_factor = med_factor[slot_med] * np.where(slot_minute >= 18 * 60, EVENING_FACTOR, 1.0)
+    slot_factor /= slot_factor.mean()
+    weekend_factor = WEEKEND_FACTOR / ((5 + 2 * WEEKEND_FACTOR) / 7)
+    weekday_factor = 1 / ((5 + 2 * WEEKEND_FACTOR) / 7)
+
+    first_day = now.date() - timedelta(days=days - 1)
+    base = history_log.encode_time(datetime.combine(first_day, datetime.min.time()))
+    now_ts = history_log.encode_time(now)
+    cutoff = now - timedelta(days=retention_days)
+    cutoff_day = (cutoff.date() - first_day).days
+
+    # Carried across chunks: per patient, the last outcome and the last row taken
+    previous_missed = np.zeros(patients, dtype=bool)
+    last_taken = np.full(patients, -1, dtype=np.int64)
+    rollup_counts = np.zeros((max(cutoff_day, 0), medications, 2), dtype=np.int64)
+    totals = {"Taken": 0, "Missed": 0}
+    alert_totals = {level: 0 for level in ("family", "caregiver", "emergency")}
+    patient_ids = np.arange(patients, dtype=np.uint32)
+
+    chunk_days = max(1, CHUNK_EVENTS // max(1, slots * patients))
+    position = 0
+    for day0 in range(0, days, chunk_days):
+        day_index = np.arange(day0, min(days, day0 + chunk_days))
+        # One row per (day, slot) in time order, one column per patient
+        row_time = (base + day_index[:, None] * 86400 + slot_minute[None, :] * 60).ravel()
+        row_day = np.repeat(day_index, slots)
+        row_med = np.tile(slot_med, len(day_index))
+        keep = row_time <= now_ts
+        row_time, row_day, row_med = row_time[keep], row_day[keep], row_med[keep]
+        rows = len(row_time)
+        if rows == 0:
+            break
+
+        weekday = (np.datetime64(first_day, 'D') + row_day).astype('datetime64[D]').view('int64')
+        weekend = ((weekday + 3) % 7) >= 5
+        probability = (patient_rate[None, :]
+                       * (slot_factor[np.tile(np.arange(slots), len(day_index))[keep]]
+                          * np.where(weekend, weekend_factor, weekday_factor))[:, None])
+        draws = rng.random((rows, patients))
+
+        # A miss makes the next dose likelier to be missed, so outcomes are
+        # drawn row by row, vectorized across patients
+        missed = np.empty((rows, patients), dtype=bool)
+        prev = previous_missed
+        for t in range(rows):
+            p = probability[t] * np.where(prev, AFTER_MISS_FACTOR, 1.0)
+            prev = missed[t] = draws[t] < np.minimum(p, 0.95)
+        previous_missed = prev
+
+        # Consecutive misses per patient decide the alert level of each miss
+        index = position + np.arange(rows, dtype=np.int64)[:, None]
+        taken_at = np.maximum(np.maximum.accumulate(np.where(missed, -1, index), axis=0),
+                              last_taken[None, :])
+        streak = index - taken_at
+        last_taken = taken_at[-1]
+        position += rows
+        is_critical = critical[row_med][:, None]
+        alert_totals["emergency"] += int(np.count_nonzero(missed & is_critical))
+        alert_totals["caregiver"] += int(np.count_nonzero(missed & ~is_critical & (streak >= 3)))
+        alert_totals["family"] += int(np.count_nonzero(missed & ~is_critical & (streak < 3)))
+
+        records = np.zeros((rows, patients), dtype=RECORD_DTYPE)
+        records["time"] = row_time[:, None]
+        records["patient"] = patient_ids[None, :]
+        records["medication"] = row_med[:, None]
+        no_scan = rng.random((rows, patients)) < 0.5
+        records["details"] = row_med[:, None] + np.where(missed, np.where(no_scan, 2, 3), 1) * medications
+        records["status"] = missed
+        write_records(log_dir, records.ravel(), totals["Taken"] + totals["Missed"])
+
+        missed_count = int(np.count_nonzero(missed))
+        totals["Missed"] += missed_count
+        totals["Taken"] += missed.size - missed_count
+
+        # Days before the retention cutoff go into the rollups. Those hold the
+        # dashboard's own patient (0) only, as the app's compliance history does.
+        archived = row_day < cutoff_day
+        if archived.any():
+            dashboard_missed = missed[archived, 0].astype(np.int64)
+            counts = np.stack([1 - dashboard_missed, dashboard_missed], axis=1)
+            np.add.at(rollup_counts, (row_day[archived], row_med[archived]), counts)
+
+    rollups = {}
+    for d, m in zip(*np.nonzero(rollup_counts.sum(axis=2))):
+        day = (first_day + timedelta(days=int(d))).isoformat()
+        taken, missed_n = rollup_counts[d, m]
+        rollups.setdefault(day, {})[names[m]] = {"Taken": int(taken), "Missed": int(missed_n)}
+    history_archive.save_rollups(archive_dir, rollups)
+    history_archive.save_watermark(archive_dir, cutoff.strftime("%Y-%m-%d %H:%M"))
+
+    return {
+        "patients": patients,
+        "medications": medications,
+        "days": days,
+        "events": totals["Taken"] + totals["Missed"],
+        "taken": totals["Taken"],
+        "missed": totals["Missed"],
+        "alerts": alert_totals
+    }
+
+def write_records(log_dir, records, written):
+    """Append a record array to the log's segment files; `written` records precede it"""
+    while len(records):
+        segment, offset = divmod(written, history_log.RECORDS_PER_SEGMENT)
+        chunk = records[:history_log.RECORDS_PER_SEGMENT - offset]
+        with open(history_log.segment_path(log_dir, segment), 'ab') as f:
+            chunk.tofile(f)
+        records = records[len(chunk):]
+        written += len(chunk)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic MediGuardian dataset")
+    parser.add_argument('--out', required=True, help="directory to write the dataset into")
+    parser.add_argument('--patients', type=int, default=1)
+    parser.add_argument('--medications', type=int, default=5)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--miss-rate', type=float, default=0.15,
+                        help="mean probability that a dose is missed")
+    parser.add_argument('--critical-fraction', type=float, default=0.4,
+                        help="share of medications flagged critical")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    stats = generate(args.out, args.patients, args.medications, args.days,
+                     args.miss_rate, args.critical_fraction, args.seed)
+    elapsed = time.perf_counter() - started
+    print(json.dumps(stats, indent=2))
+    print(f"{stats['events']} events in {elapsed:.2f}s ({stats['events'] / elapsed:,.0f}/s)")
@@ -0,0 +1,200 @@
+"""Facility-wide overview: one precomputed row per patient.
+
+Rows are updated as doses are recorded and alerts are raised or read, so
+the overview only sorts and filters rows that already exist. It never
+aggregates a patient's history on request. Patients that appear in the
+history log (for example from datagen.py) get their rows at startup from a
+single pass over the log, vectorized with NumPy when it is installed.
+
+Patient names come from an optional patients.json: {"0": "Mary Adams", ...}
+"""
+import json
+import os
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import history_log
+import risk
+
+RISK_ORDER = {"high": 0, "medium": 1, "low": 2}
+# Consecutive misses and compliance (%) thresholds for each risk level
+HIGH_RISK_STREAK = 3
+HIGH_RISK_COMPLIANCE = 70
+MEDIUM_RISK_COMPLIANCE = 85
+
+SORT_KEYS = {
+    "risk": lambda row: (RISK_ORDER[row["risk"]], -row["unread_critical"],
+                         -row["streak"], row["compliance_rate"]),
+    "miss_risk": lambda row: (-(row["miss_risk"] or 0), RISK_ORDER[row["risk"]]),
+    "compliance": lambda row: (row["compliance_rate"], RISK_ORDER[row["risk"]]),
+    "name": lambda row: row["name"].lower(),
+    "patient": lambda row: row["patient"]
+}
+
+def load_names(path):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def new_row(patient, name):
+    return {
+        "patient": patient,
+        "name": name,
+        "taken": 0,
+        "missed": 0,
+        "streak": 0,
+        "compliance_rate": 100,
+        "unread_critical": 0,
+        "status": "normal",
+        "next_dose": None,
+        "next_medication": None,
+        "last_dose": None,
+        "risk": "low",
+        "miss_risk": None,
+        "miss_risk_level": None,
+        "riskiest_dose": None,
+        "riskiest_medication": None
+    }
+
+def assess(row):
+    total = row["taken"] + row["missed"]
+    row["compliance_rate"] = round(row["taken"] / total * 100) if total else 100
+    if (row["unread_critical"] or row["streak"] >= HIGH_RISK_STREAK
+            or row["compliance_rate"] < HIGH_RISK_COMPLIANCE):
+        row["risk"] = "high"
+    elif row["streak"] or row["status"] != "normal" or row["compliance_rate"] < MEDIUM_RISK_COMPLIANCE:
+        row["risk"] = "medium"
+    else:
+        row["risk"] = "low"
+
+class Facility:
+    def __init__(self, names=None):
+        self.names = names or {}
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def row(self, patient):
+        # Caller holds the lock
+        row = self.rows.get(patient)
+        if row is None:
+            name = self.names.get(str(patient), f"Patient {patient}")
+            row = self.rows[patient] = new_row(patient, name)
+        return row
+
+    def record_doses(self, patient, statuses, when):
+        """Fold a batch of "Taken"/"Missed" results, in time order, into a row"""
+        with self.lock:
+            row = self.row(patient)
+            for status in statuses:
+                if status == "Taken":
+                    row["taken"] += 1
+                    row["streak"] = 0
+                else:
+                    row["missed"] += 1
+                    row["streak"] += 1
+            row["last_dose"] = when
+            assess(row)
+
+    def set_alerts(self, patient, unread_critical, status):
+        with self.lock:
+            row = self.row(patient)
+            row["unread_critical"] = unread_critical
+            row["status"] = status
+            assess(row)
+
+    def set_next_dose(self, patient, when, medication):
+        with self.lock:
+            row = self.row(patient)
+            row["next_dose"] = when
+            row["next_medication"] = medication
+
+    def set_miss_risk(self, patient, probability, when, medication):
+        """The patient's riskiest dose in the next 24 hours (see risk.py)"""
+        with self.lock:
+            row = self.row(patient)
+            row["miss_risk"] = round(probability, 3) if when else None
+            row["miss_risk_level"] = risk.risk_level(probability) if when else None
+            row["riskiest_dose"] = when
+            row["riskiest_medication"] = medication
+
+    def load_log(self, log):
+        """Build rows for every patient in the history log"""
+        if np is None:
+            self.load_log_slowly(log)
+            return
+        dtype = np.dtype(history_log.RECORD_FIELDS)
+        size = 0
+        taken = missed = streak = last_time = np.zeros(0, dtype=np.int64)
+        # One segment at a time, carrying per-patient totals between them
+        for view in log.segment_views():
+            records = np.frombuffer(view, dtype=dtype)
+            patient = records["patient"].astype(np.int64)
+            miss = records["status"].astype(bool)
+            if patient.max() + 1 > size:
+                grow = int(patient.max()) + 1 - size
+                taken, missed, streak = (np.concatenate([a, np.zeros(grow, dtype=np.int64)])
+                                         for a in (taken, missed, streak))
+                last_time = np.concatenate([last_time, np.full(grow, -1, dtype=np.int64)])
+                size += grow
+            taken += np.bincount(patient[~miss], minlength=size)
+            missed += np.bincount(patient[miss], minlength=size)
+            # Streak: misses after the last Taken dose, continuing the previous
+            # segment's streak for patients with no Taken dose in this one
+            position = np.arange(len(records))
+            last_taken = np.full(size, -1)
+            np.maximum.at(last_taken, patient[~miss], position[~miss])
+            after = np.bincount(patient[miss & (position > last_taken[patient])], minlength=size)
+            streak = np.where(last_taken >= 0, after, streak + after)
+            last_seen = np.full(size, -1)
+            np.maximum.at(last_seen, patient, position)
+            seen = last_seen >= 0
+            last_time[seen] = records["time"][last_seen[seen]]
+        with self.lock:
+            for p in np.nonzero(taken + missed)[0]:
+                row = self.row(int(p))
+                row["taken"] += int(taken[p])
+                row["missed"] += int(missed[p])
+                row["streak"] = int(streak[p])
+                row["last_dose"] = history_log.decode_time(int(last_time[p]))
+                assess(row)
+
+    def load_log_slowly(self, log):
+        with self.lock:
+            for timestamp, patient, _, _, status in log.records():
+                row = self.row(patient)
+                if status:
+                    row["missed"] += 1
+                    row["streak"] += 1
+                else:
+                    row["taken"] += 1
+                    row["streak"] = 0
+                row["last_dose"] = timestamp
+            for row in self.rows.values():
+                if isinstance(row["last_dose"], int):
+                    row["last_dose"] = history_log.decode_time(row["last_dose"])
+                assess(row)
+
+    def overview(self, sort="risk", risk=None, limit=None, default_next=None):
+        """Copies of the rows, filtered to one risk level and sorted.
+
+        default_next is (when, medication) for patients without their own
+        schedule, who follow the shared catalog. Returns (rows, counts per risk).
+        """
+        with self.lock:
+            rows = [dict(row) for row in self.rows.values()
+                    if risk is None or row["risk"] == risk]
+            counts = {level: 0 for level in RISK_ORDER}
+            for row in self.rows.values():
+                counts[row["risk"]] += 1
+        rows.sort(key=SORT_KEYS.get(sort, SORT_KEYS["risk"]))
+        if limit:
+            rows = rows[:limit]
+        for row in rows:
+            if row["next_dose"] is None and default_next:
+                row["next_dose"], row["next_medication"] = default_next
+        return rows, counts
@@ -0,0 +1,89 @@
+"""Per-day rollups of compacted history, and the pre-log compressed archive.
+
+History that ages out of memory is counted into rollups.json, and the
+watermark records how far compaction has gone. The events themselves stay in
+the history log. Installs that compacted history before the log existed
+also have one segment file of JSON lines per archived day, compressed with
+gzip or lzma from the standard library; read_segments() still reads them,
+but nothing writes new ones.
+"""
+import gzip
+import json
+import lzma
+import os
+
+CODECS = {
+    "gzip": (gzip, ".jsonl.gz"),
+    "lzma": (lzma, ".jsonl.xz")
+}
+
+ROLLUPS_FILE = 'rollups.json'
+WATERMARK_FILE = 'compacted_before'
+
+def list_segments(directory, start_day=None, end_day=None):
+    """Return (day, path, codec) for every segment in [start_day, end_day], oldest first"""
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for filename in os.listdir(directory):
+        for codec, (_, suffix) in CODECS.items():
+            if filename.endswith(suffix):
+                day = filename[:-len(suffix)]
+                if start_day and day < start_day:
+                    break
+                if end_day and day > end_day:
+                    break
+                segments.append((day, os.path.join(directory, filename), codec))
+                break
+    segments.sort()
+    return segments
+
+def read_segments(directory, start=None, end=None, medication=None):
+    """Yield archived events with start <= time <= end, oldest first.
+
+    start and end use the history time format ("YYYY-MM-DD HH:MM"), so only
+    the segments for the days they cover are decompressed.
+    """
+    start_day = start[:10] if start else None
+    end_day = end[:10] if end else None
+    for day, path, codec in list_segments(directory, start_day, end_day):
+        module = CODECS[codec][0]
+        with module.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                event = json.loads(line)
+                if start and event["time"] < start:
+                    continue
+                if end and event["time"] > end:
+                    continue
+                if medication and event["medication"] != medication:
+                    continue
+                yield event
+
+def load_rollups(directory):
+    path = os.path.join(directory, ROLLUPS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_rollups(directory, rollups):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, ROLLUPS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(rollups, f)
+    os.replace(path + '.tmp', path)
+
+def load_watermark(directory):
+    """Cutoff of the last compaction; everything before it is archived"""
+    path = os.path.join(directory, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read().strip() or None
+
+def save_watermark(directory, cutoff):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(cutoff)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,434 @@
+"""Append-only, segmented binary log of dose results.
+
+Every recorded dose is one fixed-size record in the current segment file
+(history_log/seg-000001.log, ...). Medication names and detail strings are
+stored once in strings.txt and referenced by id, so records stay small and
+fixed-width. A segment holds RECORDS_PER_SEGMENT records before the next one
+is started.
+
+Readers map segments with mmap and unpack only the records they return, so
+paging through years of history touches a few pages of the files instead of
+deserializing the whole log. A sparse index keeps the running maximum time
+at every INDEX_STRIDE records to find where a time range starts.
+
+Per-patient and end-bounded reads use a second index, built on first use
+with one pass over the log (vectorized with NumPy when it is installed):
+each patient's record positions in write order, and the minimum time in
+every INDEX_STRIDE block, which bounds where a time range ends.
+"""
+import bisect
+import calendar
+import mmap
+import os
+import struct
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# time (wall-clock seconds), patient id, medication id, details id, status
+RECORD = struct.Struct('<qIIIB3x')
+# The same layout as NumPy structured dtype fields, for vectorized readers
+RECORD_FIELDS = [("time", "<i8"), ("patient", "<u4"), ("medication", "<u4"),
+                 ("details", "<u4"), ("status", "u1"), ("pad", "V3")]
+RECORDS_PER_SEGMENT = 1 << 16
+INDEX_STRIDE = 256
+STATUSES = ["Taken", "Missed"]
+STRINGS_FILE = 'strings.txt'
+EPOCH = datetime(1970, 1, 1)
+
+def encode_time(value):
+    if isinstance(value, str):
+        value = datetime.strptime(value, "%Y-%m-%d %H:%M")
+    # Naive wall-clock time stored as if it were UTC, so it reads back unchanged
+    return calendar.timegm(value.timetuple())
+
+def decode_time(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+def segment_path(directory, segment):
+    return os.path.join(directory, 'seg-%06d.log' % (segment + 1))
+
+class HistoryLog:
+    def __init__(self, directory, records_per_segment=RECORDS_PER_SEGMENT):
+        self.directory = directory
+        self.records_per_segment = records_per_segment
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self.strings = []
+        self.string_ids = {}
+        strings_path = os.path.join(directory, STRINGS_FILE)
+        if os.path.exists(strings_path):
+            with open(strings_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self._remember(line.rstrip('\n'))
+        self.strings_file = open(strings_path, 'a', encoding='utf-8')
+
+        # Per segment: record count, read-only map and sparse running-max times
+        self.counts = []
+        self.maps = []
+        self.sparse = []
+        segment = 0
+        while os.path.exists(self.segment_path(segment)):
+            size = os.path.getsize(self.segment_path(segment))
+            self.counts.append(size // RECORD.size)
+            self.maps.append(None)
+            self.sparse.append([])
+            segment += 1
+        if not self.counts:
+            self.counts.append(0)
+            self.maps.append(None)
+            self.sparse.append([])
+        self.running_max = 0
+        for segment in range(len(self.counts)):
+            self._index_segment(segment)
+        # Built on first use: record positions and latest time per patient
+        # id, and per segment the minimum time in each INDEX_STRIDE block
+        self.positions = None
+        self.patient_max = None
+        self.block_min = None
+
+        # Drop a partial record left by a crash mid-write
+        last = len(self.counts) - 1
+        with open(self.segment_path(last), 'ab') as f:
+            f.truncate(self.counts[last] * RECORD.size)
+        self.active = open(self.segment_path(last), 'ab')
+
+    def segment_path(self, segment):
+        return segment_path(self.directory, segment)
+
+    def _remember(self, text):
+        self.string_ids[text] = len(self.strings)
+        self.strings.append(text)
+
+    def string_id(self, text):
+        text = str(text).replace('\n', ' ')
+        string_id = self.string_ids.get(text)
+        if string_id is None:
+            self._remember(text)
+            self.strings_file.write(text + '\n')
+            self.strings_file.flush()
+            string_id = self.string_ids[text]
+        return string_id
+
+    def _index_segment(self, segment):
+        view = self._view(segment)
+        for i in range(0, self.counts[segment], INDEX_STRIDE):
+            self.running_max = max(self.running_max, RECORD.unpack_from(view, i * RECORD.size)[0])
+            self.sparse[segment].append(self.running_max)
+        if self.counts[segment]:
+            last = RECORD.unpack_from(view, (self.counts[segment] - 1) * RECORD.size)[0]
+            self.running_max = max(self.running_max, last)
+
+    def _view(self, segment):
+        """Read-only map of a segment, remapped when the active one has grown"""
+        needed = self.counts[segment] * RECORD.size
+        current = self.maps[segment]
+        if current is None or len(current) < needed:
+            if needed == 0:
+                return b''
+            with open(self.segment_path(segment), 'rb') as f:
+                current = mmap.mmap(f.fileno(), needed, access=mmap.ACCESS_READ)
+            self.maps[segment] = current
+        return current
+
+    # Writing
+
+    def pack(self, event, patient=0):
+        return RECORD.pack(encode_time(event["time"]),
+                           patient,
+                           self.string_id(event["medication"]),
+                           self.string_id(event.get("details", "")),
+                           STATUSES.index(event["status"]))
+
+    def append(self, event, patient=0):
+        self.append_many([event], patient)
+
+    def append_many(self, events, patient=0):
+        """Append events in one write per segment they land in"""
+        with self.lock:
+            records = [self.pack(event, patient) for event in events]
+            self.append_records(records)
+
+    def append_records(self, records):
+        # Caller holds the lock; records are packed RECORD bytes
+        while records:
+            segment = len(self.counts) - 1
+            room = self.records_per_segment - self.counts[segment]
+            if room == 0:
+                self.active.close()
+                self.counts.append(0)
+                self.maps.append(None)
+                self.sparse.append([])
+                if self.block_min is not None:
+                    self.block_min.append([])
+                self.active = open(self.segment_path(segment + 1), 'ab')
+                continue
+            chunk, records = records[:room], records[room:]
+            self.active.write(b''.join(chunk))
+            self.active.flush()
+            start = self.counts[segment]
+            for i, record in enumerate(chunk, start):
+                timestamp, patient = RECORD.unpack_from(record)[:2]
+                if self.positions is not None:
+                    self.positions.setdefault(patient, array('I')).append(
+                        segment * self.records_per_segment + i)
+                    self.patient_max[patient] = max(self.patient_max.get(patient, timestamp), timestamp)
+                    mins = self.block_min[segment]
+                    if i % INDEX_STRIDE == 0:
+                        mins.append(timestamp)
+                    else:
+                        mins[-1] = min(mins[-1], timestamp)
+                self.running_max = max(self.running_max, timestamp)
+                if i % INDEX_STRIDE == 0:
+                    self.sparse[segment].append(self.running_max)
+            self.counts[segment] += len(chunk)
+
+    def sync(self):
+        """Force appended records to stable storage"""
+        with self.lock:
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.strings_file.flush()
+            os.fsync(self.strings_file.fileno())
+
+    # Reading
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def _index_records(self):
+        # Caller holds the lock
+        if self.positions is not None:
+            return
+        if np is not None:
+            self._index_records_numpy()
+            return
+        positions = {}
+        latest = {}
+        block_min = []
+        for segment, count in enumerate(self.counts):
+            base = segment * self.records_per_segment
+            mins = []
+            view = memoryview(self._view(segment))[:count * RECORD.size]
+            for i, record in enumerate(RECORD.iter_unpack(view)):
+                timestamp, patient = record[:2]
+                positions.setdefault(patient, array('I')).append(base + i)
+                latest[patient] = max(latest.get(patient, timestamp), timestamp)
+                if i % INDEX_STRIDE == 0:
+                    mins.append(timestamp)
+                else:
+                    mins[-1] = min(mins[-1], timestamp)
+            block_min.append(mins)
+        self.positions, self.patient_max, self.block_min = positions, latest, block_min
+
+    def _index_records_numpy(self):
+        dtype = np.dtype(RECORD_FIELDS)
+        times = []
+        patients = []
+        block_min = []
+        for segment, count in enumerate(self.counts):
+            if count == 0:
+                block_min.append([])
+                continue
+            records = np.frombuffer(self._view(segment), dtype, count)
+            times.append(records["time"].copy())
+            patients.append(records["patient"].copy())
+            block_min.append(np.minimum.reduceat(times[-1], np.arange(0, count, INDEX_STRIDE)).tolist())
+            del records
+        positions = {}
+        latest = {}
+        if times:
+            # Global positions; every segment but the last is full
+            times = np.concatenate(times)
+            patients = np.concatenate(patients)
+            order = np.argsort(patients, kind='stable').astype(np.uint32)
+            grouped = patients[order]
+            bounds = np.flatnonzero(grouped[1:] != grouped[:-1]) + 1
+            starts = np.concatenate(([0], bounds))
+            maxes = np.maximum.reduceat(times[order], starts)
+            for patient, latest_time, chunk in zip(grouped[starts].tolist(), maxes.tolist(),
+                                                   np.split(order, bounds)):
+                positions[patient] = array('I', chunk.tobytes())
+                latest[patient] = latest_time
+        self.positions, self.patient_max, self.block_min = positions, latest, block_min
+
+    def patient_count(self, patient):
+        """Number of records for one patient"""
+        with self.lock:
+            self._index_records()
+            return len(self.positions.get(patient, ()))
+
+    def patient_positions(self, patient):
+        """Positions of one patient's records, in the order written"""
+        with self.lock:
+            self._index_records()
+            return self.positions.get(patient, array('I'))
+
+    def _start_position(self, start_ts):
+        # Caller holds the lock. Records before the returned position are all
+        # earlier than start_ts: the running max before it is below start_ts
+        previous = 0
+        for segment, sparse in enumerate(self.sparse):
+            block = bisect.bisect_left(sparse, start_ts)
+            if block < len(sparse):
+                if block == 0:
+                    return previous
+                return segment * self.records_per_segment + (block - 1) * INDEX_STRIDE
+            if sparse:
+                previous = segment * self.records_per_segment + (len(sparse) - 1) * INDEX_STRIDE
+        return previous
+
+    def _end_position(self, end_ts):
+        # Caller holds the lock and has built the index. Records from the
+        # returned position on are all later than end_ts
+        for segment in range(len(self.counts) - 1, -1, -1):
+            mins = self.block_min[segment]
+            if not mins or min(mins) > end_ts:
+                continue
+            block = len(mins) - 1
+            while mins[block] > end_ts:
+                block -= 1
+            return segment * self.records_per_segment + min((block + 1) * INDEX_STRIDE,
+                                                            self.counts[segment])
+        return 0
+
+    def to_event(self, record):
+        timestamp, patient, medication, details, status = record
+        return {
+            "medication": self.strings[medication],
+            "time": decode_time(timestamp).strftime("%Y-%m-%d %H:%M"),
+            "status": STATUSES[status],
+            "details": self.strings[details]
+        }
+
+    def record_at(self, position):
+        segment, i = divmod(position, self.records_per_segment)
+        with self.lock:
+            view = self._view(segment)
+        return RECORD.unpack_from(view, i * RECORD.size)
+
+    def latest(self, offset=0, limit=50, patient=None):
+        """A page of events, newest first, without touching the rest of the log"""
+        if patient is not None:
+            positions = self.patient_positions(patient)
+            first = len(positions) - 1 - offset
+            return [self.to_event(self.record_at(positions[k]))
+                    for k in range(first, max(first - limit, -1), -1)]
+        total = len(self)
+        first = total - 1 - offset
+        return [self.to_event(self.record_at(p))
+                for p in range(first, max(first - limit, -1), -1)]
+
+    def newest(self, patient=None):
+        """Yield raw records newest first, optionally for one patient"""
+        if patient is not None:
+            positions = self.patient_positions(patient)
+            for k in range(len(positions) - 1, -1, -1):
+                yield self.record_at(positions[k])
+            return
+        with self.lock:
+            segments = len(self.counts)
+        for segment in range(segments - 1, -1, -1):
+            with self.lock:
+                count = self.counts[segment]
+                view = self._view(segment)
+            for i in range(count - 1, -1, -1):
+                yield RECORD.unpack_from(view, i * RECORD.size)
+
+    def records(self, start=None, end=None, patient=None, medication=None):
+        """Yield raw (time, patient, medication, details, status) tuples, in the order written"""
+        start_ts = encode_time(start) if start is not None else None
+        end_ts = encode_time(end) if end is not None else None
+        medication_id = self.string_ids.get(medication) if medication is not None else None
+        if medication is not None and medication_id is None:
+            return
+        with self.lock:
+            if end_ts is not None or patient is not None:
+                self._index_records()
+            # Late-arriving doses are appended out of time order, so the
+            # bounds come from the indexes rather than the first record past end
+            first = self._start_position(start_ts) if start_ts is not None else 0
+            stop = self._end_position(end_ts) if end_ts is not None else len(self)
+            positions = self.positions.get(patient, array('I')) if patient is not None else None
+        if positions is not None:
+            scan = (self.record_at(positions[k])
+                    for k in range(bisect.bisect_left(positions, first),
+                                   bisect.bisect_left(positions, stop)))
+        else:
+            scan = self._scan(first, stop)
+        for record in scan:
+            if start_ts is not None and record[0] < start_ts:
+                continue
+            if end_ts is not None and record[0] > end_ts:
+                continue
+            if medication_id is not None and record[2] != medication_id:
+                continue
+            yield record
+
+    def _scan(self, first, stop):
+        """Yield the raw records at positions first..stop-1"""
+        while first < stop:
+            segment, i = divmod(first, self.records_per_segment)
+            with self.lock:
+                count = min(self.counts[segment], i + stop - first)
+                view = self._view(segment)
+            if i >= count:
+                return
+            yield from RECORD.iter_unpack(memoryview(view)[i * RECORD.size:count * RECORD.size])
+            first += self.records_per_segment - i
+
+    def segment_views(self):
+        """Yield a buffer of the packed records in each segment, oldest first"""
+        with self.lock:
+            segments = len(self.counts)
+        for segment in range(segments):
+            with self.lock:
+                count = self.counts[segment]
+                view = self._view(segment)
+            if count:
+                yield memoryview(view)[:count * RECORD.size]
+
+    def read(self, start=None, end=None, patient=None, medication=None):
+        """Yield events as history dicts, in the order written"""
+        for record in self.records(start, end, patient, medication):
+            yield self.to_event(record)
+
+    def first_time(self, patient=None):
+        """Time of the record written first"""
+        if len(self) == 0 or (patient is not None and self.patient_count(patient) == 0):
+            return None
+        if patient is not None:
+            return decode_time(self.record_at(self.patient_positions(patient)[0])[0])
+        return decode_time(self.record_at(0)[0])
+
+    def latest_time(self, patient=None):
+        """Latest dose time logged, which late records can make later than last_time()"""
+        with self.lock:
+            if patient is None:
+                return decode_time(self.running_max) if len(self) else None
+            self._index_records()
+            latest = self.patient_max.get(patient)
+        return decode_time(latest) if latest is not None else None
+
+    def last_time(self, patient=None):
+        """Time of the record written last (not necessarily the latest time)"""
+        total = len(self)
+        if total == 0 or (patient is not None and self.patient_count(patient) == 0):
+            return None
+        if patient is not None:
+            return decode_time(next(self.newest(patient))[0])
+        return decode_time(self.record_at(total - 1)[0])
+
+    def close(self):
+        with self.lock:
+            self.active.close()
+            self.strings_file.close()
+            for view in self.maps:
+                if view is not None:
+                    view.close()
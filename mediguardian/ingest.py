@@ -0,0 +1,277 @@
+"""Batched ingestion of pill scans pushed by dispensers and cameras.
+
+Devices POST batches of scan events to /scans, as NDJSON or in the compact
+binary format below. A batch is parsed in the request thread and put on a
+bounded queue. When MAX_PENDING_EVENTS are already waiting, the batch is
+turned away with 429 so devices back off and retry. One writer thread takes
+every batch waiting on the queue, has the app match them to dose slots and
+append the doses to the history log, syncs the log once for the whole
+group, and only then acknowledges each batch.
+
+Each scan claims the open dose slot of its patient and medication nearest
+its time, within SCAN_WINDOW. A slot is claimed once, so a batch that is
+retried after a timeout reports its scans as duplicates instead of
+recording them twice.
+
+NDJSON, one scan per line:
+
+    {"device": "cab-3", "patient": 12, "medication": "Metformin",
+     "time": "2026-10-19 13:02", "shape": "oval", "color": "blue", "imprint": "M500"}
+
+time is "YYYY-MM-DD HH:MM[:SS]" local time or Unix seconds. shape, color and
+imprint are what a camera saw; a dispenser that only reports the
+compartment it opened leaves them out.
+
+Binary, little-endian: b'MGS1', a u16 count of strings, each string as a u16
+length and UTF-8 bytes, then one 24-byte record per scan: time (i64 Unix
+seconds), patient (u32), and u16 string ids for device, medication, shape,
+color and imprint (NO_STRING where absent).
+"""
+import bisect
+import json
+import queue
+import struct
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+import recurrence
+
+BINARY_MAGIC = b'MGS1'
+BINARY_RECORD = struct.Struct('<qI5H2x')
+NO_STRING = 0xFFFF
+SCAN_FIELDS = ("device", "medication", "shape", "color", "imprint")
+
+MAX_BATCH_EVENTS = 10000
+MAX_PENDING_EVENTS = 50000
+# The writer stops adding batches to a group once it holds this many scans
+GROUP_COMMIT_EVENTS = 20000
+
+# How far from a slot's time a scan still counts for it
+SCAN_WINDOW = timedelta(hours=1)
+# Slots indexed either side of the present
+SLOT_HORIZON = timedelta(days=1)
+
+class IngestError(Exception):
+    """Rejected batch; status is the HTTP status to answer with"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def parse_time(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value)
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S" if len(value) > 16 else "%Y-%m-%d %H:%M")
+    raise ValueError("time must be a date string or Unix seconds")
+
+def make_scan(time, patient, fields):
+    if not fields.get("medication"):
+        raise ValueError("medication is required")
+    if not isinstance(patient, int) or isinstance(patient, bool) or not 0 <= patient < 1 << 32:
+        raise ValueError("patient must be a non-negative integer")
+    scan = {"time": parse_time(time), "patient": patient}
+    for field in SCAN_FIELDS:
+        value = fields.get(field)
+        scan[field] = str(value) if value is not None else None
+    return scan
+
+def parse_ndjson(body):
+    scans = []
+    for number, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            event = json.loads(line)
+            if not isinstance(event, dict):
+                raise ValueError("expected an object")
+            scans.append(make_scan(event.get("time"), event.get("patient", 0), event))
+        except (ValueError, OverflowError, OSError) as e:
+            raise IngestError(f"line {number}: {e}")
+    return scans
+
+def parse_binary(body):
+    view = memoryview(body)
+    if bytes(view[:4]) != BINARY_MAGIC:
+        raise IngestError("binary batches start with " + BINARY_MAGIC.decode())
+    try:
+        (count,) = struct.unpack_from('<H', view, 4)
+        offset = 6
+        strings = []
+        for _ in range(count):
+            (length,) = struct.unpack_from('<H', view, offset)
+            strings.append(bytes(view[offset + 2:offset + 2 + length]).decode('utf-8'))
+            offset += 2 + length
+        if (len(view) - offset) % BINARY_RECORD.size:
+            raise ValueError("truncated record")
+        scans = []
+        for time, patient, *ids in BINARY_RECORD.iter_unpack(view[offset:]):
+            fields = {field: strings[i] if i != NO_STRING else None
+                      for field, i in zip(SCAN_FIELDS, ids)}
+            scans.append(make_scan(time, patient, fields))
+    except (struct.error, IndexError, UnicodeDecodeError, ValueError, OverflowError, OSError) as e:
+        raise IngestError(f"malformed binary batch: {e}")
+    return scans
+
+def encode_binary(scans):
+    """Binary batch for a list of scan dicts (the inverse of parse_binary)"""
+    strings = {}
+    def string_id(value):
+        if value is None:
+            return NO_STRING
+        return strings.setdefault(str(value), len(strings))
+    records = []
+    for scan in scans:
+        time = scan["time"]
+        if isinstance(time, str):
+            time = parse_time(time)
+        if isinstance(time, datetime):
+            time = time.timestamp()
+        records.append(BINARY_RECORD.pack(int(time), scan.get("patient", 0),
+                                          *(string_id(scan.get(field)) for field in SCAN_FIELDS)))
+    header = [BINARY_MAGIC, struct.pack('<H', len(strings))]
+    for text in strings:
+        data = text.encode('utf-8')
+        header.append(struct.pack('<H', len(data)) + data)
+    return b''.join(header + records)
+
+def parse_batch(body, content_type=''):
+    if body[:4] == BINARY_MAGIC or 'octet-stream' in content_type:
+        scans = parse_binary(body)
+    else:
+        try:
+            scans = parse_ndjson(body.decode('utf-8'))
+        except UnicodeDecodeError:
+            raise IngestError("NDJSON batches must be UTF-8")
+    if not scans:
+        raise IngestError("empty batch")
+    if len(scans) > MAX_BATCH_EVENTS:
+        raise IngestError(f"at most {MAX_BATCH_EVENTS} scans per batch", 413)
+    return scans
+
+class SlotIndex:
+    """Dose slots near the present, per medication, and which are claimed.
+
+    Slots are taken from the schedule index for SLOT_HORIZON either side of
+    the present, and rebuilt when the catalog is swapped or the present
+    moves too close to the edge. Scans and scheduler checks both claim slots
+    here, so whichever reaches a slot first records it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules = None
+        self.start = self.end = None
+        # medication -> sorted slot times
+        self.slots = {}
+        # (patient, medication, slot time)
+        self.claimed = set()
+
+    def refresh(self, rules, now):
+        # Caller holds the lock
+        if (rules is self.rules and self.start <= now - SLOT_HORIZON / 2
+                and now + SLOT_HORIZON / 2 <= self.end):
+            return
+        start, end = now - SLOT_HORIZON, now + SLOT_HORIZON
+        slots = {}
+        for when, med in recurrence.upcoming(rules, start, end):
+            slots.setdefault(med, []).append(when)
+        self.rules, self.slots, self.start, self.end = rules, slots, start, end
+        self.claimed = {key for key in self.claimed if key[2] >= start - SCAN_WINDOW}
+
+    def claim_many(self, rules, requests, now=None):
+        """Claim a slot for each (patient, medication, time).
+
+        Returns (slot time, outcome) per request: "matched" for a newly
+        claimed slot, "duplicate" when the slots in reach are all claimed
+        already, or "unmatched" (slot None) when no slot is in reach.
+        """
+        results = []
+        with self.lock:
+            self.refresh(rules, now or datetime.now())
+            for patient, medication, when in requests:
+                times = self.slots.get(medication, ())
+                i = bisect.bisect_left(times, when - SCAN_WINDOW)
+                # Nearest slot first among those within the window
+                reach = sorted(times[i:bisect.bisect_right(times, when + SCAN_WINDOW)],
+                               key=lambda slot: abs(slot - when))
+                result = (None, "unmatched")
+                for slot in reach:
+                    key = (patient, medication, slot)
+                    if key not in self.claimed:
+                        self.claimed.add(key)
+                        result = (slot, "matched")
+                        break
+                    result = (slot, "duplicate")
+                results.append(result)
+        return results
+
+    def release(self, keys):
+        """Give back (patient, medication, slot time) claims whose doses were not written"""
+        with self.lock:
+            self.claimed.difference_update(keys)
+
+class ScanIngestor:
+    def __init__(self, record, sync, max_pending=MAX_PENDING_EVENTS):
+        """record(scans) matches and records one group of scans, returning an
+        outcome per scan; sync() makes what it wrote durable. When either
+        raises, every batch in the group fails with that error."""
+        self.record = record
+        self.sync = sync
+        self.max_pending = max_pending
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.stats = {"batches": 0, "scans": 0, "groups": 0, "rejected": 0}
+        self.writer_thread = threading.Thread(target=self.writer, name='scan-writer', daemon=True)
+        self.writer_thread.start()
+
+    def submit(self, scans):
+        """Queue a parsed batch; returns a Future for its outcomes"""
+        with self.lock:
+            if not self.writer_thread.is_alive():
+                raise IngestError("scan writer is not running", 503)
+            # An oversized batch is still let in when nothing else is waiting
+            if self.pending and self.pending + len(scans) > self.max_pending:
+                self.stats["rejected"] += 1
+                raise IngestError("too many scans waiting to be written, retry shortly", 429)
+            self.pending += len(scans)
+        future = Future()
+        self.queue.put((scans, future))
+        return future
+
+    def writer(self):
+        while True:
+            group = [self.queue.get()]
+            size = len(group[0][0])
+            while size < GROUP_COMMIT_EVENTS:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                group.append(item)
+                size += len(item[0])
+            try:
+                outcomes = self.record([scan for scans, _ in group for scan in scans])
+                self.sync()
+            except Exception as e:
+                for _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                position = 0
+                for scans, future in group:
+                    # A caller that gave up waiting may have cancelled it
+                    if not future.done():
+                        future.set_result(outcomes[position:position + len(scans)])
+                    position += len(scans)
+            with self.lock:
+                self.pending -= size
+                self.stats["batches"] += len(group)
+                self.stats["scans"] += size
+                self.stats["groups"] += 1
+
+def summarize(outcomes):
+    summary = {"accepted": len(outcomes), "taken": 0, "missed": 0, "duplicate": 0, "unmatched": 0}
+    for outcome in outcomes:
+        summary[outcome] += 1
+    return summary
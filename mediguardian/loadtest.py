@@ -0,0 +1,394 @@
+"""Concurrent load generator for the MediGuardian app.
+
+Each virtual user behaves like an open dashboard: on the dashboard's 5 second
+interval (compressed by --time-scale) it polls /fragments and fetches the
+fragments that changed, alongside a /data poll, and now and then reloads the
+page, acknowledges an alert, or adds a medication and deletes it again.
+Scheduler ticks run alongside the users. For every concurrency level the
+run reports throughput, latency percentiles per route, errors, and
+shared-state inconsistencies found by checking the app's invariants.
+
+    python loadtest.py                              # in-process, scratch data dir
+    python loadtest.py --url http://127.0.0.1:5000  # running server over localhost
+    python loadtest.py --emergency                  # plus emergency latency under load
+    python loadtest.py --scan-devices 8             # plus devices pushing scan batches
+
+With --emergency the in-process app notifies local stand-in sinks: a crowd of
+routine contacts behind a slow webhook that keeps the notifier's shared pool
+busy, and emergency contacts behind a fast one. A probe presses the help
+button throughout the run, and the level fails with an inconsistency if p95
+emergency delivery latency (button press to sink) exceeds --emergency-target-ms.
+
+Against a running server the users add and delete LoadTest-* medications in
+its real catalog, so point it at a disposable instance.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import ingest
+import notifications
+
+# How a dashboard session behaves per 5 second poll
+POLL_INTERVAL = 5.0
+RELOAD_PROBABILITY = 0.05
+MARK_READ_PROBABILITY = 0.05
+ADD_MEDICATION_PROBABILITY = 0.02
+# Stand-in contacts used by --emergency
+ROUTINE_CONTACTS = 20
+EMERGENCY_CONTACTS = 2
+ROUTINE_ALERTS_PER_PROBE = 4
+
+class InProcessClient:
+    """Drives the Flask app through its test client, one per thread"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, content_type=None):
+        if content_type:
+            response = self.client.open(path, method=method, data=body, content_type=content_type)
+        else:
+            response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_data()
+
+class HttpClient:
+    """Keep-alive connection to a running server"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connection = None
+
+    def request(self, method, path, body=None, content_type=None):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {}
+        payload = None
+        if content_type:
+            payload = body
+            headers['Content-Type'] = content_type
+        elif body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.inconsistencies = []
+        self.counters = {}
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def inconsistent(self, message):
+        with self.lock:
+            self.inconsistencies.append(message)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def timed(client, stats, route, method, path, body=None):
+    start = time.perf_counter()
+    try:
+        status, payload = client.request(method, path, body)
+        ok = 200 <= status < 300
+    except Exception:
+        status, payload, ok = None, b'', False
+    stats.record(route, time.perf_counter() - start, ok)
+    return payload if ok else None
+
+def check_snapshot(stats, payload):
+    """Invariants visible to any client in a single /data response"""
+    try:
+        state = json.loads(payload)["state"]
+    except (ValueError, KeyError, TypeError):
+        stats.inconsistent("/data returned an unparseable body")
+        return None
+    unread = {}
+    for alert in state["alerts"]:
+        if not alert["read"]:
+            unread[alert["level"]] = unread.get(alert["level"], 0) + 1
+    for level, count in state["unread_alerts"].items():
+        if unread.get(level, 0) != count:
+            stats.inconsistent(f"unread_alerts[{level}]={count} but {unread.get(level, 0)} unread alerts")
+    ids = [alert["id"] for alert in state["alerts"]]
+    if len(ids) != len(set(ids)):
+        stats.inconsistent("duplicate alert ids")
+    return state
+
+def dashboard_session(client, stats, user, stop, time_scale):
+    rng = random.Random(user)
+    added = None
+    versions = {}
+    while not stop.is_set():
+        payload = timed(client, stats, '/fragments', 'GET', '/fragments')
+        if payload is not None:
+            latest = json.loads(payload)["versions"]
+            for name, version in latest.items():
+                if versions.get(name) != version:
+                    timed(client, stats, '/fragments/<name>', 'GET', f'/fragments/{name}')
+            versions = latest
+
+        payload = timed(client, stats, '/data', 'GET', '/data')
+        state = check_snapshot(stats, payload) if payload is not None else None
+
+        if rng.random() < RELOAD_PROBABILITY:
+            timed(client, stats, '/', 'GET', '/')
+        if state and rng.random() < MARK_READ_PROBABILITY:
+            unread = [alert["id"] for alert in state["alerts"] if not alert["read"]]
+            if unread:
+                timed(client, stats, '/mark_alert_read', 'GET', f'/mark_alert_read/{rng.choice(unread)}')
+        if added:
+            timed(client, stats, '/delete_medication', 'POST', '/delete_medication', {"name": added})
+            added = None
+        elif rng.random() < ADD_MEDICATION_PROBABILITY:
+            added = f"LoadTest-{user}"
+            timed(client, stats, '/add_medication', 'POST', '/add_medication', {
+                "name": added,
+                "dose": "1 mg",
+                "schedule": "%02d:%02d" % (rng.randrange(24), rng.randrange(60))
+            })
+        stop.wait(POLL_INTERVAL * time_scale)
+    if added:
+        timed(client, stats, '/delete_medication', 'POST', '/delete_medication', {"name": added})
+
+def scheduler_ticks(mg, stats, stop, interval):
+    minute = None
+    while not stop.is_set():
+        # Keep a dose due in the current minute. The first tick in a minute
+        # checks and records it; later ones find its slot claimed and only
+        # reschedule, so tick latency mixes both
+        now = mg.datetime.now().strftime("%H:%M")
+        if now != minute:
+            mg.apply_medication_batch([{"op": "add", "name": "LoadTest-scheduled",
+                                        "dose": "1 mg", "schedule": [now]}])
+            minute = now
+        start = time.perf_counter()
+        try:
+            mg.medication_check()
+            ok = True
+        except Exception as e:
+            stats.inconsistent(f"scheduler tick raised {e!r}")
+            ok = False
+        stats.record('scheduler tick', time.perf_counter() - start, ok)
+        stop.wait(interval)
+
+def scan_device(client, stats, device, stop, batch_size):
+    """A dispenser cabinet pushing binary scan batches as fast as they are acknowledged"""
+    patient = (device + 1) * 1000000
+    while not stop.is_set():
+        body = ingest.encode_binary([{"patient": patient + i, "medication": "LoadTest-scheduled",
+                                      "time": datetime.now(), "device": f"cab-{device}",
+                                      "shape": "round", "color": "white"}
+                                     for i in range(batch_size)])
+        patient += batch_size
+        start = time.perf_counter()
+        try:
+            status, _ = client.request('POST', '/scans', body, 'application/octet-stream')
+        except Exception:
+            status = None
+        # 429 is the ingestion queue pushing back, not a failure
+        stats.record('/scans', time.perf_counter() - start, status in (200, 429))
+        if status == 200:
+            stats.count('scans', batch_size)
+        elif status == 429:
+            stats.count('scan batches turned away')
+            stop.wait(0.05)
+
+def emergency_probe(mg, client, stats, stop, interval):
+    while not stop.is_set():
+        # Routine alerts arrive faster than the shared pool can deliver them
+        mg.send_alerts([("family", "LoadTest-scheduled", False)] * ROUTINE_ALERTS_PER_PROBE)
+        timed(client, stats, '/trigger_emergency', 'POST', '/trigger_emergency')
+        stop.wait(interval)
+
+def emergency_registry(routine_url, emergency_url):
+    """Routine contacts on a slow sink, emergency contacts on a fast one"""
+    contacts = [{"name": f"Family {i}", "webhook": routine_url, "levels": ["family", "caregiver"]}
+                for i in range(ROUTINE_CONTACTS)]
+    contacts += [{"name": f"Responder {i}", "webhook": emergency_url, "levels": ["emergency"]}
+                 for i in range(EMERGENCY_CONTACTS)]
+    return {"transports": {}, "contacts": contacts}
+
+def start_sinks(routine_latency):
+    servers = (notifications.StandInHTTPServer(('127.0.0.1', 0), routine_latency),
+               notifications.StandInHTTPServer(('127.0.0.1', 0)))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return [f"http://127.0.0.1:{server.server_address[1]}/hook" for server in servers]
+
+def check_emergency_latency(mg, stats, target_ms):
+    values = sorted(mg.notifier.emergency_latency)
+    mg.notifier.emergency_latency.clear()
+    stats.latencies['emergency delivery'] = values
+    if not values:
+        stats.inconsistent("no emergency alert was delivered")
+    elif percentile(values, 0.95) * 1000 > target_ms:
+        stats.inconsistent(f"p95 emergency delivery latency "
+                           f"{percentile(values, 0.95) * 1000:.0f}ms exceeds {target_ms:.0f}ms")
+
+def check_invariants(mg, stats):
+    """Whole-state invariants, checked in-process once traffic has stopped"""
+    state = mg.system_state
+    with mg.state_lock:
+        unread = {}
+        for alert in state["alerts"]:
+            if not alert["read"]:
+                unread[alert["level"]] = unread.get(alert["level"], 0) + 1
+        for level, count in state["unread_alerts"].items():
+            if unread.get(level, 0) != count:
+                stats.inconsistent(f"unread_alerts[{level}]={count} but {unread.get(level, 0)} unread alerts")
+        if len(mg.alert_index["by_id"]) != len(state["alerts"]):
+            stats.inconsistent("alert index and alert list disagree")
+        expected_status = state["status"]
+        mg.update_status()
+        if state["status"] != expected_status:
+            stats.inconsistent(f"status {expected_status} does not match unread counters")
+        if state["compliance_rate"] != mg.calculate_compliance():
+            stats.inconsistent("compliance_rate is stale")
+        window = mg.adherence_window(start=mg.datetime(1970, 1, 2), end=mg.datetime(9999, 1, 1))
+        tracked = len(state["compliance_history"]) + sum(mg.archived_totals.values())
+        if window["Taken"] + window["Missed"] != tracked:
+            stats.inconsistent("adherence index count differs from recorded history")
+        if any(name.startswith("LoadTest-") and name != "LoadTest-scheduled"
+               for name in mg.MEDICATION_DB):
+            stats.inconsistent("medication added during the run was not deleted")
+
+def run_level(make_client, users, duration, time_scale, mg=None, tick_interval=None,
+              emergency_interval=None, emergency_target_ms=None, scan_devices=0, scan_batch=500):
+    stats = Stats()
+    stop = threading.Event()
+    threads = [threading.Thread(target=dashboard_session,
+                                args=(make_client(), stats, user, stop, time_scale))
+               for user in range(users)]
+    threads += [threading.Thread(target=scan_device,
+                                 args=(make_client(), stats, device, stop, scan_batch))
+                for device in range(scan_devices)]
+    if mg is not None and tick_interval:
+        threads.append(threading.Thread(target=scheduler_ticks, args=(mg, stats, stop, tick_interval)))
+    if mg is not None and emergency_interval:
+        mg.notifier.emergency_latency.clear()
+        threads.append(threading.Thread(target=emergency_probe,
+                                        args=(mg, make_client(), stats, stop, emergency_interval)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if mg is not None:
+        check_invariants(mg, stats)
+        if emergency_interval:
+            # Let deliveries already queued finish before reading latencies
+            time.sleep(0.5)
+            check_emergency_latency(mg, stats, emergency_target_ms)
+    return stats, elapsed
+
+def report(users, stats, elapsed):
+    total = sum(len(v) for k, v in stats.latencies.items()
+                if k not in ('scheduler tick', 'emergency delivery'))
+    errors = sum(stats.errors.values())
+    print(f"\n== {users} users: {total} requests in {elapsed:.1f}s "
+          f"({total / elapsed:.0f} req/s), {errors} errors, "
+          f"{len(stats.inconsistencies)} inconsistencies")
+    print(f"{'route':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for route, values in sorted(stats.latencies.items()):
+        values.sort()
+        print(f"{route:<20}{len(values):>8}"
+              f"{percentile(values, 0.50) * 1000:>10.1f}"
+              f"{percentile(values, 0.95) * 1000:>10.1f}"
+              f"{percentile(values, 0.99) * 1000:>10.1f}"
+              f"{values[-1] * 1000:>10.1f}"
+              f"{stats.errors.get(route, 0):>8}")
+    if 'scans' in stats.counters:
+        print(f"scans: {stats.counters['scans']} written ({stats.counters['scans'] / elapsed:.0f}/s), "
+              f"{stats.counters.get('scan batches turned away', 0)} batches turned away")
+    for message in sorted(set(stats.inconsistencies))[:10]:
+        print(f"  ! {message}")
+
+def load_app(data_dir):
+    """Import the app against a scratch copy of its data files"""
+    os.environ.setdefault('MEDIGUARDIAN_SCHEDULER', 'off')
+    # The app opens and writes its files relative to the working directory as
+    # soon as it is imported, so it has to start inside data_dir
+    for name in ('medications.json', 'contacts.json'):
+        if os.path.exists(name):
+            shutil.copy(name, data_dir)
+    os.chdir(data_dir)
+    import mediguardian as mg
+    mg.save_medications(mg.MEDICATION_DB)
+    return mg
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test MediGuardian")
+    parser.add_argument('--url', help="target a running server instead of the in-process app")
+    parser.add_argument('--levels', default='1,5,10,25,50',
+                        help="comma-separated numbers of concurrent dashboard users")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per level")
+    parser.add_argument('--time-scale', type=float, default=0.01,
+                        help="multiplier on the 5s poll interval (1.0 = real dashboards)")
+    parser.add_argument('--tick-interval', type=float, default=0.05,
+                        help="seconds between in-process scheduler ticks (0 disables)")
+    parser.add_argument('--emergency', action='store_true',
+                        help="measure emergency alert latency while routine alerts saturate the notifier")
+    parser.add_argument('--emergency-interval', type=float, default=0.2,
+                        help="seconds between help button presses with --emergency")
+    parser.add_argument('--emergency-target-ms', type=float, default=250.0,
+                        help="p95 emergency delivery latency a level must stay under")
+    parser.add_argument('--routine-latency', type=float, default=0.2,
+                        help="seconds the routine contacts' sink takes per delivery")
+    parser.add_argument('--scan-devices', type=int, default=0,
+                        help="devices pushing scan batches to /scans alongside the dashboards")
+    parser.add_argument('--scan-batch', type=int, default=500, help="scans per device batch")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(',')]
+    if args.url:
+        for users in levels:
+            stats, elapsed = run_level(lambda: HttpClient(args.url), users,
+                                       args.duration, args.time_scale,
+                                       scan_devices=args.scan_devices, scan_batch=args.scan_batch)
+            report(users, stats, elapsed)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            mg = load_app(data_dir)
+            if args.emergency:
+                mg.notifier.set_registry(emergency_registry(*start_sinks(args.routine_latency)))
+            for users in levels:
+                stats, elapsed = run_level(lambda: InProcessClient(mg.app), users,
+                                           args.duration, args.time_scale,
+                                           mg=mg, tick_interval=args.tick_interval,
+                                           emergency_interval=args.emergency and args.emergency_interval,
+                                           emergency_target_ms=args.emergency_target_ms,
+                                           scan_devices=args.scan_devices, scan_batch=args.scan_batch)
+                report(users, stats, elapsed)
@@ -1,16 +1,62 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request, abort
 import threading
 import time
 import random
+import itertools
 from datetime import datetime, timedelta
 import os
 import json
+import csv
+import io
+import traceback
+from collections import deque
+import history_archive
+import notifications
+import recurrence
+import facility
+import ingest
+import risk
+from adherence_index import AdherenceIndex
+from history_log import HistoryLog
+from response_cache import ResponseCache
 
 app = Flask(__name__)
 
 # File path for medication database
 MEDICATION_DB_FILE = 'medications.json'
 
+# Minimum seconds between checks of medications.json for outside edits
+CATALOG_CHECK_INTERVAL = 1.0
+
+# Emergency contacts and the transports used to reach them
+CONTACTS_FILE = 'contacts.json'
+
+# Optional names for the facility overview; the dashboard's own patient is id 0
+PATIENTS_FILE = 'patients.json'
+LIVE_PATIENT = 0
+FACILITY_PAGE_LIMIT = 500
+
+# History older than this is rolled up per day and dropped from memory; the
+# events themselves stay in the history log
+HISTORY_RETENTION_DAYS = 14
+HISTORY_ARCHIVE_DIR = 'history_archive'
+
+# Append-only binary log of every recorded dose, kept across restarts
+HISTORY_LOG_DIR = 'history_log'
+HISTORY_PAGE_SIZE = 100
+# Most events /history/archive returns for one query
+HISTORY_QUERY_LIMIT = 1000
+
+# A gap this long between scheduler ticks means dose slots may have been skipped
+SCHEDULER_STALL_SECONDS = 60
+
+# Seconds a device waits for its scan batch to be written before getting a 503
+SCAN_ACK_TIMEOUT = 10
+
+# Doses with at least this miss risk get a reminder this many minutes ahead
+REMINDER_RISK = risk.HIGH_RISK
+REMINDER_LEAD_MINUTES = 30
+
 def load_medications():
     if os.path.exists(MEDICATION_DB_FILE):
         with open(MEDICATION_DB_FILE, 'r') as f:
@@ -65,13 +111,57 @@ def load_medications():
             }
         }
 
+def file_signature(path):
+    # Cheap change detection: a different mtime or size means re-parse
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
 def save_medications(meds):
-    with open(MEDICATION_DB_FILE, 'w') as f:
+    # Write to a temporary file and swap it in, so other readers never see half a file
+    with open(MEDICATION_DB_FILE + '.tmp', 'w') as f:
         json.dump(meds, f, indent=4)
+    os.replace(MEDICATION_DB_FILE + '.tmp', MEDICATION_DB_FILE)
+    # The file now matches memory again, replacing any broken outside edit
+    catalog_status["signature"] = file_signature(MEDICATION_DB_FILE)
+    catalog_status["error"] = system_state["catalog_error"] = None
 
 # Load medications from file
 MEDICATION_DB = load_medications()
 
+# What the in-memory catalog was loaded from, and the last reload failure if any
+catalog_status = {
+    "signature": file_signature(MEDICATION_DB_FILE),
+    "last_check": time.monotonic(),
+    "error": None
+}
+
+# Compiled recurrence rule for every medication, swapped together with MEDICATION_DB
+schedule_index = recurrence.compile_all(MEDICATION_DB)
+
+history_log = HistoryLog(HISTORY_LOG_DIR)
+
+# Delivers alerts to the contacts registered for their level
+notifier = notifications.Notifier(notifications.load_registry(CONTACTS_FILE))
+
+# Per-patient rows behind /facility, kept current as doses and alerts happen
+facility_rollups = facility.Facility(facility.load_names(PATIENTS_FILE))
+
+# Dose slots claimed by device scans or scheduler checks, so each is recorded once
+scan_slots = ingest.SlotIndex()
+
+# Miss probability of every patient's doses in the next 24 hours
+risk_model = risk.RiskModel()
+reminder_log = deque(maxlen=200)
+
+# Alert levels, from least to most severe
+ALERT_LEVELS = ["family", "caregiver", "emergency"]
+
+# Guards system_state and alert_index against the scheduler thread
+state_lock = threading.RLock()
+
 # System state with historical data
 system_state = {
     "current_med": None,
@@ -79,6 +169,7 @@ system_state = {
     "compliance_history": [],
     "alerts": [
         {
+            "id": 1,
             "level": "family",
             "message": "Missed dose of Aspirin",
             "medication": "Aspirin",
@@ -86,191 +177,1056 @@ system_state = {
             "read": False
         }
     ],
+    "unread_alerts": {level: 0 for level in ALERT_LEVELS},
     "next_dose_time": datetime.now().replace(hour=13, minute=0, second=0),
     "last_check": datetime.now().replace(hour=8, minute=14, second=0),
     "compliance_rate": 87,
-    "status": "alert"
+    "status": "alert",
+    "catalog_error": None
 }
 
+# Bumped whenever the data behind a dashboard fragment changes, so clients
+# only re-fetch the fragments that are out of date
+fragment_versions = {
+    "alerts": 0,
+    "schedule": 0,
+    "history": 0,
+    "medications": 0
+}
+
+def touch_fragments(*names):
+    for name in names:
+        fragment_versions[name] += 1
+
+def state_version():
+    # Every change to system_state or the catalog ends by touching a fragment
+    return sum(fragment_versions.values())
+
+# Alert lookup tables: alerts keep their id for life, so positions in
+# system_state["alerts"] are never used to address them
+alert_index = {
+    "next_id": 1,
+    "by_id": {},
+    "by_medication": {},
+    "by_level": {}
+}
+
+def index_alert(alert):
+    alert_index["by_id"][alert["id"]] = alert
+    alert_index["by_medication"].setdefault(alert["medication"], set()).add(alert["id"])
+    alert_index["by_level"].setdefault(alert["level"], set()).add(alert["id"])
+    alert_index["next_id"] = max(alert_index["next_id"], alert["id"] + 1)
+    if not alert["read"]:
+        unread = system_state["unread_alerts"]
+        unread[alert["level"]] = unread.get(alert["level"], 0) + 1
+
+def update_status():
+    unread = system_state["unread_alerts"]
+    if unread.get("emergency"):
+        system_state["status"] = "emergency"
+    elif any(unread.values()):
+        system_state["status"] = "alert"
+    else:
+        system_state["status"] = "normal"
+    facility_rollups.set_alerts(LIVE_PATIENT, unread.get("emergency", 0), system_state["status"])
+
+def valid_alert_ids(ids):
+    """True if ids is left out or is a list of integer alert ids"""
+    return ids is None or (isinstance(ids, list) and
+                           all(isinstance(i, int) and not isinstance(i, bool) for i in ids))
+
+def find_alerts(ids=None, level=None, medication=None, unread_only=True):
+    """Return ids of alerts matching every given filter"""
+    candidates = None
+    if ids is not None:
+        candidates = set(ids) & alert_index["by_id"].keys()
+    if level is not None:
+        ids = alert_index["by_level"].get(level, set())
+        candidates = set(ids) if candidates is None else candidates & ids
+    if medication is not None:
+        ids = alert_index["by_medication"].get(medication, set())
+        candidates = set(ids) if candidates is None else candidates & ids
+    if candidates is None:
+        candidates = alert_index["by_id"].keys()
+    if unread_only:
+        return [i for i in candidates if not alert_index["by_id"][i]["read"]]
+    return list(candidates)
+
+def mark_alerts_read(alert_ids):
+    marked = 0
+    with state_lock:
+        for alert_id in alert_ids:
+            alert = alert_index["by_id"].get(alert_id)
+            if alert is None or alert["read"]:
+                continue
+            alert["read"] = True
+            system_state["unread_alerts"][alert["level"]] -= 1
+            marked += 1
+        update_status()
+        if marked:
+            touch_fragments("alerts")
+    return marked
+
+for existing_alert in system_state["alerts"]:
+    index_alert(existing_alert)
+
+# Alert ids are handed out without state_lock, so emergencies never wait for it
+alert_ids = itertools.count(alert_index["next_id"])
+
+# Per-day, per-medication counts for history that has left memory:
+# {"YYYY-MM-DD": {medication: {"Taken": n, "Missed": n}}}
+history_rollups = history_archive.load_rollups(HISTORY_ARCHIVE_DIR)
+
+def rollup_totals():
+    totals = {"Taken": 0, "Missed": 0}
+    for meds in history_rollups.values():
+        for counts in meds.values():
+            for status, count in counts.items():
+                totals[status] = totals.get(status, 0) + count
+    return totals
+
+archived_totals = rollup_totals()
+
+# Windowed Taken/Missed counts, covering both resident and rolled-up history
+adherence = AdherenceIndex()
+
+def index_history():
+    for day, meds in history_rollups.items():
+        for med, counts in meds.items():
+            for status, count in counts.items():
+                if count:
+                    adherence.add(med, status, day + " 00:00", count)
+    for event in system_state["compliance_history"]:
+        adherence.add(event["medication"], event["status"], event["time"])
+
+def adherence_window(days=None, start=None, end=None, medication=None):
+    """Taken/Missed counts for the last `days` days or between start and end"""
+    now = datetime.now()
+    if days is not None:
+        start, end = now - timedelta(days=days), now
+    return adherence.window(start or datetime(1970, 1, 2), end or now, medication)
+
 def calculate_compliance():
-    total = len(system_state["compliance_history"])
+    total = len(system_state["compliance_history"]) + sum(archived_totals.values())
     if total == 0:
         return 100
     taken = sum(1 for e in system_state["compliance_history"] if e["status"] == "Taken")
+    taken += archived_totals["Taken"]
     return round((taken / total) * 100)
 
+def compact_history(now=None):
+    """Move events older than the retention window out of memory.
+    
+    Expired events are folded into history_rollups. They are already in the
+    history log, which is where queries read them from, so nothing else is
+    written. Returns how many were moved.
+    """
+    now = now or datetime.now()
+    cutoff = (now - timedelta(days=HISTORY_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M")
+    
+    # History is newest first, so expired events are all at the tail
+    expired = []
+    with state_lock:
+        history = system_state["compliance_history"]
+        while history and history[-1]["time"] < cutoff:
+            expired.append(history.pop())
+    if not expired:
+        return 0
+    
+    with state_lock:
+        for event in expired:
+            counts = history_rollups.setdefault(event["time"][:10], {}).setdefault(
+                event["medication"], {"Taken": 0, "Missed": 0})
+            counts[event["status"]] = counts.get(event["status"], 0) + 1
+            archived_totals[event["status"]] = archived_totals.get(event["status"], 0) + 1
+        system_state["compliance_rate"] = calculate_compliance()
+        touch_fragments("history")
+    history_archive.save_rollups(HISTORY_ARCHIVE_DIR, history_rollups)
+    history_archive.save_watermark(HISTORY_ARCHIVE_DIR, cutoff)
+    return len(expired)
+
+def query_history(start=None, end=None, medication=None, limit=None):
+    """The dashboard patient's latest `limit` events between start and end
+    ("YYYY-MM-DD HH:MM"), newest first"""
+    events = deque(history_log.read(start, end, patient=LIVE_PATIENT, medication=medication), maxlen=limit)
+    
+    # Archive segments hold history compacted before the log existed; nothing
+    # writes them any more
+    first = history_log.first_time(LIVE_PATIENT)
+    oldest = first.strftime("%Y-%m-%d %H:%M") if first else None
+    if (limit is None or len(events) < limit) and (oldest is None or not start or start < oldest):
+        archived = deque((e for e in history_archive.read_segments(HISTORY_ARCHIVE_DIR, start, end, medication)
+                          if oldest is None or e["time"] < oldest),
+                         maxlen=None if limit is None else limit - len(events))
+        events.extendleft(reversed(archived))
+    events.reverse()
+    return list(events)
+
+def daily_adherence(start_day=None, end_day=None):
+    """Per-day, per-medication Taken/Missed counts across memory and rollups"""
+    report = {}
+    for day, meds in history_rollups.items():
+        if (start_day and day < start_day) or (end_day and day > end_day):
+            continue
+        for med, counts in meds.items():
+            merged = report.setdefault(day, {}).setdefault(med, {"Taken": 0, "Missed": 0})
+            for status, count in counts.items():
+                merged[status] = merged.get(status, 0) + count
+    for event in system_state["compliance_history"]:
+        day = event["time"][:10]
+        if (start_day and day < start_day) or (end_day and day > end_day):
+            continue
+        counts = report.setdefault(day, {}).setdefault(event["medication"], {"Taken": 0, "Missed": 0})
+        counts[event["status"]] = counts.get(event["status"], 0) + 1
+    return dict(sorted(report.items()))
+
+def due_medications(now=None):
+    """Every medication with a dose due in the current minute"""
+    now = now or datetime.now()
+    return [med for med, rule in schedule_index.items() if rule.occurs_at(now)]
+
 def get_current_medication():
-    now = datetime.now().strftime("%H:%M")
-    for med, details in MEDICATION_DB.items():
-        if now in details["schedule"]:
-            return med
-    return None
+    due = due_medications()
+    return due[0] if due else None
 
-def verify_pill(camera_input, expected_med):
-    expected = MEDICATION_DB[expected_med]
+def verify_pill(camera_input, expected_med, meds=None):
+    expected = (meds or MEDICATION_DB)[expected_med]
     if random.random() > 0.15:
         return camera_input == expected
     return False
 
-def send_alert(level, medication, emergency=False):
-    if emergency:
-        message = "EMERGENCY: Help button pressed! Medical assistance requested!"
-    else:
-        alert_types = {
-            "family": f"Missed dose of {medication}",
-            "caregiver": f"URGENT: 3 consecutive misses of {medication}",
-            "emergency": f"EMERGENCY: Critical medication {medication} missed!"
-        }
-        message = alert_types[level]
+def send_alert(level, medication, emergency=False, raised_at=None):
+    return send_alerts([(level, medication, emergency)], raised_at)[0]
+
+def send_alerts(requests, raised_at=None):
+    """Raise a batch of (level, medication, emergency) alerts.
     
-    alert = {
-        "level": level,
-        "message": message,
-        "medication": medication if not emergency else "Emergency",
-        "time": datetime.now().strftime("%H:%M:%S"),
-        "read": False
+    Emergency-level alerts are handed to the notifier's emergency lane
+    before anything waits on state_lock. The batch is then recorded under
+    one lock and one fragment update, and the rest queued for delivery.
+    raised_at (time.perf_counter()) is when the alerts were triggered.
+    """
+    raised_at = raised_at or time.perf_counter()
+    alert_types = {
+        "family": "Missed dose of {}",
+        "caregiver": "URGENT: 3 consecutive misses of {}",
+        "emergency": "EMERGENCY: Critical medication {} missed!"
     }
+    alerts = []
+    for item in requests:
+        # An optional fourth element replaces the standard message
+        level, medication, emergency = item[:3]
+        if len(item) > 3:
+            message = item[3]
+        elif emergency:
+            message = "EMERGENCY: Help button pressed! Medical assistance requested!"
+        else:
+            message = alert_types[level].format(medication)
+        alerts.append({
+            "id": next(alert_ids),
+            "level": level,
+            "message": message,
+            "medication": medication if not emergency else "Emergency",
+            "time": datetime.now().strftime("%H:%M:%S"),
+            "read": False
+        })
+    for alert in alerts:
+        if alert["level"] == "emergency":
+            notifier.notify(alert, raised_at)
     
-    system_state["alerts"].insert(0, alert)
-    system_state["status"] = "alert" if level != "emergency" else "emergency"
+    if alerts:
+        with state_lock:
+            for alert in alerts:
+                system_state["alerts"].insert(0, alert)
+                index_alert(alert)
+            update_status()
+            touch_fragments("alerts")
+    for alert in alerts:
+        if alert["level"] != "emergency":
+            notifier.notify(alert, raised_at)
+    return alerts
 
-def medication_check():
-    current_med = get_current_medication()
-    if not current_med:
-        return
-        
-    med_details = MEDICATION_DB[current_med]
-    system_state["current_med"] = current_med
-    
+def scan_pill(expected_med, meds):
+    """Simulated camera reading for the pill presented for expected_med"""
     if random.random() < 0.7:
-        user_pill = med_details
-    else:
-        other_med = random.choice([m for m in MEDICATION_DB.keys() if m != current_med])
-        user_pill = MEDICATION_DB[other_med]
+        return meds[expected_med]
+    others = [m for m in meds if m != expected_med]
+    return meds[random.choice(others)] if others else meds[expected_med]
+
+def alert_level(details):
+    if details["critical"]:
+        return "emergency"
+    if system_state["missed_count"] >= 3:
+        return "caregiver"
+    return "family"
+
+def medication_check(now=None):
+    """Check every medication due in this slot as one batch.
     
-    if verify_pill(user_pill, current_med):
-        result = "Taken"
-        system_state["missed_count"] = 0
-    else:
-        result = "Missed"
-        system_state["missed_count"] += 1
-        
-        if med_details["critical"]:
-            send_alert("emergency", current_med)
-        elif system_state["missed_count"] >= 3:
-            send_alert("caregiver", current_med)
+    All pills are verified first; then the results are applied under one
+    lock, appended to the history log in one write, and raised as one batch
+    of alerts. Returns the recorded events.
+    """
+    now = now or datetime.now()
+    due = due_medications(now)
+    # Slots a device already reported a scan for are not checked again
+    claims = scan_slots.claim_many(schedule_index, [(LIVE_PATIENT, med, now) for med in due], now)
+    due = [med for med, (_, outcome) in zip(due, claims) if outcome != "duplicate"]
+    if not due:
+        # Nothing left to check this minute (or a device already recorded it),
+        # so the next dose is up
+        with state_lock:
+            schedule_next_dose()
+        return []
+    meds = MEDICATION_DB
+    
+    checks = []
+    for med in due:
+        scanned = scan_pill(med, meds)
+        checks.append((med, scanned, verify_pill(scanned, med, meds)))
+    
+    # Critical misses go out before the batch waits on the lock or the log
+    send_alerts([("emergency", med, False) for med, _, taken in checks
+                 if not taken and meds[med]["critical"]])
+    
+    stamp = now.strftime("%Y-%m-%d %H:%M")
+    events = []
+    alerts = []
+    with state_lock:
+        system_state["current_med"] = due[0]
+        for med, scanned, taken in checks:
+            details = meds[med]
+            if taken:
+                result = "Taken"
+                system_state["missed_count"] = 0
+            else:
+                result = "Missed"
+                system_state["missed_count"] += 1
+                if not details["critical"]:
+                    alerts.append((alert_level(details), med, False))
+            events.append({
+                "medication": med,
+                "time": stamp,
+                "status": result,
+                "details": f"Expected: {details['shape']} {details['color']}, Scanned: {scanned['shape']} {scanned['color']}"
+            })
+            adherence.add(med, result, now)
+        system_state["compliance_history"][:0] = reversed(events)
+        facility_rollups.record_doses(LIVE_PATIENT, [e["status"] for e in events], now)
+    risk_model.record([(LIVE_PATIENT, e["medication"], now, e["status"] == "Missed") for e in events])
+    
+    history_log.append_many(events)
+    send_alerts(alerts)
+    with state_lock:
+        system_state["last_check"] = datetime.now()
+        system_state["compliance_rate"] = calculate_compliance()
+        schedule_next_dose()
+        touch_fragments("history")
+    return events
+
+def catch_up(since, until=None):
+    """Record every dose slot after `since` and before the current minute as Missed.
+    
+    Used after downtime or a stalled scheduler, when nobody was there to
+    check those doses. All slots are found from the schedule index and
+    written as one batch, and each medication gets a single alert for all
+    of its missed doses. Returns the recorded events.
+    """
+    until = (until or datetime.now()).replace(second=0, microsecond=0)
+    if since is None or since >= until:
+        return []
+    meds = MEDICATION_DB
+    slots = list(recurrence.upcoming(schedule_index, since, until - timedelta(seconds=1)))
+    claims = scan_slots.claim_many(schedule_index, [(LIVE_PATIENT, med, when) for when, med in slots], until)
+    events = []
+    doses = []
+    missed = {}
+    for (when, med), (_, outcome) in zip(slots, claims):
+        if outcome == "duplicate":
+            # A device reported this dose while checks were not running
+            continue
+        doses.append((LIVE_PATIENT, med, when, True))
+        details = meds[med]
+        events.append({
+            "medication": med,
+            "time": when.strftime("%Y-%m-%d %H:%M"),
+            "status": "Missed",
+            "details": f"Expected: {details['shape']} {details['color']}, Scanned: None"
+        })
+        missed[med] = missed.get(med, 0) + 1
+    if not events:
+        return []
+    
+    prefixes = {"family": "", "caregiver": "URGENT: ", "emergency": "EMERGENCY: "}
+    alerts = []
+    with state_lock:
+        for event in events:
+            adherence.add(event["medication"], "Missed", event["time"])
+        system_state["compliance_history"][:0] = reversed(events)
+        system_state["missed_count"] += len(events)
+        facility_rollups.record_doses(LIVE_PATIENT, ["Missed"] * len(events),
+                                      datetime.strptime(events[-1]["time"], "%Y-%m-%d %H:%M"))
+        # One escalation decision per medication instead of one alert per slot
+        for med, count in missed.items():
+            level = alert_level(meds[med])
+            if count >= 3 and level == "family":
+                level = "caregiver"
+            message = f"{prefixes[level]}Missed {count} dose{'s' if count > 1 else ''} of {med} while checks were not running"
+            alerts.append((level, med, False, message))
+    risk_model.record(doses)
+    
+    history_log.append_many(events)
+    send_alerts(alerts)
+    with state_lock:
+        system_state["compliance_rate"] = calculate_compliance()
+        # From the minute before `until`, so the current minute is still checked
+        schedule_next_dose(until - timedelta(minutes=1))
+        touch_fragments("history")
+    return events
+
+def match_scans(scans, claims, meds):
+    """Outcome per scan, and the doses to record per patient as (slot, event)"""
+    outcomes = []
+    by_patient = {}
+    for scan, (slot, outcome) in zip(scans, claims):
+        details = meds.get(scan["medication"])
+        if outcome != "matched" or details is None:
+            outcomes.append(outcome if details else "unmatched")
+            continue
+        expected = f"{details['shape']} {details['color']}"
+        if scan["shape"] or scan["color"]:
+            seen = f"{scan['shape']} {scan['color']}"
+            taken = (scan["shape"] == details["shape"] and scan["color"] == details["color"]
+                     and (not scan["imprint"] or scan["imprint"] == details.get("imprint")))
         else:
-            send_alert("family", current_med)
+            seen, taken = f"dispensed by {scan['device'] or 'device'}", True
+        status = "Taken" if taken else "Missed"
+        by_patient.setdefault(scan["patient"], []).append((slot, {
+            "medication": scan["medication"],
+            "time": slot.strftime("%Y-%m-%d %H:%M"),
+            "status": status,
+            "details": f"Expected: {expected}, Scanned: {seen}"
+        }))
+        outcomes.append(status.lower())
+    return outcomes, by_patient
+
+def record_scans(scans):
+    """Match ingested device scans to dose slots and record the doses.
     
-    event = {
-        "medication": current_med,
-        "time": datetime.now().strftime("%Y-%m-%d %H:%M"),
-        "status": result,
-        "details": f"Expected: {med_details['shape']} {med_details['color']}, Scanned: {user_pill['shape']} {user_pill['color']}"
-    }
+    Runs on the ingestion writer for a whole group of batches. A scan
+    resolves its slot as Taken when the pill seen matches the catalog entry,
+    or when a dispenser reports the compartment without a reading. Doses of
+    the dashboard's patient update its state and raise alerts like a
+    scheduler check; other patients' doses go to the log and their facility
+    rows. Returns an outcome per scan (see ingest.summarize).
+    """
+    meds = MEDICATION_DB
+    claims = scan_slots.claim_many(schedule_index,
+                                   [(s["patient"], s["medication"], s["time"]) for s in scans])
+    try:
+        outcomes, by_patient = match_scans(scans, claims, meds)
+        if by_patient:
+            with history_log.lock:
+                history_log.append_records([history_log.pack(event, patient)
+                                            for patient, doses in by_patient.items()
+                                            for _, event in doses])
+    except Exception:
+        # Nothing was logged, so a retried batch may claim these slots again.
+        # Once the doses are in the log the claims stay, even if the sync
+        # fails, so the retry comes back as duplicates.
+        scan_slots.release([(scan["patient"], scan["medication"], slot)
+                            for scan, (slot, outcome) in zip(scans, claims) if outcome == "matched"])
+        raise
+    if not by_patient:
+        return outcomes
     
-    system_state["compliance_history"].insert(0, event)
-    system_state["last_check"] = datetime.now()
-    system_state["compliance_rate"] = calculate_compliance()
-    schedule_next_dose()
+    for patient, doses in by_patient.items():
+        doses.sort(key=lambda dose: dose[0])
+        if patient != LIVE_PATIENT:
+            facility_rollups.record_doses(patient, [e["status"] for _, e in doses], doses[-1][0])
+    risk_model.record([(patient, event["medication"], slot, event["status"] == "Missed")
+                       for patient, doses in by_patient.items() for slot, event in doses])
+    
+    live = by_patient.get(LIVE_PATIENT)
+    if live:
+        send_alerts([("emergency", e["medication"], False) for _, e in live
+                     if e["status"] == "Missed" and meds[e["medication"]]["critical"]])
+        alerts = []
+        with state_lock:
+            for slot, event in live:
+                if event["status"] == "Taken":
+                    system_state["missed_count"] = 0
+                else:
+                    system_state["missed_count"] += 1
+                    if not meds[event["medication"]]["critical"]:
+                        alerts.append((alert_level(meds[event["medication"]]), event["medication"], False))
+                adherence.add(event["medication"], event["status"], slot)
+            system_state["compliance_history"][:0] = reversed([e for _, e in live])
+            facility_rollups.record_doses(LIVE_PATIENT, [e["status"] for _, e in live], live[-1][0])
+        send_alerts(alerts)
+        with state_lock:
+            system_state["compliance_rate"] = calculate_compliance()
+            schedule_next_dose()
+            touch_fragments("history")
+    return outcomes
 
-def schedule_next_dose():
-    now = datetime.now()
-    next_time = None
+# Writes device scans in groups, one log sync per group, before acknowledging them
+scan_ingestor = ingest.ScanIngestor(record_scans, lambda: history_log.sync())
+
+def submit_scans(body, content_type=''):
+    """Parse and queue a scan batch; returns a Future for its outcomes.
     
-    for med, details in MEDICATION_DB.items():
-        for time_str in details["schedule"]:
-            med_time = datetime.strptime(time_str, "%H:%M").replace(
-                year=now.year, month=now.month, day=now.day)
-            if med_time > now and (next_time is None or med_time < next_time):
-                next_time = med_time
+    Raises ingest.IngestError with the HTTP status to answer with.
+    """
+    return scan_ingestor.submit(ingest.parse_batch(body, content_type))
+
+def refresh_risk(now=None):
+    """Rescore upcoming doses and copy each rescored patient's riskiest dose to /facility"""
+    changed = risk_model.refresh(schedule_index, now or datetime.now())
+    for patient, peak in risk_model.peaks(changed).items():
+        facility_rollups.set_miss_risk(patient, *peak)
+    if LIVE_PATIENT in changed:
+        with state_lock:
+            touch_fragments("schedule")
+    return changed
+
+def send_reminders(now=None):
+    """Remind about high-risk doses due soon, riskiest first.
+    
+    The dashboard's patient's contacts are notified; every reminder is kept
+    in reminder_log for /risk.
+    """
+    now = now or datetime.now()
+    due = risk_model.due_reminders(now, timedelta(minutes=REMINDER_LEAD_MINUTES), REMINDER_RISK)
+    for probability, patient, when, medication in due:
+        reminder = {
+            "patient": patient,
+            "medication": medication,
+            "due": when.strftime("%Y-%m-%d %H:%M"),
+            "miss_risk": round(probability, 3),
+            "time": now.strftime("%H:%M:%S")
+        }
+        reminder_log.appendleft(reminder)
+        if patient == LIVE_PATIENT:
+            notifier.notify({
+                "id": None,
+                "level": "family",
+                "message": f"Reminder: {medication} is due at {when.strftime('%H:%M')} "
+                           f"(miss risk {probability:.0%})",
+                "medication": medication,
+                "time": reminder["time"],
+                "read": False
+            })
+    return due
+
+def schedule_next_dose(after=None):
+    # Caller holds state_lock
+    upcoming = recurrence.next_occurrence(schedule_index, after or datetime.now())
+    if upcoming:
+        if upcoming[0] != system_state["next_dose_time"]:
+            system_state["next_dose_time"] = upcoming[0]
+            # A state change like any other, so /data and /fragments see it
+            touch_fragments("schedule")
+        facility_rollups.set_next_dose(LIVE_PATIENT, *upcoming)
+
+# Fields a medication entry may carry, with defaults for new entries
+MEDICATION_FIELDS = {
+    "dose": None,
+    "schedule": None,
+    "critical": False,
+    "icon": "💊",
+    "shape": "round",
+    "color": "white",
+    "imprint": "",
+    "recurrence": None
+}
+
+def parse_schedule(schedule):
+    if isinstance(schedule, str):
+        schedule = schedule.split(',')
+    return [t.strip() for t in schedule if t.strip()]
+
+def validate_medication(details):
+    if not details.get("dose"):
+        return "dose is required"
+    if not details.get("schedule") and not details.get("recurrence"):
+        return "at least one schedule time is required"
+    try:
+        recurrence.compile_rule(details)
+    except ValueError as e:
+        return str(e)
+    return None
+
+def apply_operation(meds, operation):
+    """Apply one add/update/delete operation to meds, returning an error or None"""
+    op = operation.get("op")
+    name = operation.get("name")
+    if not name or not isinstance(name, str):
+        return "name is required"
+    
+    if op == "delete":
+        if name not in meds:
+            return f"unknown medication {name}"
+        del meds[name]
+        return None
+    
+    if op == "add":
+        details = {field: operation.get(field, default)
+                   for field, default in MEDICATION_FIELDS.items()}
+    elif op == "update":
+        if name not in meds:
+            return f"unknown medication {name}"
+        details = dict(meds[name])
+        details.update({field: operation[field]
+                        for field in MEDICATION_FIELDS if field in operation})
+    else:
+        return f"unknown op {op!r}, expected add, update or delete"
     
-    if next_time:
-        system_state["next_dose_time"] = next_time
+    details["schedule"] = parse_schedule(details["schedule"] or [])
+    if not details.get("recurrence"):
+        details.pop("recurrence", None)
+    error = validate_medication(details)
+    if error:
+        return error
+    meds[name] = details
+    return None
+
+def apply_medication_batch(operations):
+    """Validate and apply a list of operations all-or-nothing.
+    
+    The catalog is written to disk and the next dose rescheduled once for
+    the whole batch. Returns (success, per-operation results).
+    """
+    global MEDICATION_DB, schedule_index
+    results = []
+    with state_lock:
+        staged = dict(MEDICATION_DB)
+        for i, operation in enumerate(operations):
+            error = apply_operation(staged, operation)
+            results.append({
+                "index": i,
+                "op": operation.get("op"),
+                "name": operation.get("name"),
+                "success": error is None,
+                "error": error
+            })
+        if not all(r["success"] for r in results):
+            return False, results
+        
+        index = recurrence.compile_all(staged)
+        # Saved before it goes live, so a failed write (OSError) leaves both the
+        # file and memory on the old catalog
+        save_medications(staged)
+        # Rebind rather than mutate so readers iterating the old catalog are unaffected
+        MEDICATION_DB, schedule_index = staged, index
+        schedule_next_dose()
+        touch_fragments("medications", "schedule")
+    return True, results
+
+scheduler_status = {
+    "last_compaction": datetime.now().date(),
+    "last_tick": None,
+    "error": None
+}
+
+def scheduler_tick(now):
+    """One pass of the scheduler loop; returns True if a dose was checked"""
+    reload_medications_if_changed()
+    last_tick = scheduler_status["last_tick"]
+    scheduler_status["last_tick"] = now
+    if last_tick and (now - last_tick).total_seconds() > SCHEDULER_STALL_SECONDS:
+        catch_up(last_tick, now)
+    checked = False
+    if now >= system_state["next_dose_time"]:
+        medication_check(now)
+        checked = True
+    refresh_risk(now)
+    send_reminders(now)
+    if now.date() != scheduler_status["last_compaction"]:
+        compact_history(now)
+        scheduler_status["last_compaction"] = now.date()
+    return checked
+
+def run_scheduler_tick(now):
+    """scheduler_tick for the scheduler loops: an error is reported and the
+    loop carries on, so one bad tick doesn't stop every later dose check"""
+    try:
+        return scheduler_tick(now)
+    except Exception as e:
+        scheduler_status["error"] = f"{now.strftime('%Y-%m-%d %H:%M')}: {e!r}"
+        traceback.print_exc()
+        return False
+
+def reload_medications_if_changed():
+    """Re-read medications.json if it changed on disk since it was last loaded.
+    
+    The new catalog and its schedule index are swapped in together. If the
+    file does not parse or validate, the last good catalog stays in use and
+    the error is reported in system_state["catalog_error"].
+    """
+    global MEDICATION_DB, schedule_index
+    now = time.monotonic()
+    if now - catalog_status["last_check"] < CATALOG_CHECK_INTERVAL:
+        return False
+    catalog_status["last_check"] = now
+    signature = file_signature(MEDICATION_DB_FILE)
+    if signature is None or signature == catalog_status["signature"]:
+        return False
+    
+    with state_lock:
+        if signature == catalog_status["signature"]:
+            return False
+        # Remember the signature either way so a broken file is parsed only once
+        catalog_status["signature"] = signature
+        try:
+            with open(MEDICATION_DB_FILE, 'r') as f:
+                meds = json.load(f)
+            if not isinstance(meds, dict):
+                raise ValueError("expected an object of medications")
+            for name, details in meds.items():
+                error = validate_medication(details) if isinstance(details, dict) else "not an object"
+                if error:
+                    raise ValueError(f"{name}: {error}")
+                # Fields left out of the file take the same defaults as added entries
+                meds[name] = {**MEDICATION_FIELDS, **details}
+            index = recurrence.compile_all(meds)
+        except (OSError, ValueError) as e:
+            catalog_status["error"] = system_state["catalog_error"] = f"{MEDICATION_DB_FILE}: {e}"
+            touch_fragments("medications")
+            return False
+        
+        MEDICATION_DB, schedule_index = meds, index
+        catalog_status["error"] = system_state["catalog_error"] = None
+        schedule_next_dose()
+        touch_fragments("medications", "schedule")
+    return True
 
 def background_scheduler():
     while True:
-        now = datetime.now()
-        if now >= system_state["next_dose_time"]:
-            medication_check()
+        if run_scheduler_tick(datetime.now()):
             time.sleep(10)
         time.sleep(5)
 
-# Start background thread
+# Start background thread, unless the asyncio server (asgi.py) schedules doses
 scheduler_thread = threading.Thread(target=background_scheduler)
 scheduler_thread.daemon = True
-scheduler_thread.start()
+if os.environ.get('MEDIGUARDIAN_SCHEDULER', 'thread') == 'thread':
+    scheduler_thread.start()
+
+def todays_doses():
+    """(time, medication) for every dose due today, in time order"""
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return list(recurrence.upcoming(schedule_index,
+                                    midnight - timedelta(seconds=1),
+                                    midnight + timedelta(days=1) - timedelta(seconds=1)))
+
+def describe_schedule(name):
+    rule = schedule_index.get(name)
+    return rule.describe() if rule else ""
+
+def dashboard_context():
+    return dict(state=system_state,
+                meds=MEDICATION_DB,
+                todays_doses=todays_doses(),
+                describe_schedule=describe_schedule,
+                dose_risk=risk_model.slot_risks(LIVE_PATIENT),
+                risk_level=risk.risk_level,
+                missed_last_week=adherence_window(days=7)["Missed"],
+                fragment_versions=dict(fragment_versions),
+                contacts=notifier.contacts,
+                now=datetime.now())
+
+# Each fragment gets only what its template uses, so polling one fragment
+# doesn't compute the rest of the dashboard
+FRAGMENT_CONTEXTS = {
+    "alerts": lambda: dict(state=system_state),
+    "history": lambda: dict(state=system_state),
+    "medications": lambda: dict(state=system_state,
+                                meds=MEDICATION_DB,
+                                describe_schedule=describe_schedule),
+    "schedule": lambda: dict(meds=MEDICATION_DB,
+                             todays_doses=todays_doses(),
+                             dose_risk=risk_model.slot_risks(LIVE_PATIENT),
+                             risk_level=risk.risk_level)
+}
+
+def fragment_context(name):
+    return FRAGMENT_CONTEXTS[name]()
+
+@app.before_request
+def refresh_catalog():
+    reload_medications_if_changed()
 
 @app.route('/')
 def dashboard():
-    return render_template('dashboard.html', 
-                           state=system_state, 
-                           meds=MEDICATION_DB,
-                           now=datetime.now())
+    return render_template('dashboard.html', **dashboard_context())
+
+@app.route('/fragments')
+def fragment_state():
+    return jsonify(versions=fragment_versions,
+                   status=system_state["status"],
+                   next_dose_time=system_state["next_dose_time"].strftime('%Y-%m-%dT%H:%M:%S'))
+
+@app.route('/fragments/<name>')
+def fragment(name):
+    if name not in fragment_versions:
+        abort(404)
+    return render_template(f'fragments/{name}.html', **fragment_context(name))
+
+def history_page(page):
+    """Template context for one page of the dashboard patient's history, newest first"""
+    total = history_log.patient_count(LIVE_PATIENT)
+    pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+    page = min(max(page, 1), pages)
+    return {
+        "history": history_log.latest((page - 1) * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE, LIVE_PATIENT),
+        "total": total,
+        "page": page,
+        "pages": pages,
+        "state": system_state
+    }
+
+HISTORY_RANGE_ERROR = "dates must be YYYY-MM-DD or YYYY-MM-DD HH:MM"
+
+def history_range(start, end):
+    """Normalize "YYYY-MM-DD" bounds to whole days; raises ValueError if malformed"""
+    if start and len(start) == 10:
+        start += " 00:00"
+    if end and len(end) == 10:
+        end += " 23:59"
+    for value in (start, end):
+        if value:
+            datetime.strptime(value, "%Y-%m-%d %H:%M")
+    return start, end
+
+def export_rows(start=None, end=None, medication=None):
+    """CSV lines for the dashboard patient's logged events in a range, oldest first"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["time", "medication", "status", "details"])
+    for event in history_log.read(start, end, patient=LIVE_PATIENT, medication=medication):
+        writer.writerow([event["time"], event["medication"], event["status"], event["details"]])
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
 @app.route('/history')
 def history():
-    return render_template('history.html', 
-                           history=system_state["compliance_history"],
-                           state=system_state)
+    return render_template('history.html', **history_page(request.args.get('page', 1, type=int)))
+
+@app.route('/history/export')
+def history_export():
+    # Streams CSV straight from the log; start/end as in /history/archive
+    try:
+        start, end = history_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        return jsonify(success=False, error=HISTORY_RANGE_ERROR), 400
+    return Response(export_rows(start, end, request.args.get('medication')),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=mediguardian-history.csv'})
+
+def archive_query(args):
+    """/history/archive for query args: start/end as "YYYY-MM-DD" or
+    "YYYY-MM-DD HH:MM", the latest `limit` events in range. Raises ValueError
+    for malformed dates."""
+    start, end = history_range(args.get('start'), args.get('end'))
+    try:
+        limit = int(args.get('limit') or HISTORY_QUERY_LIMIT)
+    except ValueError:
+        limit = HISTORY_QUERY_LIMIT
+    limit = min(max(limit, 1), HISTORY_QUERY_LIMIT)
+    events = query_history(start, end, args.get('medication'), limit)
+    return {"events": events, "count": len(events), "limit": limit}
+
+def window_query(args):
+    """/history/window for query args: ?days=7, ?period=month, or
+    ?start=...&end=... ("YYYY-MM-DD" or "YYYY-MM-DD HH:MM"). Raises ValueError
+    for malformed dates."""
+    medication = args.get('medication')
+    now = datetime.now()
+    if args.get('period') == 'month':
+        start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return adherence_window(start=start, end=now, medication=medication)
+    if args.get('days'):
+        return adherence_window(days=float(args['days']), medication=medication)
+    
+    def parse(value, end_of_day=False):
+        if len(value) == 10:
+            day = datetime.strptime(value, "%Y-%m-%d")
+            return day.replace(hour=23, minute=59) if end_of_day else day
+        return datetime.strptime(value, "%Y-%m-%d %H:%M")
+    start = parse(args['start']) if args.get('start') else None
+    end = parse(args['end'], end_of_day=True) if args.get('end') else now
+    return adherence_window(start=start, end=end, medication=medication)
+
+def adherence_query(args):
+    """/history/adherence for query args"""
+    return {"days": daily_adherence(args.get('start'), args.get('end')),
+            "compliance_rate": system_state["compliance_rate"]}
+
+def history_query(query, args):
+    """(payload, status) for one of the history queries above"""
+    try:
+        return query(args), 200
+    except ValueError:
+        return {"success": False, "error": HISTORY_RANGE_ERROR}, 400
+
+@app.route('/history/archive')
+def history_archive_query():
+    return respond_json(*history_query(archive_query, request.args))
+
+@app.route('/history/window')
+def history_window():
+    return respond_json(*history_query(window_query, request.args))
+
+@app.route('/history/adherence')
+def history_adherence():
+    return jsonify(adherence_query(request.args))
+
+def facility_overview(sort=None, risk=None, limit=None):
+    """Sorted, filtered facility rows plus the count of patients at each risk level"""
+    if risk not in facility.RISK_ORDER:
+        risk = None
+    rows, counts = facility_rollups.overview(sort or "risk", risk, limit,
+                                             recurrence.next_occurrence(schedule_index, datetime.now()))
+    return {"patients": rows, "risk_counts": counts, "sort": sort or "risk", "risk": risk}
+
+@app.route('/facility')
+def facility_page():
+    overview = facility_overview(request.args.get('sort'), request.args.get('risk'),
+                                 request.args.get('limit', FACILITY_PAGE_LIMIT, type=int))
+    return render_template('facility.html', **overview)
+
+@app.route('/facility/data')
+def facility_data():
+    # ?sort=risk|miss_risk|compliance|name|patient&risk=high|medium|low&limit=N
+    return jsonify(facility_overview(request.args.get('sort'), request.args.get('risk'),
+                                     request.args.get('limit', type=int)))
+
+def risk_overview(patient=None, limit=None):
+    """Riskiest doses in the next 24 hours, most likely to be missed first"""
+    slots = [{"patient": p, "medication": med, "due": when.strftime("%Y-%m-%d %H:%M"),
+              "miss_risk": round(probability, 3), "level": risk.risk_level(probability)}
+             for probability, p, when, med in risk_model.riskiest(limit or FACILITY_PAGE_LIMIT, patient)]
+    return {"slots": slots, "reminders": list(reminder_log)}
+
+@app.route('/risk')
+def risk_data():
+    # ?patient=N&limit=N
+    return jsonify(risk_overview(request.args.get('patient', type=int),
+                                 request.args.get('limit', type=int)))
+
+# JSON endpoints shared by the Flask routes and asgi.py: each takes the
+# decoded body (any JSON value) and returns (payload, status)
+
+def json_object(data):
+    return data if isinstance(data, dict) else {}
+
+def add_medication_request(data):
+    success, results = apply_medication_batch([dict(json_object(data), op="add")])
+    if not success:
+        return {"success": False, "error": results[0]["error"]}, 400
+    return {"success": True}, 200
+
+def delete_medication_request(data):
+    name = json_object(data).get('name')
+    if isinstance(name, str) and name in MEDICATION_DB:
+        apply_medication_batch([{"op": "delete", "name": name}])
+    return {"success": True}, 200
+
+def medications_batch_request(data):
+    # Body: {"operations": [{"op": "add" | "update" | "delete", "name": ..., ...}]}
+    operations = json_object(data).get('operations')
+    if not isinstance(operations, list) or not operations:
+        return {"success": False, "error": "operations must be a non-empty list"}, 400
+    if not all(isinstance(op, dict) for op in operations):
+        return {"success": False, "error": "each operation must be an object"}, 400
+    success, results = apply_medication_batch(operations)
+    return {"success": success, "results": results}, (200 if success else 400)
+
+def mark_alerts_request(data):
+    # Filter by any of ids, level and medication; no filter marks everything
+    data = json_object(data)
+    if not valid_alert_ids(data.get('ids')):
+        return {"success": False, "error": "ids must be a list of integers"}, 400
+    marked = mark_alerts_read(find_alerts(ids=data.get('ids'),
+                                          level=data.get('level'),
+                                          medication=data.get('medication')))
+    return {"success": True,
+            "marked": marked,
+            "unread": system_state["unread_alerts"],
+            "status": system_state["status"]}, 200
+
+def respond_json(payload, status):
+    return jsonify(payload), status
 
 @app.route('/add_medication', methods=['POST'])
 def add_medication():
-    # Get form data
-    data = request.get_json()
-    name = data.get('name')
-    dose = data.get('dose')
-    schedule = [t.strip() for t in data.get('schedule').split(',')]
-    critical = data.get('critical', False)
-    icon = data.get('icon', '💊')
-    
-    # Add to database
-    MEDICATION_DB[name] = {
-        "dose": dose,
-        "schedule": schedule,
-        "critical": critical,
-        "icon": icon,
-        "shape": data.get('shape', 'round'),
-        "color": data.get('color', 'white'),
-        "imprint": data.get('imprint', '')
-    }
-    
-    # Save to file
-    save_medications(MEDICATION_DB)
-    
-    # Recalculate next dose
-    schedule_next_dose()
-    
-    return jsonify(success=True)
+    return respond_json(*add_medication_request(request.get_json(silent=True)))
 
 @app.route('/delete_medication', methods=['POST'])
 def delete_medication():
-    data = request.get_json()
-    name = data.get('name')
-    if name in MEDICATION_DB:
-        del MEDICATION_DB[name]
-        save_medications(MEDICATION_DB)
-        schedule_next_dose()
-    return jsonify(success=True)
+    return respond_json(*delete_medication_request(request.get_json(silent=True)))
 
-@app.route('/data')
-def data():
-    return jsonify({
+@app.route('/medications/batch', methods=['POST'])
+def medications_batch():
+    return respond_json(*medications_batch_request(request.get_json(silent=True)))
+
+def data_payload():
+    return {
         "state": system_state,
         "meds": MEDICATION_DB
-    })
-
-@app.route('/mark_alert_read/<int:index>')
-def mark_alert_read(index):
-    if index < len(system_state["alerts"]):
-        system_state["alerts"][index]["read"] = True
-        if all(alert["read"] for alert in system_state["alerts"]):
-            system_state["status"] = "normal"
+    }
+
+# /data is polled by every open client; it is serialized once per state version
+data_cache = ResponseCache(data_payload, app.json.dumps, app.json.default, state_lock)
+
+@app.route('/data')
+def data():
+    status, body, headers = data_cache.respond(state_version(),
+                                               request.headers.get('Accept-Encoding', ''),
+                                               request.headers.get('If-None-Match', ''))
+    return Response(body, status=status, headers=headers, mimetype='application/json')
+
+@app.route('/mark_alert_read/<int:alert_id>')
+def mark_alert_read(alert_id):
+    mark_alerts_read([alert_id])
     return jsonify(success=True)
 
+@app.route('/mark_alerts_read', methods=['POST'])
+def mark_alerts_read_bulk():
+    return respond_json(*mark_alerts_request(request.get_json(silent=True)))
+
+@app.route('/notifications')
+def notification_log():
+    return jsonify(deliveries=list(notifier.log),
+                   emergency_latency=notifier.latency_summary(),
+                   invalid_contacts=notifier.invalid_contacts)
+
+@app.route('/scans', methods=['POST'])
+def scans():
+    # NDJSON or binary scan batch from a device; see ingest.py for the formats
+    try:
+        future = submit_scans(request.get_data(), request.content_type or '')
+        outcomes = future.result(timeout=SCAN_ACK_TIMEOUT)
+    except ingest.IngestError as e:
+        headers = {'Retry-After': '1'} if e.status in (429, 503) else {}
+        return jsonify(success=False, error=str(e)), e.status, headers
+    except Exception as e:
+        # A retry is safe: slots are released when nothing was logged, and
+        # doses already logged come back as duplicates
+        return jsonify(success=False, error=f"scans not written: {e!r}"), 503, {'Retry-After': '1'}
+    return jsonify(success=True, **ingest.summarize(outcomes))
+
+@app.route('/scans/stats')
+def scan_stats():
+    return jsonify(dict(scan_ingestor.stats, pending=scan_ingestor.pending))
+
 @app.route('/trigger_emergency', methods=['POST'])
 def trigger_emergency():
-    send_alert("emergency", "", emergency=True)
+    send_alert("emergency", "", emergency=True, raised_at=time.perf_counter())
     return jsonify(success=True)
 
 # Dashboard Template
@@ -382,6 +1338,9 @@ dashboard_html = '''
         .badge-taken { background-color: #28a745; }
         .badge-missed { background-color: #dc3545; }
         .badge-pending { background-color: #6c757d; }
+        .risk-high { background-color: #dc3545; }
+        .risk-medium { background-color: #ffc107; color: #212529; }
+        .risk-low { background-color: #28a745; }
         .modal-content {
             border-radius: 15px;
         }
@@ -414,7 +1373,10 @@ dashboard_html = '''
         <div class="d-flex justify-content-between align-items-center mb-4">
             <h1 class="display-4"><i class="fas fa-heartbeat"></i> MediGuardian</h1>
             <div class="status-indicator">
-                <span class="badge bg-{% if state.status == 'normal' %}teal{% elif state.status == 'alert' %}warning{% else %}danger{% endif %} p-2">
+                <a href="/facility" class="btn btn-outline-secondary btn-sm me-2">
+                    <i class="fas fa-hospital"></i> Facility
+                </a>
+                <span id="statusBadge" class="badge bg-{% if state.status == 'normal' %}teal{% elif state.status == 'alert' %}warning{% else %}danger{% endif %} p-2">
                     Status: <span class="text-uppercase">{{ state.status }}</span>
                 </span>
             </div>
@@ -433,7 +1395,7 @@ dashboard_html = '''
                                     <h3 class="mt-2">{{ meds[state.current_med]['icon'] }} {{ state.current_med }}</h3>
                                     <p>{{ meds[state.current_med]['dose'] }}</p>
                                 {% endif %}
-                                <h2>{{ state.next_dose_time.strftime('%H:%M') }}</h2>
+                                <h2 id="nextDoseClock">{{ state.next_dose_time.strftime('%H:%M') }}</h2>
                                 <div class="text-center mt-2">
                                     <p class="mb-1">Time remaining: 
                                         <span id="countdown">4h 46m</span>
@@ -462,40 +1424,8 @@ dashboard_html = '''
                 
                 <!-- Medication Schedule Card -->
                 <div class="card med-card">
-                    <div class="card-body">
-                        <h5 class="card-title"><i class="fas fa-calendar-alt"></i> Today's Schedule</h5>
-                        <div class="table-responsive">
-                            <table class="table schedule-table">
-                                <thead>
-                                    <tr>
-                                        <th>Time</th>
-                                        <th>Medicine</th>
-                                        <th>Dose</th>
-                                        <th>Status</th>
-                                    </tr>
-                                </thead>
-                                <tbody>
-                                    {% for med_name, details in meds.items() %}
-                                        {% for time in details.schedule %}
-                                            <tr>
-                                                <td>{{ time }}</td>
-                                                <td>{{ med_name }}</td>
-                                                <td>{{ details.dose }}</td>
-                                                <td>
-                                                    {% if time == "06:30" %}
-                                                        <span class="badge badge-taken">Taken</span>
-                                                    {% elif time == "08:00" %}
-                                                        <span class="badge badge-missed">Missed</span>
-                                                    {% else %}
-                                                        <span class="badge badge-pending">Pending</span>
-                                                    {% endif %}
-                                                </td>
-                                            </tr>
-                                        {% endfor %}
-                                    {% endfor %}
-                                </tbody>
-                            </table>
-                        </div>
+                    <div id="scheduleFragment" class="card-body">
+                        {% include 'fragments/schedule.html' %}
                     </div>
                 </div>
             </div>
@@ -504,81 +1434,15 @@ dashboard_html = '''
             <div class="col-md-8">
                 <!-- Alerts Card -->
                 <div class="card alert-card">
-                    <div class="card-body">
-                        <div class="d-flex justify-content-between align-items-center">
-                            <h5 class="card-title"><i class="fas fa-bell"></i> Alerts</h5>
-                            <span class="position-relative">
-                                <i class="fas fa-bell fs-4"></i>
-                                {% set unread = state.alerts|selectattr('read', 'false')|list|length %}
-                                {% if unread > 0 %}
-                                    <span class="alert-badge">{{ unread }}</span>
-                                {% endif %}
-                            </span>
-                        </div>
-                        <div class="mt-3">
-                            {% if state.alerts %}
-                                {% for alert in state.alerts %}
-                                <div class="alert-item alert-{{ alert.level }} {% if alert.read %}text-muted{% endif %}">
-                                    <div class="d-flex justify-content-between">
-                                        <div>
-                                            <strong>{{ alert.message }}</strong>
-                                            <div class="text-muted small">{{ alert.time }}</div>
-                                        </div>
-                                        {% if not alert.read %}
-                                        <button class="btn btn-sm btn-outline-secondary mark-read" 
-                                                data-index="{{ loop.index0 }}">
-                                            Mark Read
-                                        </button>
-                                        {% endif %}
-                                    </div>
-                                </div>
-                                {% endfor %}
-                            {% else %}
-                                <p class="text-muted">No alerts</p>
-                            {% endif %}
-                        </div>
+                    <div id="alertsFragment" class="card-body">
+                        {% include 'fragments/alerts.html' %}
                     </div>
                 </div>
                 
                 <!-- History Card -->
                 <div class="card history-card">
-                    <div class="card-body">
-                        <h5 class="card-title"><i class="fas fa-history"></i> Recent History</h5>
-                        <div class="table-responsive">
-                            <table class="table">
-                                <thead>
-                                    <tr>
-                                        <th>Time</th>
-                                        <th>Medication</th>
-                                        <th>Status</th>
-                                        <th>Details</th>
-                                    </tr>
-                                </thead>
-                                <tbody>
-                                    {% for event in state.compliance_history[:5] %}
-                                    <tr>
-                                        <td>{{ event.time }}</td>
-                                        <td>{{ event.medication }}</td>
-                                        <td>
-                                            {% if event.status == "Taken" %}
-                                                <span class="badge badge-taken">Taken</span>
-                                            {% else %}
-                                                <span class="badge badge-missed">Missed</span>
-                                            {% endif %}
-                                        </td>
-                                        <td><small>{{ event.details }}</small></td>
-                                    </tr>
-                                    {% else %}
-                                    <tr>
-                                        <td colspan="4" class="text-center text-muted">No history yet</td>
-                                    </tr>
-                                    {% endfor %}
-                                </tbody>
-                            </table>
-                        </div>
-                        <div class="text-end">
-                            <small><a href="/history">View full history ({{ state.compliance_history|length }} events)</a></small>
-                        </div>
+                    <div id="historyFragment" class="card-body">
+                        {% include 'fragments/history.html' %}
                     </div>
                 </div>
                 
@@ -595,7 +1459,11 @@ dashboard_html = '''
                                     </li>
                                     <li class="list-group-item d-flex justify-content-between">
                                         <span>Missed Doses:</span>
-                                        <span>{{ state.missed_count }} (last 7 days)</span>
+                                        <span>{{ missed_last_week }} (last 7 days)</span>
+                                    </li>
+                                    <li class="list-group-item d-flex justify-content-between">
+                                        <span>Consecutive Misses:</span>
+                                        <span>{{ state.missed_count }}</span>
                                     </li>
                                 </ul>
                             </div>
@@ -659,29 +1527,7 @@ dashboard_html = '''
                                     </tr>
                                 </thead>
                                 <tbody id="medicationsList">
-                                    {% for med, details in meds.items() %}
-                                    <tr id="med-{{ med }}">
-                                        <td>{{ details.icon }} {{ med }}</td>
-                                        <td>{{ details.dose }}</td>
-                                        <td>
-                                            {% for time in details.schedule %}
-                                                <span class="badge bg-teal me-1">{{ time }}</span>
-                                            {% endfor %}
-                                        </td>
-                                        <td>
-                                            {% if details.critical %}
-                                                <span class="badge bg-danger">Critical</span>
-                                            {% else %}
-                                                <span class="badge bg-secondary">Normal</span>
-                                            {% endif %}
-                                        </td>
-                                        <td>
-                                            <button class="btn btn-sm btn-danger delete-med" data-med="{{ med }}">
-                                                <i class="fas fa-trash"></i>
-                                            </button>
-                                        </td>
-                                    </tr>
-                                    {% endfor %}
+                                    {% include 'fragments/medications.html' %}
                                 </tbody>
                             </table>
                         </div>
@@ -770,9 +1616,11 @@ dashboard_html = '''
                     <div class="mt-4">
                         <p class="mb-1"><strong>Emergency contacts:</strong></p>
                         <ul>
-                            <li>Sarah Johnson (Daughter) - +91 8590586955</li>
-                            <li>John Smith (Caregiver) - +91 7036985373</li>
-                            <li>Local EMS - +91 9054242294</li>
+                            {% for contact in contacts if 'emergency' in contact.get('levels', ['emergency']) %}
+                            <li>{{ contact.name }}{% if contact.relation %} ({{ contact.relation }}){% endif %} - {{ contact.phone or contact.email }}</li>
+                            {% else %}
+                            <li class="text-muted">No emergency contacts registered</li>
+                            {% endfor %}
                         </ul>
                     </div>
                 </div>
@@ -788,9 +1636,18 @@ dashboard_html = '''
 
     <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
     <script>
+        // Dashboard fragments, the element each one fills and the version it was rendered at
+        const fragmentTargets = {
+            alerts: 'alertsFragment',
+            schedule: 'scheduleFragment',
+            history: 'historyFragment',
+            medications: 'medicationsList'
+        };
+        const fragmentVersions = {{ fragment_versions|tojson }};
+        let nextDoseTime = new Date("{{ state.next_dose_time.strftime('%Y-%m-%dT%H:%M:%S') }}");
+        
         // Update countdown timer
         function updateCountdown() {
-            const nextDoseTime = new Date("{{ state.next_dose_time.strftime('%Y-%m-%dT%H:%M:%S') }}");
             const now = new Date();
             
             if (nextDoseTime > now) {
@@ -806,66 +1663,44 @@ dashboard_html = '''
             }
         }
         
-        // Update data periodically
-        function updateData() {
-            fetch('/data')
+        // Update the status badge in the header
+        function updateStatus(status) {
+            const colors = { normal: 'teal', alert: 'warning' };
+            const badge = document.getElementById('statusBadge');
+            badge.className = `badge bg-${colors[status] || 'danger'} p-2`;
+            badge.querySelector('span').innerText = status;
+        }
+        
+        // Re-render only the fragments whose data changed since they were loaded
+        function syncFragments() {
+            return fetch('/fragments')
                 .then(response => response.json())
                 .then(data => {
-                    // Update the medications list
-                    const medsList = document.getElementById('medicationsList');
-                    medsList.innerHTML = '';
-                    
-                    for (const [med, details] of Object.entries(data.meds)) {
-                        const criticalBadge = details.critical ? 
-                            '<span class="badge bg-danger">Critical</span>' : 
-                            '<span class="badge bg-secondary">Normal</span>';
-                        
-                        let scheduleBadges = '';
-                        for (const time of details.schedule) {
-                            scheduleBadges += `<span class="badge bg-teal me-1">${time}</span>`;
-                        }
-                        
-                        medsList.innerHTML += `
-                            <tr id="med-${med}">
-                                <td>${details.icon} ${med}</td>
-                                <td>${details.dose}</td>
-                                <td>${scheduleBadges}</td>
-                                <td>${criticalBadge}</td>
-                                <td>
-                                    <button class="btn btn-sm btn-danger delete-med" data-med="${med}">
-                                        <i class="fas fa-trash"></i>
-                                    </button>
-                                </td>
-                            </tr>
-                        `;
+                    nextDoseTime = new Date(data.next_dose_time);
+                    const clock = document.getElementById('nextDoseClock');
+                    if (clock) {
+                        clock.innerText = data.next_dose_time.slice(11, 16);
                     }
+                    updateStatus(data.status);
                     
-                    // Reattach delete event listeners
-                    document.querySelectorAll('.delete-med').forEach(button => {
-                        button.addEventListener('click', function() {
-                            const medName = this.getAttribute('data-med');
-                            if (confirm(`Are you sure you want to delete ${medName}?`)) {
-                                fetch('/delete_medication', {
-                                    method: 'POST',
-                                    headers: {
-                                        'Content-Type': 'application/json'
-                                    },
-                                    body: JSON.stringify({ name: medName })
-                                })
-                                .then(response => response.json())
-                                .then(data => {
-                                    if (data.success) {
-                                        document.getElementById(`med-${medName}`).remove();
-                                        // Refresh the page to update the schedule
-                                        setTimeout(() => location.reload(), 500);
-                                    }
-                                });
-                            }
-                        });
-                    });
+                    const stale = Object.keys(fragmentTargets)
+                        .filter(name => data.versions[name] !== fragmentVersions[name]);
+                    return Promise.all(stale.map(name =>
+                        fetch(`/fragments/${name}`)
+                            .then(response => response.text())
+                            .then(html => {
+                                document.getElementById(fragmentTargets[name]).innerHTML = html;
+                                fragmentVersions[name] = data.versions[name];
+                            })
+                    ));
                 });
-                
-            setTimeout(updateData, 5000); // Update every 5 seconds
+        }
+        
+        // Check for changes periodically
+        function pollFragments() {
+            syncFragments()
+                .catch(error => console.error('Error:', error))
+                .finally(() => setTimeout(pollFragments, 5000)); // Update every 5 seconds
         }
         
         // Add medication form
@@ -896,12 +1731,13 @@ dashboard_html = '''
                 if (data.success) {
                     alert('Medication added successfully!');
                     document.getElementById('addMedicationForm').reset();
-                    // Close modal and refresh
+                    // Close modal and refresh the affected fragments
                     const modal = bootstrap.Modal.getInstance(document.getElementById('manageMedsModal'));
                     modal.hide();
-                    setTimeout(() => location.reload(), 500);
+                    syncFragments();
                 } else {
-                    alert('Failed to add medication. Please try again.');
+                    alert(data.error ? `Failed to add medication: ${data.error}` :
+                                       'Failed to add medication. Please try again.');
                 }
             })
             .catch(error => {
@@ -910,10 +1746,12 @@ dashboard_html = '''
             });
         });
         
-        // Delete medication
-        document.querySelectorAll('.delete-med').forEach(button => {
-            button.addEventListener('click', function() {
-                const medName = this.getAttribute('data-med');
+        // Buttons inside fragments are replaced on every swap, so listen on the document
+        document.addEventListener('click', function(e) {
+            // Delete medication
+            const deleteButton = e.target.closest('.delete-med');
+            if (deleteButton) {
+                const medName = deleteButton.getAttribute('data-med');
                 if (confirm(`Are you sure you want to delete ${medName}?`)) {
                     fetch('/delete_medication', {
                         method: 'POST',
@@ -923,24 +1761,35 @@ dashboard_html = '''
                         body: JSON.stringify({ name: medName })
                     })
                     .then(response => response.json())
-                    .then data => {
+                    .then(data => {
                         if (data.success) {
-                            document.getElementById(`med-${medName}`).remove();
-                            // Refresh the page to update the schedule
-                            setTimeout(() => location.reload(), 500);
+                            syncFragments();
                         }
                     });
                 }
-            });
-        });
-        
-        // Mark alert as read
-        document.querySelectorAll('.mark-read').forEach(button => {
-            button.addEventListener('click', function() {
-                const index = this.getAttribute('data-index');
-                fetch(`/mark_alert_read/${index}`)
-                    .then(() => window.location.reload());
-            });
+                return;
+            }
+            
+            // Mark alert as read
+            const markRead = e.target.closest('.mark-read');
+            if (markRead) {
+                const alertId = markRead.getAttribute('data-id');
+                fetch(`/mark_alert_read/${alertId}`)
+                    .then(() => syncFragments());
+                return;
+            }
+            
+            // Mark every unread alert as read
+            if (e.target.closest('#markAllRead')) {
+                fetch('/mark_alerts_read', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({})
+                })
+                .then(() => syncFragments());
+            }
         });
         
         // Confirm emergency
@@ -949,7 +1798,8 @@ dashboard_html = '''
                 .then(response => response.json())
                 .then(data => {
                     alert('Emergency assistance requested! Help is on the way.');
-                    window.location.reload();
+                    bootstrap.Modal.getInstance(document.getElementById('emergencyModal')).hide();
+                    syncFragments();
                 });
         });
 
@@ -965,7 +1815,7 @@ dashboard_html = '''
         // Initialize
         updateCountdown();
         setInterval(updateCountdown, 1000);
-        updateData();
+        setTimeout(pollFragments, 5000);
     </script>
 </body>
 </html>
@@ -1008,7 +1858,7 @@ history_html = '''
         <div class="card">
             <div class="card-header bg-teal text-white">
                 <h2><i class="fas fa-history"></i> Medication History</h2>
-                <p class="mb-0">Compliance Rate: {{ state.compliance_rate }}% ({{ history|length }} events)</p>
+                <p class="mb-0">Compliance Rate: {{ state.compliance_rate }}% ({{ total }} events)</p>
             </div>
             <div class="card-body">
                 <div class="table-responsive">
@@ -1043,6 +1893,24 @@ history_html = '''
                         </tbody>
                     </table>
                 </div>
+                <div class="d-flex justify-content-between align-items-center">
+                    <a href="/history/export" class="btn btn-outline-secondary btn-sm">
+                        <i class="fas fa-download"></i> Export CSV
+                    </a>
+                    {% if pages > 1 %}
+                    <nav>
+                        <ul class="pagination pagination-sm mb-0">
+                            <li class="page-item {{ 'disabled' if page == 1 }}">
+                                <a class="page-link" href="/history?page={{ page - 1 }}">Newer</a>
+                            </li>
+                            <li class="page-item disabled"><span class="page-link">Page {{ page }} of {{ pages }}</span></li>
+                            <li class="page-item {{ 'disabled' if page == pages }}">
+                                <a class="page-link" href="/history?page={{ page + 1 }}">Older</a>
+                            </li>
+                        </ul>
+                    </nav>
+                    {% endif %}
+                </div>
             </div>
         </div>
     </div>
@@ -1052,13 +1920,289 @@ history_html = '''
 </html>
 '''
 
+# Facility Overview Template
+facility_html = '''
+<!DOCTYPE html>
+<html>
+<head>
+    <title>MediGuardian - Facility Overview</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+    <style>
+        :root {
+            --teal: #20B2AA;
+        }
+        body {
+            font-family: Arial, sans-serif;
+            background-color: #f8f9fa;
+        }
+        .facility-table th {
+            background-color: var(--teal);
+            color: white;
+        }
+        .risk-high { background-color: #dc3545; }
+        .risk-medium { background-color: #ffc107; color: #212529; }
+        .risk-low { background-color: #28a745; }
+    </style>
+</head>
+<body>
+    <div class="container py-4">
+        <a href="/" class="btn btn-primary mb-3">
+            <i class="fas fa-arrow-left"></i> Back to Dashboard
+        </a>
+        
+        <div class="card">
+            <div class="card-header bg-teal">
+                <h2><i class="fas fa-hospital"></i> Facility Overview</h2>
+                <div class="btn-group btn-group-sm" role="group">
+                    <a href="/facility?sort={{ sort }}" class="btn btn-outline-dark {{ 'active' if not risk }}">
+                        All ({{ risk_counts.values()|sum }})
+                    </a>
+                    {% for level, count in risk_counts.items() %}
+                    <a href="/facility?sort={{ sort }}&risk={{ level }}" class="btn btn-outline-dark {{ 'active' if risk == level }}">
+                        {{ level|title }} risk ({{ count }})
+                    </a>
+                    {% endfor %}
+                </div>
+                <div class="btn-group btn-group-sm ms-2" role="group">
+                    {% for key in ['risk', 'miss_risk', 'compliance', 'name'] %}
+                    <a href="/facility?sort={{ key }}{{ '&risk=' ~ risk if risk }}" class="btn btn-outline-secondary {{ 'active' if sort == key }}">
+                        Sort by {{ key.replace('_', ' ') }}
+                    </a>
+                    {% endfor %}
+                </div>
+            </div>
+            <div class="card-body">
+                <div class="table-responsive">
+                    <table class="table table-hover table-sm facility-table">
+                        <thead>
+                            <tr>
+                                <th>Patient</th>
+                                <th>Risk</th>
+                                <th>Compliance</th>
+                                <th>Missed in a row</th>
+                                <th>Unread critical</th>
+                                <th>Status</th>
+                                <th>Next dose</th>
+                                <th>Riskiest dose (24h)</th>
+                            </tr>
+                        </thead>
+                        <tbody>
+                            {% for row in patients %}
+                            <tr>
+                                <td>
+                                    {% if row.patient == 0 %}<a href="/">{{ row.name }}</a>{% else %}{{ row.name }}{% endif %}
+                                </td>
+                                <td><span class="badge risk-{{ row.risk }}">{{ row.risk|title }}</span></td>
+                                <td>{{ row.compliance_rate }}% <small class="text-muted">({{ row.taken + row.missed }} doses)</small></td>
+                                <td>{{ row.streak }}</td>
+                                <td>{% if row.unread_critical %}<span class="badge bg-danger">{{ row.unread_critical }}</span>{% else %}0{% endif %}</td>
+                                <td class="text-uppercase">{{ row.status }}</td>
+                                <td>
+                                    {% if row.next_dose %}{{ row.next_dose.strftime('%Y-%m-%d %H:%M') }} {{ row.next_medication or '' }}{% else %}-{% endif %}
+                                </td>
+                                <td>
+                                    {% if row.riskiest_dose %}
+                                    <span class="badge risk-{{ row.miss_risk_level }}">{{ '%d%%' % (row.miss_risk * 100) }}</span>
+                                    {{ row.riskiest_dose.strftime('%H:%M') }} {{ row.riskiest_medication }}
+                                    {% else %}-{% endif %}
+                                </td>
+                            </tr>
+                            {% else %}
+                            <tr>
+                                <td colspan="8" class="text-center text-muted">No patients</td>
+                            </tr>
+                            {% endfor %}
+                        </tbody>
+                    </table>
+                </div>
+            </div>
+        </div>
+    </div>
+</body>
+</html>
+'''
+
+# Dashboard Fragment: Alerts Card
+alerts_fragment_html = '''
+<div class="d-flex justify-content-between align-items-center">
+    <h5 class="card-title"><i class="fas fa-bell"></i> Alerts</h5>
+    <div class="d-flex align-items-center">
+        {% set unread = state.unread_alerts.values()|sum %}
+        {% if unread > 0 %}
+        <button class="btn btn-sm btn-outline-secondary me-3" id="markAllRead">
+            Mark All Read
+        </button>
+        {% endif %}
+        <span class="position-relative">
+            <i class="fas fa-bell fs-4"></i>
+            {% if unread > 0 %}
+                <span class="alert-badge">{{ unread }}</span>
+            {% endif %}
+        </span>
+    </div>
+</div>
+<div class="mt-3">
+    {% if state.alerts %}
+        {% for alert in state.alerts %}
+        <div class="alert-item alert-{{ alert.level }} {% if alert.read %}text-muted{% endif %}">
+            <div class="d-flex justify-content-between">
+                <div>
+                    <strong>{{ alert.message }}</strong>
+                    <div class="text-muted small">{{ alert.time }}</div>
+                </div>
+                {% if not alert.read %}
+                <button class="btn btn-sm btn-outline-secondary mark-read" 
+                        data-id="{{ alert.id }}">
+                    Mark Read
+                </button>
+                {% endif %}
+            </div>
+        </div>
+        {% endfor %}
+    {% else %}
+        <p class="text-muted">No alerts</p>
+    {% endif %}
+</div>
+'''
+
+# Dashboard Fragment: Today's Schedule Table
+schedule_fragment_html = '''
+<h5 class="card-title"><i class="fas fa-calendar-alt"></i> Today's Schedule</h5>
+<div class="table-responsive">
+    <table class="table schedule-table">
+        <thead>
+            <tr>
+                <th>Time</th>
+                <th>Medicine</th>
+                <th>Dose</th>
+                <th>Status</th>
+                <th>Miss risk</th>
+            </tr>
+        </thead>
+        <tbody>
+            {% for when, med_name in todays_doses if med_name in meds %}
+                {% set time = when.strftime('%H:%M') %}
+                <tr>
+                    <td>{{ time }}</td>
+                    <td>{{ med_name }}</td>
+                    <td>{{ meds[med_name].dose }}</td>
+                    <td>
+                        {% if time == "06:30" %}
+                            <span class="badge badge-taken">Taken</span>
+                        {% elif time == "08:00" %}
+                            <span class="badge badge-missed">Missed</span>
+                        {% else %}
+                            <span class="badge badge-pending">Pending</span>
+                        {% endif %}
+                    </td>
+                    <td>
+                        {% set miss_risk = dose_risk.get((when, med_name)) %}
+                        {% if miss_risk is not none %}
+                            <span class="badge risk-{{ risk_level(miss_risk) }}">{{ '%d%%' % (miss_risk * 100) }}</span>
+                        {% endif %}
+                    </td>
+                </tr>
+            {% endfor %}
+        </tbody>
+    </table>
+</div>
+'''
+
+# Dashboard Fragment: Recent History Card
+history_fragment_html = '''
+<h5 class="card-title"><i class="fas fa-history"></i> Recent History</h5>
+<div class="table-responsive">
+    <table class="table">
+        <thead>
+            <tr>
+                <th>Time</th>
+                <th>Medication</th>
+                <th>Status</th>
+                <th>Details</th>
+            </tr>
+        </thead>
+        <tbody>
+            {% for event in state.compliance_history[:5] %}
+            <tr>
+                <td>{{ event.time }}</td>
+                <td>{{ event.medication }}</td>
+                <td>
+                    {% if event.status == "Taken" %}
+                        <span class="badge badge-taken">Taken</span>
+                    {% else %}
+                        <span class="badge badge-missed">Missed</span>
+                    {% endif %}
+                </td>
+                <td><small>{{ event.details }}</small></td>
+            </tr>
+            {% else %}
+            <tr>
+                <td colspan="4" class="text-center text-muted">No history yet</td>
+            </tr>
+            {% endfor %}
+        </tbody>
+    </table>
+</div>
+<div class="text-end">
+    <small><a href="/history">View full history ({{ state.compliance_history|length }} events)</a></small>
+</div>
+'''
+
+# Dashboard Fragment: Medications List Rows
+medications_fragment_html = '''
+{% if state.catalog_error %}
+<tr>
+    <td colspan="5" class="table-warning">
+        <i class="fas fa-exclamation-triangle"></i> {{ state.catalog_error }}
+        <div class="small">Showing the last version that loaded successfully.</div>
+    </td>
+</tr>
+{% endif %}
+{% for med, details in meds.items() %}
+<tr id="med-{{ med }}">
+    <td>{{ details.icon }} {{ med }}</td>
+    <td>{{ details.dose }}</td>
+    <td>
+        {% if details.recurrence %}
+            <span class="badge bg-info me-1">{{ describe_schedule(med) }}</span>
+        {% else %}
+            {% for time in details.schedule %}
+                <span class="badge bg-teal me-1">{{ time }}</span>
+            {% endfor %}
+        {% endif %}
+    </td>
+    <td>
+        {% if details.critical %}
+            <span class="badge bg-danger">Critical</span>
+        {% else %}
+            <span class="badge bg-secondary">Normal</span>
+        {% endif %}
+    </td>
+    <td>
+        <button class="btn btn-sm btn-danger delete-med" data-med="{{ med }}">
+            <i class="fas fa-trash"></i>
+        </button>
+    </td>
+</tr>
+{% endfor %}
+'''
+
 # Create template files
-os.makedirs('templates', exist_ok=True)
-with open('templates/dashboard.html', 'w', encoding='utf-8') as f:
-    f.write(dashboard_html)
-    
-with open('templates/history.html', 'w', encoding='utf-8') as f:
-    f.write(history_html)
+TEMPLATE_FILES = {
+    'dashboard.html': dashboard_html,
+    'history.html': history_html,
+    'facility.html': facility_html,
+    'fragments/alerts.html': alerts_fragment_html,
+    'fragments/schedule.html': schedule_fragment_html,
+    'fragments/history.html': history_fragment_html,
+    'fragments/medications.html': medications_fragment_html
+}
+os.makedirs('templates/fragments', exist_ok=True)
+for filename, content in TEMPLATE_FILES.items():
+    with open(os.path.join('templates', filename), 'w', encoding='utf-8') as f:
+        f.write(content)
 
 def generate_dummy_history():
     """Generate dummy history for past two days and today's passed medications"""
@@ -1109,9 +2253,33 @@ def generate_dummy_history():
     history.sort(key=lambda x: datetime.strptime(x["time"], "%Y-%m-%d %H:%M"), reverse=True)
     return history
 
-# Generate and add dummy history
-system_state["compliance_history"] = generate_dummy_history()
+def load_history():
+    """Resident history (newest first) from the log; seeds an empty log with dummy history"""
+    if len(history_log) == 0:
+        history = generate_dummy_history()
+        history_log.append_many(reversed(history))
+        return history
+    # Everything before the last compaction is already in the archive and rollups
+    history = list(history_log.read(start=history_archive.load_watermark(HISTORY_ARCHIVE_DIR),
+                                    patient=LIVE_PATIENT))
+    history.reverse()
+    return history
+
+system_state["compliance_history"] = load_history()
+facility_rollups.load_log(history_log)
+risk_model.load_log(history_log)
+update_status()
+upcoming_dose = recurrence.next_occurrence(schedule_index, datetime.now())
+if upcoming_dose:
+    facility_rollups.set_next_dose(LIVE_PATIENT, *upcoming_dose)
+index_history()
+# Doses that fell due while the app was not running
+# From the latest dose logged; late scans are written after newer doses
+catch_up(history_log.latest_time(LIVE_PATIENT))
+scheduler_status["last_tick"] = datetime.now()
+compact_history()
 system_state["compliance_rate"] = calculate_compliance()
+refresh_risk()
 
 if __name__ == '__main__':
     system_state["next_dose_time"] = datetime.now().replace(hour=13, minute=0, second=0)
@@ -0,0 +1,452 @@
+"""Alert delivery to the contacts in the contacts registry.
+
+Deliveries run on a pool of worker threads. Each worker keeps its SMTP
+connection and its HTTP keep-alive connections open between jobs, so
+fanning an alert out to many contacts costs about one round trip rather
+than one connection setup per message. Failed deliveries are retried with
+exponential backoff.
+
+Emergency alerts skip the shared pool. They go on their own queue, served by
+dedicated worker threads that open their connections up front, one worker
+per emergency delivery so the whole fan-out goes out at once. Those workers
+retry on a much shorter backoff, and each delivery records its latency from
+the moment the alert was raised.
+
+The registry (contacts.json) lists the contacts and the transports used to
+reach them:
+
+    {
+        "transports": {
+            "smtp": {"host": "localhost", "port": 8025, "sender": "alerts@mediguardian.local"},
+            "sms_gateway": "http://localhost:8026/sms"
+        },
+        "contacts": [
+            {"name": "...", "relation": "...", "phone": "...", "email": "...",
+             "webhook": "http://...", "levels": ["family", "caregiver", "emergency"]}
+        ]
+    }
+
+Run `python notifications.py --standin` for local SMTP and HTTP stand-ins that
+accept and print every message.
+"""
+import argparse
+import http.client
+import json
+import os
+import queue
+import random
+import smtplib
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from email.message import EmailMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+WORKERS = 64
+CONNECT_TIMEOUT = 5
+# Emergency workers are kept at one per emergency delivery, within these bounds
+EMERGENCY_WORKERS = 4
+EMERGENCY_MAX_WORKERS = 256
+EMERGENCY_RETRY_BACKOFF = 0.05
+
+# Without contacts.json nobody is registered, so alerts only show on the dashboard
+DEFAULT_REGISTRY = {"transports": {}, "contacts": []}
+
+def load_registry(path):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return DEFAULT_REGISTRY
+
+def contact_error(contact):
+    """Why a registry contact can't be notified, or None"""
+    if not isinstance(contact, dict):
+        return "not an object"
+    if not contact.get("name") or not isinstance(contact["name"], str):
+        return "name is required"
+    levels = contact.get("levels", [])
+    if not isinstance(levels, list) or not all(isinstance(level, str) for level in levels):
+        return "levels must be a list of strings"
+    for field in ("phone", "email", "webhook"):
+        if contact.get(field) is not None and not isinstance(contact[field], str):
+            return f"{field} must be a string"
+    return None
+
+class DeliveryError(Exception):
+    pass
+
+class Notifier:
+    def __init__(self, registry, workers=WORKERS, emergency_workers=EMERGENCY_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='notify')
+        self.local = threading.local()
+        self.log = deque(maxlen=200)
+        # Seconds from raising an emergency alert to its delivery, per delivery
+        self.emergency_latency = deque(maxlen=1000)
+        self.emergency_queue = queue.SimpleQueue()
+        self.min_emergency_workers = emergency_workers
+        self.emergency_workers = 0
+        self.set_registry(registry)
+
+    def set_registry(self, registry):
+        # Malformed contacts are left out and reported, rather than failing deliveries later
+        contacts = registry.get("contacts", [])
+        if not isinstance(contacts, list):
+            contacts = []
+        transports = registry.get("transports", {})
+        self.invalid_contacts = []
+        valid = []
+        for i, contact in enumerate(contacts):
+            error = contact_error(contact)
+            if error:
+                self.invalid_contacts.append(f"contact {i}: {error}")
+            else:
+                valid.append(contact)
+        self.registry = dict(registry, contacts=valid,
+                             transports=transports if isinstance(transports, dict) else {})
+        # Worked out once, so raising an emergency doesn't have to
+        self.emergency_deliveries = self.deliveries_for({"level": "emergency"})
+        # Workers that are already running reconnect to the new transports
+        for _ in range(self.emergency_workers):
+            self.emergency_queue.put(None)
+        wanted = min(max(self.min_emergency_workers, len(self.emergency_deliveries)), EMERGENCY_MAX_WORKERS)
+        while self.emergency_workers < wanted:
+            threading.Thread(target=self.emergency_worker, name=f'emergency-{self.emergency_workers}',
+                             daemon=True).start()
+            self.emergency_workers += 1
+
+    @property
+    def contacts(self):
+        return self.registry.get("contacts", [])
+
+    def deliveries_for(self, alert):
+        """(channel, contact) pairs that should receive this alert"""
+        transports = self.registry.get("transports", {})
+        deliveries = []
+        for contact in self.contacts:
+            if alert["level"] not in contact.get("levels", ["emergency"]):
+                continue
+            if contact.get("email") and transports.get("smtp"):
+                deliveries.append(("email", contact))
+            if contact.get("phone") and transports.get("sms_gateway"):
+                deliveries.append(("sms", contact))
+            if contact.get("webhook"):
+                deliveries.append(("webhook", contact))
+        return deliveries
+
+    def notify(self, alert, raised_at=None):
+        """Queue the alert for every matching contact; returns the futures.
+        
+        raised_at is the time.perf_counter() at which the alert was raised.
+        """
+        raised_at = raised_at or time.perf_counter()
+        if alert["level"] == "emergency":
+            futures = []
+            for channel, contact in self.emergency_deliveries:
+                future = Future()
+                self.emergency_queue.put((channel, contact, alert, raised_at, future))
+                futures.append(future)
+            return futures
+        return [self.pool.submit(self.deliver, channel, contact, alert, raised_at)
+                for channel, contact in self.deliveries_for(alert)]
+
+    def emergency_worker(self):
+        self.warm_up()
+        while True:
+            job = self.emergency_queue.get()
+            if job is None:
+                self.warm_up()
+                continue
+            channel, contact, alert, raised_at, future = job
+            # Whatever goes wrong, the worker lives on and the future resolves
+            try:
+                result = self.deliver(channel, contact, alert, raised_at, EMERGENCY_RETRY_BACKOFF)
+            except Exception as e:
+                result = {
+                    "alert_id": alert.get("id"),
+                    "channel": channel,
+                    "contact": contact.get("name"),
+                    "success": False,
+                    "attempts": 1,
+                    "error": repr(e),
+                    "seconds": 0.0,
+                    "latency": round(time.perf_counter() - raised_at, 4),
+                    "time": datetime.now().strftime("%H:%M:%S")
+                }
+                self.log.appendleft(result)
+            if result["success"]:
+                self.emergency_latency.append(result["latency"])
+            future.set_result(result)
+
+    def warm_up(self):
+        """Open this thread's connections to the emergency contacts' transports"""
+        urls = {}
+        for channel, contact in self.emergency_deliveries:
+            if channel == "email":
+                urls["smtp"] = None
+            else:
+                url = contact["webhook"] if channel == "webhook" else self.registry["transports"]["sms_gateway"]
+                parts = urlsplit(url)
+                urls.setdefault((parts.scheme, parts.netloc), url)
+        # One connection per host, shared by every delivery that goes there
+        for key, url in urls.items():
+            try:
+                if url is None:
+                    self.smtp_connection()
+                else:
+                    connection = self.http_connection(url)[0]
+                    if connection.sock is None:
+                        connection.connect()
+            except (OSError, ValueError, smtplib.SMTPException, http.client.HTTPException):
+                # Not reachable yet; the first delivery connects and retries
+                pass
+
+    def latency_summary(self):
+        """Emergency delivery latency percentiles in milliseconds"""
+        values = sorted(self.emergency_latency)
+        if not values:
+            return {"count": 0}
+        def at(fraction):
+            return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 1)
+        return {"count": len(values), "p50_ms": at(0.5), "p95_ms": at(0.95),
+                "p99_ms": at(0.99), "max_ms": round(values[-1] * 1000, 1)}
+
+    def notify_and_wait(self, alert, timeout=None):
+        futures = self.notify(alert)
+        wait(futures, timeout=timeout)
+        return [f.result() if f.done() else None for f in futures]
+
+    def deliver(self, channel, contact, alert, raised_at=None, backoff=RETRY_BACKOFF):
+        started = time.perf_counter()
+        error = None
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                getattr(self, 'send_' + channel)(contact, alert)
+                error = None
+                break
+            except (OSError, smtplib.SMTPException, http.client.HTTPException, DeliveryError) as e:
+                error = repr(e)
+                if attempt + 1 < RETRY_ATTEMPTS:
+                    time.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+        finished = time.perf_counter()
+        result = {
+            "alert_id": alert.get("id"),
+            "channel": channel,
+            "contact": contact["name"],
+            "success": error is None,
+            "attempts": attempt + 1,
+            "error": error,
+            "seconds": round(finished - started, 4),
+            "latency": round(finished - (raised_at or started), 4),
+            "time": datetime.now().strftime("%H:%M:%S")
+        }
+        self.log.appendleft(result)
+        return result
+
+    def message_text(self, alert):
+        return f"MediGuardian: {alert['message']} ({alert['time']})"
+
+    # Transports, one persistent connection per worker thread
+
+    def smtp_connection(self):
+        # A dropped connection surfaces as an error on send, which closes it
+        # and lets the retry open a fresh one
+        connection = getattr(self.local, 'smtp', None)
+        if connection is not None:
+            return connection
+        settings = self.registry["transports"]["smtp"]
+        connection = smtplib.SMTP(settings.get("host", "localhost"),
+                                  settings.get("port", 25),
+                                  timeout=CONNECT_TIMEOUT)
+        if settings.get("starttls"):
+            connection.starttls()
+        if settings.get("username"):
+            connection.login(settings["username"], settings.get("password", ""))
+        self.local.smtp = connection
+        return connection
+
+    def close_smtp(self):
+        connection = getattr(self.local, 'smtp', None)
+        self.local.smtp = None
+        if connection is not None:
+            try:
+                connection.close()
+            except OSError:
+                pass
+
+    def send_email(self, contact, alert):
+        settings = self.registry["transports"]["smtp"]
+        message = EmailMessage()
+        message["From"] = settings.get("sender", "alerts@mediguardian.local")
+        message["To"] = contact["email"]
+        message["Subject"] = f"MediGuardian {alert['level']} alert"
+        message.set_content(self.message_text(alert))
+        try:
+            self.smtp_connection().send_message(message)
+        except (OSError, smtplib.SMTPException):
+            self.close_smtp()
+            raise
+
+    def http_connection(self, url):
+        """(connection, key) for this thread's keep-alive connection to url's host"""
+        parts = urlsplit(url)
+        connections = getattr(self.local, 'http', None)
+        if connections is None:
+            connections = self.local.http = {}
+        key = (parts.scheme, parts.netloc)
+        connection = connections.get(key)
+        if connection is None:
+            connection_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                                else http.client.HTTPConnection)
+            connection = connections[key] = connection_class(parts.netloc, timeout=CONNECT_TIMEOUT)
+        return connection, key
+
+    def http_post(self, url, payload):
+        parts = urlsplit(url)
+        connection, key = self.http_connection(url)
+        connections = self.local.http
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        try:
+            connection.request('POST', path, body=json.dumps(payload).encode('utf-8'),
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            del connections[key]
+            raise
+        if response.status >= 300:
+            raise DeliveryError(f"{url} answered {response.status}")
+
+    def send_sms(self, contact, alert):
+        self.http_post(self.registry["transports"]["sms_gateway"], {
+            "to": contact["phone"],
+            "message": self.message_text(alert)
+        })
+
+    def send_webhook(self, contact, alert):
+        self.http_post(contact["webhook"], {
+            "contact": contact["name"],
+            "alert": alert
+        })
+
+# Local stand-ins for an SMTP relay and an SMS/webhook gateway
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply("220 mediguardian stand-in")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+            time.sleep(self.server.latency)
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply("250 stand-in")
+            elif command == 'DATA':
+                self.reply("354 end data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if data in (b'.\r\n', b'.\n', b''):
+                        break
+                    lines.append(data)
+                self.server.received.append(b''.join(lines).decode('utf-8', 'replace'))
+                self.reply("250 queued")
+            elif command == 'QUIT':
+                self.reply("221 bye")
+                return
+            else:
+                # MAIL, RCPT, RSET and NOOP are all accepted as-is
+                self.reply("250 ok")
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, StandInSMTPHandler)
+        self.latency = latency
+        self.received = []
+
+class StandInHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        time.sleep(self.server.latency)
+        self.server.received.append((self.path, json.loads(body or b'null')))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, StandInHTTPHandler)
+        self.latency = latency
+        self.received = []
+
+def start_standins(smtp_port=8025, http_port=8026, latency=0.0):
+    """Start both stand-ins in background threads and return them"""
+    servers = (StandInSMTPServer(('127.0.0.1', smtp_port), latency),
+               StandInHTTPServer(('127.0.0.1', http_port), latency))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return servers
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MediGuardian notification stand-ins")
+    parser.add_argument('--standin', action='store_true', help="run local SMTP and HTTP stand-ins")
+    parser.add_argument('--smtp-port', type=int, default=8025)
+    parser.add_argument('--http-port', type=int, default=8026)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds the stand-ins wait before answering each command")
+    parser.add_argument('--demo', type=int, metavar='N',
+                        help="fan an emergency alert out to N contacts through the stand-ins")
+    args = parser.parse_args()
+
+    smtp_server, http_server = start_standins(args.smtp_port, args.http_port, args.latency)
+    if args.demo:
+        registry = {
+            "transports": {
+                "smtp": {"host": "127.0.0.1", "port": args.smtp_port},
+                "sms_gateway": f"http://127.0.0.1:{args.http_port}/sms"
+            },
+            "contacts": [{"name": f"Contact {i}", "phone": f"+91 90000{i:05d}",
+                          "email": f"contact{i}@example.com", "levels": ["emergency"]}
+                         for i in range(args.demo)]
+        }
+        notifier = Notifier(registry)
+        alert = {"id": 0, "level": "emergency", "message": "EMERGENCY: demo",
+                 "time": datetime.now().strftime("%H:%M:%S")}
+        for run in ("cold", "warm"):
+            started = time.perf_counter()
+            results = notifier.notify_and_wait(alert)
+            failed = sum(1 for r in results if not r or not r["success"])
+            print(f"{run}: {len(results)} deliveries in {time.perf_counter() - started:.3f}s, {failed} failed")
+    else:
+        print(f"SMTP stand-in on 127.0.0.1:{args.smtp_port}, HTTP stand-in on 127.0.0.1:{args.http_port}")
+        seen = (0, 0)
+        while True:
+            time.sleep(1)
+            for message in smtp_server.received[seen[0]:]:
+                print("SMTP:", message.splitlines()[-1] if message else message)
+            for path, payload in http_server.received[seen[1]:]:
+                print("HTTP:", path, payload)
+            seen = (len(smtp_server.received), len(http_server.received))
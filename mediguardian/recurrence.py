@@ -0,0 +1,274 @@
+"""Recurrence rules for medication schedules.
+
+A medication's "recurrence" field describes when doses fall due; without one
+the plain daily "schedule" list is used. Each spec compiles into a rule whose
+next_after() finds the next dose with a bisect over that day's sorted dose
+times plus date arithmetic, so occurrences are produced one at a time and a
+long regimen never expands its calendar in memory.
+
+    {"type": "daily", "times": ["08:00", "20:00"]}
+    {"type": "weekly", "days": ["mon", "wed", "fri"], "times": ["09:00"]}
+    {"type": "interval", "every_hours": 8, "start": "2026-10-19 06:00"}
+    {"type": "cycle", "start": "2026-10-01", "on_days": 21, "off_days": 7, "times": ["21:00"]}
+    {"type": "taper", "start": "2026-10-19",
+     "steps": [{"days": 7, "times": ["08:00", "20:00"]}, {"days": 7, "times": ["08:00"]}]}
+
+Every type also accepts optional "start" and "end" dates ("YYYY-MM-DD").
+"""
+import bisect
+import heapq
+from datetime import datetime, time, timedelta
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+ONE_DAY = timedelta(days=1)
+
+def parse_minutes(times):
+    """Sorted, de-duplicated minutes past midnight for a list of "HH:MM" strings"""
+    if not times:
+        raise ValueError("at least one dose time is required")
+    if isinstance(times, str):
+        times = [times]
+    if not isinstance(times, list):
+        raise ValueError("dose times must be a list of HH:MM")
+    minutes = set()
+    for time_str in times:
+        try:
+            parsed = datetime.strptime(time_str, "%H:%M")
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid schedule time {time_str!r}, expected HH:MM")
+        minutes.add(parsed.hour * 60 + parsed.minute)
+    return sorted(minutes)
+
+def parse_date(value, field):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid {field} {value!r}, expected YYYY-MM-DD")
+
+def parse_number(value, field):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid {field} {value!r}, expected a number")
+
+def format_times(minutes):
+    return ", ".join("%02d:%02d" % divmod(m, 60) for m in minutes)
+
+class Rule:
+    """Occurrences on whole days; subclasses say which days and which times"""
+
+    def __init__(self, spec):
+        self.start = parse_date(spec["start"], "start") if spec.get("start") else None
+        self.end = parse_date(spec["end"], "end") if spec.get("end") else None
+
+    def first_day(self, day):
+        """First day on or after day that has doses, or None"""
+        raise NotImplementedError
+
+    def day_minutes(self, day):
+        raise NotImplementedError
+
+    def next_after(self, when):
+        """First occurrence strictly after when, or None once the regimen ends"""
+        # An occurrence at minute m is after `when` exactly when m > when's minute
+        cut = when.hour * 60 + when.minute + 1
+        day = when.date()
+        while True:
+            if self.start and day < self.start:
+                day = self.start
+            candidate = self.first_day(day)
+            if candidate is None or (self.end and candidate > self.end):
+                return None
+            minutes = self.day_minutes(candidate)
+            i = bisect.bisect_left(minutes, cut) if candidate == when.date() else 0
+            if i < len(minutes):
+                return datetime.combine(candidate, time()) + timedelta(minutes=minutes[i])
+            day = candidate + ONE_DAY
+
+    def occurrences(self, after, until=None):
+        """Lazily yield occurrences after `after`, up to and including `until`"""
+        when = self.next_after(after)
+        while when is not None and (until is None or when <= until):
+            yield when
+            try:
+                when = self.next_after(when)
+            except OverflowError:
+                # Ran off the end of the calendar (year 9999)
+                return
+
+    def occurs_at(self, when):
+        when = when.replace(second=0, microsecond=0)
+        return self.next_after(when - timedelta(seconds=1)) == when
+
+class DailyRule(Rule):
+    def __init__(self, spec):
+        super().__init__(spec)
+        self.minutes = parse_minutes(spec.get("times"))
+
+    def first_day(self, day):
+        return day
+
+    def day_minutes(self, day):
+        return self.minutes
+
+    def describe(self):
+        return f"Daily {format_times(self.minutes)}"
+
+class WeeklyRule(Rule):
+    def __init__(self, spec):
+        super().__init__(spec)
+        self.minutes = parse_minutes(spec.get("times"))
+        days = spec.get("days") or []
+        if isinstance(days, str):
+            days = [days]
+        if not isinstance(days, list):
+            days = []
+        unknown = [d for d in days if str(d).lower()[:3] not in WEEKDAYS]
+        if not days or unknown:
+            raise ValueError("weekly schedules need days from " + ", ".join(WEEKDAYS))
+        self.weekdays = sorted({WEEKDAYS.index(str(d).lower()[:3]) for d in days})
+
+    def first_day(self, day):
+        i = bisect.bisect_left(self.weekdays, day.weekday())
+        target = self.weekdays[i] if i < len(self.weekdays) else self.weekdays[0] + 7
+        return day + timedelta(days=target - day.weekday())
+
+    def day_minutes(self, day):
+        return self.minutes
+
+    def describe(self):
+        days = ", ".join(WEEKDAYS[d].title() for d in self.weekdays)
+        return f"{days} {format_times(self.minutes)}"
+
+class CycleRule(Rule):
+    """on_days with doses followed by off_days without, repeating from start"""
+
+    def __init__(self, spec):
+        super().__init__(spec)
+        if not spec.get("start"):
+            raise ValueError("cycle schedules need a start date")
+        self.minutes = parse_minutes(spec.get("times"))
+        self.on_days = int(parse_number(spec.get("on_days"), "on_days"))
+        self.off_days = int(parse_number(spec.get("off_days"), "off_days"))
+        if self.on_days < 1 or self.off_days < 0:
+            raise ValueError("cycle schedules need on_days >= 1 and off_days >= 0")
+
+    def first_day(self, day):
+        period = self.on_days + self.off_days
+        offset = (day - self.start).days % period
+        if offset < self.on_days:
+            return day
+        return day + timedelta(days=period - offset)
+
+    def day_minutes(self, day):
+        return self.minutes
+
+    def describe(self):
+        return f"{self.on_days} days on, {self.off_days} off, {format_times(self.minutes)}"
+
+class TaperRule(Rule):
+    """Consecutive steps, each with its own dose times, ending after the last"""
+
+    def __init__(self, spec):
+        super().__init__(spec)
+        if not spec.get("start"):
+            raise ValueError("taper schedules need a start date")
+        steps = spec.get("steps") or []
+        if not isinstance(steps, list) or not steps:
+            raise ValueError("taper schedules need at least one step")
+        # Day offset from start at which each step ends, for bisecting
+        self.boundaries = []
+        self.step_minutes = []
+        total = 0
+        for step in steps:
+            if not isinstance(step, dict):
+                raise ValueError("each taper step needs days and times")
+            days = int(parse_number(step.get("days"), "taper step days"))
+            if days < 1:
+                raise ValueError("each taper step needs days >= 1")
+            total += days
+            self.boundaries.append(total)
+            self.step_minutes.append(parse_minutes(step.get("times")))
+        last_day = self.start + timedelta(days=total - 1)
+        self.end = min(self.end, last_day) if self.end else last_day
+
+    def first_day(self, day):
+        return day
+
+    def day_minutes(self, day):
+        step = bisect.bisect_right(self.boundaries, (day - self.start).days)
+        return self.step_minutes[step]
+
+    def describe(self):
+        steps = "; ".join(f"{format_times(m)}" for m in self.step_minutes)
+        return f"Taper until {self.end.isoformat()}: {steps}"
+
+class IntervalRule(Rule):
+    """Every N hours from an anchor time, regardless of the calendar day"""
+
+    def __init__(self, spec):
+        super().__init__({"end": spec.get("end")})
+        minutes = (parse_number(spec.get("every_minutes"), "every_minutes")
+                   or 60 * parse_number(spec.get("every_hours"), "every_hours"))
+        if minutes < 1:
+            raise ValueError("interval schedules need every_hours or every_minutes")
+        self.step = timedelta(minutes=int(minutes))
+        try:
+            self.anchor = datetime.strptime(spec.get("start", ""), "%Y-%m-%d %H:%M")
+        except (TypeError, ValueError):
+            raise ValueError("interval schedules need a start of the form YYYY-MM-DD HH:MM")
+
+    def next_after(self, when):
+        if when < self.anchor:
+            candidate = self.anchor
+        else:
+            candidate = self.anchor + ((when - self.anchor) // self.step + 1) * self.step
+        if self.end and candidate.date() > self.end:
+            return None
+        return candidate
+
+    def describe(self):
+        hours = self.step.total_seconds() / 3600
+        return f"Every {hours:g}h from {self.anchor.strftime('%H:%M')}"
+
+RULE_TYPES = {
+    "daily": DailyRule,
+    "weekly": WeeklyRule,
+    "cycle": CycleRule,
+    "taper": TaperRule,
+    "interval": IntervalRule
+}
+
+def compile_rule(details):
+    """Rule for a medication entry; raises ValueError for a bad spec"""
+    spec = details.get("recurrence") or {"type": "daily", "times": details.get("schedule")}
+    if not isinstance(spec, dict):
+        raise ValueError("recurrence must be an object")
+    name = spec.get("type", "daily")
+    rule_type = RULE_TYPES.get(name) if isinstance(name, str) else None
+    if rule_type is None:
+        raise ValueError(f"unknown recurrence type {name!r}, expected one of " + ", ".join(RULE_TYPES))
+    try:
+        return rule_type(spec)
+    except (TypeError, AttributeError, OverflowError) as e:
+        # Anything the checks above missed is still a bad spec, not a crash
+        raise ValueError(f"invalid {name} schedule: {e}")
+
+def compile_all(meds):
+    return {name: compile_rule(details) for name, details in meds.items()}
+
+def upcoming(rules, after, until=None):
+    """Lazily merge occurrences of {name: rule} in time order as (when, name)"""
+    def tagged(name, rule):
+        for when in rule.occurrences(after, until):
+            yield when, name
+    return heapq.merge(*(tagged(name, rule) for name, rule in rules.items()))
+
+def next_occurrence(rules, after):
+    """(when, name) of the earliest dose after `after` across all rules, or None"""
+    best = None
+    for name, rule in rules.items():
+        when = rule.next_after(after)
+        if when is not None and (best is None or when < best[0]):
+            best = (when, name)
+    return best
@@ -0,0 +1,82 @@
+"""Serialize-once cache for JSON responses that many clients poll.
+
+The payload is built, encoded and gzipped once per state version, and every
+poller that asks for that version is handed the same bytes. Serialization
+work therefore follows the number of state changes rather than the number
+of clients. orjson is used for encoding when it is installed.
+"""
+import gzip
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+GZIP_LEVEL = 6
+# Bodies smaller than this are sent as-is; gzip would barely shrink them
+GZIP_MIN_SIZE = 1024
+
+class ResponseCache:
+    def __init__(self, build, dumps, default=None, lock=None):
+        """build() returns the payload; dumps and default are the fallback
+        encoder and the hook for types JSON lacks (datetimes, ...)"""
+        self.build = build
+        self.dumps = dumps
+        self.default = default
+        self.state_lock = lock or threading.RLock()
+        self.lock = threading.Lock()
+        self.entry = None
+        self.builds = 0
+        # Versions restart with the process, so ETags carry when it started
+        self.epoch = '%x' % time.time_ns()
+
+    def encode(self, payload):
+        if orjson is not None:
+            # Passing datetimes through keeps the same format as the fallback
+            return orjson.dumps(payload, default=self.default,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME)
+        return self.dumps(payload).encode('utf-8')
+
+    def get(self, version):
+        """Cached entry for version: {"version", "body", "gzip", "etag"}.
+
+        Read the version before calling, so a change that lands while the
+        body is being built produces a newer version and a rebuild.
+        """
+        entry = self.entry
+        if entry is not None and entry["version"] == version:
+            return entry
+        with self.lock:
+            # Another poller may have built it while this one waited
+            entry = self.entry
+            if entry is None or entry["version"] != version:
+                with self.state_lock:
+                    body = self.encode(self.build())
+                entry = {
+                    "version": version,
+                    "body": body,
+                    "gzip": (gzip.compress(body, GZIP_LEVEL, mtime=0)
+                             if len(body) >= GZIP_MIN_SIZE else None),
+                    "etag": f'"{self.epoch}-{version}"'
+                }
+                self.entry = entry
+                self.builds += 1
+        return entry
+
+    def current(self, version):
+        """True when version is already built, so respond() won't block"""
+        entry = self.entry
+        return entry is not None and entry["version"] == version
+
+    def respond(self, version, accept_encoding='', if_none_match=''):
+        """(status, body, headers) for a request with the given headers"""
+        entry = self.get(version)
+        headers = [('ETag', entry["etag"]), ('Vary', 'Accept-Encoding')]
+        if entry["etag"] in [tag.strip() for tag in if_none_match.split(',')]:
+            return 304, b'', headers
+        if entry["gzip"] is not None and 'gzip' in accept_encoding:
+            headers.append(('Content-Encoding', 'gzip'))
+            return 200, entry["gzip"], headers
+        return 200, entry["body"], headers
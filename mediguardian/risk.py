@@ -0,0 +1,267 @@
+"""Missed-dose risk for every patient's dose slots in the next 24 hours.
+
+Running counts of Taken and Missed doses are kept per patient and time of
+day, per medication, per weekday, and by how many doses in a row the patient
+had just missed. They are built from the history log at startup and then
+updated with each dose as it is recorded. A slot's miss probability
+combines them in log-odds. The starting point is the patient's miss rate
+at that time of day, smoothed toward their overall rate, which is in turn
+smoothed toward the facility's. The slot's medication and weekday and the
+patient's current streak then shift the odds by as much as they shift the
+facility's.
+
+Scores are a NumPy array of patients x the shared schedule's slots in the
+next 24 hours. refresh() rescores only patients with new doses, and
+everything once a slot falls due or the catalog changes. Without NumPy the
+model stays empty and every slot is unscored.
+"""
+import bisect
+import threading
+from datetime import timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import history_log
+import recurrence
+
+HORIZON = timedelta(hours=24)
+# Time of day is counted in this many equal buckets
+HOUR_BUCKETS = 8
+# Misses in a row counted separately up to this many; longer streaks share the last
+STREAK_CAP = 3
+# Pseudo-doses pulling a sparse rate toward the broader rate it refines
+PRIOR_WEIGHT = 10
+# Probabilities at which a slot is shown as high or medium risk
+HIGH_RISK = 0.4
+MEDIUM_RISK = 0.2
+
+def risk_level(probability):
+    if probability >= HIGH_RISK:
+        return "high"
+    if probability >= MEDIUM_RISK:
+        return "medium"
+    return "low"
+
+def logit(p):
+    return np.log(p / (1 - p))
+
+def smoothed(missed, total, prior):
+    return (missed + PRIOR_WEIGHT * prior) / (total + PRIOR_WEIGHT)
+
+def grown(array, size, fill=0):
+    # Capacity doubles, so adding patients one batch at a time stays cheap
+    if size <= len(array):
+        return array
+    extra = np.full((max(size, 2 * len(array)) - len(array),) + array.shape[1:], fill, dtype=array.dtype)
+    return np.concatenate([array, extra])
+
+class RiskModel:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.patient_rows = {}
+        self.patient_ids = []
+        self.med_columns = {}
+        self.slots = []
+        self.rules = None
+        self.next_rebuild = None
+        self.dirty = set()
+        # (patient, slot time, medication) already reminded about
+        self.reminded = set()
+        if np is None:
+            return
+        # [..., 0] Taken and [..., 1] Missed counts
+        self.by_hour = np.zeros((0, HOUR_BUCKETS, 2), dtype=np.int64)
+        self.by_med = np.zeros((0, 2), dtype=np.int64)
+        self.by_weekday = np.zeros((7, 2), dtype=np.int64)
+        self.by_streak = np.zeros((STREAK_CAP + 1, 2), dtype=np.int64)
+        # Misses in a row per patient; -1 before their first dose
+        self.streak = np.zeros(0, dtype=np.int64)
+        self.scores = np.zeros((0, 0))
+
+    def rows_for(self, patients):
+        # Caller holds the lock
+        rows = []
+        for patient in patients:
+            row = self.patient_rows.get(patient)
+            if row is None:
+                row = self.patient_rows[patient] = len(self.patient_ids)
+                self.patient_ids.append(patient)
+            rows.append(row)
+        self.by_hour = grown(self.by_hour, len(self.patient_ids))
+        self.streak = grown(self.streak, len(self.patient_ids), -1)
+        return rows
+
+    def column(self, medication):
+        # Caller holds the lock
+        column = self.med_columns.get(medication)
+        if column is None:
+            column = self.med_columns[medication] = len(self.med_columns)
+            self.by_med = grown(self.by_med, len(self.med_columns))
+        return column
+
+    def add(self, rows, columns, buckets, weekdays, missed):
+        """Count a batch of doses; each patient's doses must be in time order"""
+        np.add.at(self.by_hour, (rows, buckets, missed), 1)
+        np.add.at(self.by_med, (columns, missed), 1)
+        np.add.at(self.by_weekday, (weekdays, missed), 1)
+
+        # Streak before each dose, continuing each patient's carried streak
+        order = np.argsort(rows, kind='stable')
+        rows, missed = rows[order], missed[order]
+        patients, starts = np.unique(rows, return_index=True)
+        group = np.repeat(np.arange(len(patients)), np.diff(np.append(starts, len(rows))))
+        position = np.arange(len(rows))
+        taken_at = np.maximum.accumulate(np.where(missed == 0, position, -1))
+        before = np.empty(len(rows), dtype=np.int64)
+        before[0] = -1
+        before[1:] = taken_at[:-1]
+        carried = self.streak[rows]
+        in_group = before >= starts[group]
+        streak = np.where(in_group, position - 1 - before,
+                          np.maximum(carried, 0) + position - starts[group])
+        streak[(carried < 0) & (position == starts[group])] = -1
+        known = streak >= 0
+        np.add.at(self.by_streak, (np.minimum(streak[known], STREAK_CAP), missed[known]), 1)
+
+        ends = np.append(starts[1:], len(rows)) - 1
+        self.streak[patients] = np.where(missed[ends] == 1, np.maximum(streak[ends], 0) + 1, 0)
+        self.dirty.update(patients.tolist())
+
+    def record(self, doses):
+        """Count (patient, medication, time, missed) doses, in time order per patient"""
+        if np is None or not doses:
+            return
+        with self.lock:
+            rows = np.array(self.rows_for([dose[0] for dose in doses]))
+            columns = np.array([self.column(dose[1]) for dose in doses])
+            buckets = np.array([dose[2].hour * HOUR_BUCKETS // 24 for dose in doses])
+            weekdays = np.array([dose[2].weekday() for dose in doses])
+            missed = np.array([1 if dose[3] else 0 for dose in doses])
+            self.add(rows, columns, buckets, weekdays, missed)
+
+    def load_log(self, log):
+        """Count every dose in the history log, one segment at a time"""
+        if np is None:
+            return
+        dtype = np.dtype(history_log.RECORD_FIELDS)
+        with self.lock:
+            for view in log.segment_views():
+                records = np.frombuffer(view, dtype=dtype)
+                patients, patient_index = np.unique(records["patient"], return_inverse=True)
+                medications, med_index = np.unique(records["medication"], return_inverse=True)
+                rows = np.array(self.rows_for(patients.tolist()))[patient_index]
+                columns = np.array([self.column(log.strings[i]) for i in medications.tolist()])[med_index]
+                # Log times are wall-clock seconds, so hours and days fall out directly
+                seconds = records["time"]
+                buckets = (seconds // 3600 % 24) * HOUR_BUCKETS // 24
+                weekdays = (seconds // 86400 + 3) % 7
+                self.add(rows, columns, buckets, weekdays, records["status"].astype(np.int64))
+            self.rules = None
+
+    def population(self):
+        # Facility rate and how much medication, weekday and streak shift its log-odds
+        totals = self.by_weekday.sum(axis=0)
+        rate = (totals[1] + 1) / (totals.sum() + 2)
+        base = logit(rate)
+        def shift(counts):
+            return logit(smoothed(counts[:, 1], counts.sum(axis=1), rate)) - base
+        return rate, shift(self.by_med), shift(self.by_weekday), shift(self.by_streak)
+
+    def score(self, rows):
+        rate, med, weekday, streak = self.terms
+        columns, buckets, weekdays = self.slot_features
+        counts = self.by_hour[rows]
+        patient_rate = smoothed(counts[:, :, 1].sum(axis=1), counts.sum(axis=(1, 2)), rate)
+        hour_rate = smoothed(counts[:, :, 1], counts.sum(axis=2), patient_rate[:, None])
+        odds = logit(hour_rate)[:, buckets] + (med[columns] + weekday[weekdays])[None, :]
+        current = self.streak[rows]
+        odds += np.where(current >= 0, streak[np.minimum(np.maximum(current, 0), STREAK_CAP)], 0.0)[:, None]
+        return 1 / (1 + np.exp(-odds))
+
+    def refresh(self, rules, now):
+        """Bring scores up to date; returns the ids of patients rescored"""
+        if np is None:
+            return set()
+        with self.lock:
+            if rules is not self.rules or self.next_rebuild is None or now >= self.next_rebuild:
+                self.rules = rules
+                self.slots = list(recurrence.upcoming(rules, now, now + HORIZON))
+                self.next_rebuild = self.slots[0][0] if self.slots else now + timedelta(hours=1)
+                self.slot_features = (np.array([self.column(med) for _, med in self.slots], dtype=np.int64),
+                                      np.array([when.hour * HOUR_BUCKETS // 24 for when, _ in self.slots], dtype=np.int64),
+                                      np.array([when.weekday() for when, _ in self.slots], dtype=np.int64))
+                self.terms = self.population()
+                self.scores = self.score(np.arange(len(self.patient_ids)))
+                self.reminded = {key for key in self.reminded if key[1] > now}
+                self.dirty.clear()
+                return set(self.patient_ids)
+            if not self.dirty:
+                return set()
+            rows = np.array(sorted(self.dirty))
+            self.dirty.clear()
+            if len(self.patient_ids) > len(self.scores):
+                self.scores = np.concatenate([self.scores, np.zeros((len(self.patient_ids) - len(self.scores),
+                                                                     len(self.slots)))])
+            self.scores[rows] = self.score(rows)
+            return {self.patient_ids[row] for row in rows.tolist()}
+
+    def slot_risks(self, patient):
+        """{(slot time, medication): probability} for one patient"""
+        with self.lock:
+            row = self.patient_rows.get(patient)
+            if row is None or row >= len(self.scores):
+                return {}
+            return {slot: float(p) for slot, p in zip(self.slots, self.scores[row].tolist())}
+
+    def peaks(self, patients):
+        """{patient: (probability, slot time, medication)} of each patient's riskiest slot"""
+        with self.lock:
+            if not self.slots:
+                return {patient: (0.0, None, None) for patient in patients}
+            rows = [self.patient_rows[p] for p in patients
+                    if self.patient_rows.get(p, len(self.scores)) < len(self.scores)]
+            if not rows:
+                return {}
+            best = self.scores[rows].argmax(axis=1)
+            return {self.patient_ids[row]: (float(self.scores[row, i]),) + self.slots[i]
+                    for row, i in zip(rows, best.tolist())}
+
+    def riskiest(self, limit=50, patient=None, until=None):
+        """Slots in descending order of risk, as (probability, patient, slot time, medication)"""
+        with self.lock:
+            end = bisect.bisect_right([when for when, _ in self.slots], until) if until else len(self.slots)
+            if patient is not None:
+                row = self.patient_rows.get(patient)
+                rows = np.array([row] if row is not None and row < len(self.scores) else [], dtype=np.int64)
+            else:
+                rows = np.arange(len(self.scores))
+            if not end or not len(rows):
+                return []
+            block = self.scores[rows, :end]
+            flat = block.ravel()
+            if limit and limit < len(flat):
+                top = np.argpartition(-flat, limit - 1)[:limit]
+            else:
+                top = np.arange(len(flat))
+            top = top[np.argsort(-flat[top], kind='stable')]
+            return [(float(flat[i]), self.patient_ids[int(rows[i // end])]) + self.slots[i % end]
+                    for i in top.tolist()]
+
+    def due_reminders(self, now, lead, threshold):
+        """Slots due within `lead` with risk of at least `threshold` that were
+        not reminded about yet, riskiest first; they count as reminded now"""
+        if np is None:
+            return []
+        due = []
+        with self.lock:
+            for probability, patient, when, medication in self.riskiest(limit=None, until=now + lead):
+                if probability < threshold:
+                    break
+                key = (patient, when, medication)
+                if key not in self.reminded:
+                    self.reminded.add(key)
+                    due.append((probability, patient, when, medication))
+        return due
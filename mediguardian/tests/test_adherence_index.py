@@ -0,0 +1,56 @@
+import random
+from datetime import datetime, timedelta
+
+from adherence_index import AdherenceIndex, FenwickCounts
+
+def check_ranges(tree, counts):
+    buckets = sorted(counts)
+    for first in range(buckets[0] - 2, buckets[-1] + 3):
+        for last in range(first - 1, buckets[-1] + 3):
+            expected = sum(n for bucket, n in counts.items() if first <= bucket <= last)
+            assert tree.range(first, last) == expected, (first, last)
+
+def test_empty_tree_counts_nothing():
+    tree = FenwickCounts()
+    assert tree.prefix(10) == 0
+    assert tree.range(-5, 5) == 0
+
+def test_growth_at_the_edges():
+    tree = FenwickCounts()
+    counts = {}
+    # First bucket, the last slot of the initial span, one past it, then below the origin
+    for bucket in [100, 115, 116, 99, 84, 83, 200, -40]:
+        tree.add(bucket)
+        counts[bucket] = counts.get(bucket, 0) + 1
+        check_ranges(tree, counts)
+
+def test_growth_far_beyond_the_span():
+    tree = FenwickCounts()
+    tree.add(0, 3)
+    tree.add(10000, 2)
+    tree.add(-10000, 5)
+    assert tree.range(-10000, 10000) == 10
+    assert tree.range(1, 9999) == 0
+    assert tree.prefix(-10001) == 0
+    assert tree.prefix(50000) == 10
+
+def test_random_adds_match_brute_force():
+    rng = random.Random(7)
+    tree = FenwickCounts()
+    counts = {}
+    for _ in range(300):
+        bucket, count = rng.randint(-150, 150), rng.randint(1, 3)
+        tree.add(bucket, count)
+        counts[bucket] = counts.get(bucket, 0) + count
+    check_ranges(tree, counts)
+
+def test_window_by_medication():
+    index = AdherenceIndex()
+    start = datetime(2026, 10, 1, 8, 0)
+    for day in range(10):
+        index.add("Aspirin", "Taken" if day % 3 else "Missed", start + timedelta(days=day))
+    index.add("Metformin", "Missed", "2026-10-05 09:00")
+    assert index.window(start, start + timedelta(days=9), "Aspirin") == \
+        {"Taken": 6, "Missed": 4, "compliance_rate": 60}
+    assert index.count(start, start + timedelta(days=9)) == 5
+    assert index.count(start, start + timedelta(days=9), "Unknown") == 0
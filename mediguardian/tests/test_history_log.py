@@ -0,0 +1,143 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import history_log
+from history_log import HistoryLog
+
+def event(when, medication="Aspirin", status="Taken"):
+    return {"time": when.strftime("%Y-%m-%d %H:%M"), "medication": medication,
+            "status": status, "details": f"at {when:%H:%M}"}
+
+@pytest.fixture
+def log(tmp_path):
+    log = HistoryLog(str(tmp_path), records_per_segment=4)
+    yield log
+    log.close()
+
+def test_round_trip_across_segments(log, tmp_path):
+    start = datetime(2026, 10, 19, 8, 0)
+    events = [event(start + timedelta(hours=i), status="Missed" if i % 3 == 0 else "Taken") for i in range(10)]
+    log.append_many(events)
+    assert len(log) == 10
+    assert sorted(os.listdir(tmp_path)) == ["seg-000001.log", "seg-000002.log", "seg-000003.log", "strings.txt"]
+    assert list(log.read()) == events
+    assert log.latest(0, 3) == events[::-1][:3]
+    assert log.latest(8, 5) == events[::-1][8:]
+
+def test_reopen_keeps_records_and_appends_after_them(log, tmp_path):
+    start = datetime(2026, 10, 19, 8, 0)
+    log.append_many([event(start + timedelta(hours=i)) for i in range(6)])
+    log.append(event(start, medication="Metformin"), patient=3)
+    log.sync()
+    log.close()
+
+    reopened = HistoryLog(str(tmp_path), records_per_segment=4)
+    try:
+        assert len(reopened) == 7
+        assert reopened.patient_count(3) == 1
+        assert [e["medication"] for e in reopened.read(patient=3)] == ["Metformin"]
+        reopened.append(event(start + timedelta(days=1), medication="Lisinopril"))
+        assert len(reopened) == 8
+        assert reopened.latest(0, 1)[0]["medication"] == "Lisinopril"
+        assert reopened.last_time(0) == start + timedelta(days=1)
+        assert reopened.first_time(3) == start
+    finally:
+        reopened.close()
+
+def test_partial_record_is_dropped_on_reopen(log, tmp_path):
+    start = datetime(2026, 10, 19, 8, 0)
+    log.append_many([event(start + timedelta(hours=i)) for i in range(5)])
+    log.close()
+    # A crash part way through writing the sixth record
+    with open(os.path.join(tmp_path, "seg-000002.log"), "ab") as f:
+        f.write(b"\x01" * (history_log.RECORD.size // 2))
+
+    reopened = HistoryLog(str(tmp_path), records_per_segment=4)
+    try:
+        assert len(reopened) == 5
+        reopened.append(event(start + timedelta(hours=5)))
+        times = [e["time"] for e in reopened.read()]
+        assert times == [(start + timedelta(hours=i)).strftime("%Y-%m-%d %H:%M") for i in range(6)]
+    finally:
+        reopened.close()
+
+def test_out_of_order_records_are_found_by_range(log):
+    log.append(event(datetime(2026, 10, 19, 10, 0)))
+    log.append(event(datetime(2026, 10, 19, 9, 0)))
+    assert [e["time"] for e in log.read(end="2026-10-19 09:30")] == ["2026-10-19 09:00"]
+    assert [e["time"] for e in log.read(start="2026-10-19 09:30")] == ["2026-10-19 10:00"]
+
+def test_ranges_match_a_full_scan_past_the_sparse_index(tmp_path):
+    log = HistoryLog(str(tmp_path))
+    try:
+        start = datetime(2026, 1, 1)
+        times = [start + timedelta(hours=i) for i in range(3 * history_log.INDEX_STRIDE)]
+        # Late doses written long after newer ones
+        times[400:400] = [start + timedelta(hours=5), start + timedelta(hours=700)]
+        log.append_many([event(when) for when in times])
+        for first, last in [(0, 10), (5, 5), (300, 700), (699, 701), (760, 900)]:
+            lo, hi = start + timedelta(hours=first), start + timedelta(hours=last)
+            found = [e["time"] for e in log.read(lo, hi)]
+            expected = [when.strftime("%Y-%m-%d %H:%M") for when in times if lo <= when <= hi]
+            assert found == expected, (first, last)
+    finally:
+        log.close()
+
+def test_unknown_medication_reads_nothing(log):
+    log.append(event(datetime(2026, 10, 19, 8, 0)))
+    assert list(log.read(medication="Unknown")) == []
+    assert log.first_time(patient=9) is None
+
+def test_latest_time_is_not_the_last_written(log, tmp_path):
+    log.append(event(datetime(2026, 10, 19, 0, 2)))
+    log.append(event(datetime(2026, 10, 19, 0, 1)))
+    log.append(event(datetime(2026, 10, 18, 23, 0)), patient=5)
+    assert log.last_time(0) == datetime(2026, 10, 19, 0, 1)
+    assert log.latest_time(0) == datetime(2026, 10, 19, 0, 2)
+    assert log.latest_time(5) == datetime(2026, 10, 18, 23, 0)
+    assert log.latest_time(9) is None
+    log.close()
+    reopened = HistoryLog(str(tmp_path), records_per_segment=4)
+    try:
+        assert reopened.latest_time() == datetime(2026, 10, 19, 0, 2)
+        assert reopened.latest_time(0) == datetime(2026, 10, 19, 0, 2)
+    finally:
+        reopened.close()
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_patient_and_range_reads_match_a_full_scan(tmp_path, monkeypatch, vectorized):
+    if not vectorized:
+        monkeypatch.setattr(history_log, "np", None)
+    elif history_log.np is None:
+        pytest.skip("numpy not installed")
+    start = datetime(2026, 1, 1)
+    written = []
+    log = HistoryLog(str(tmp_path), records_per_segment=700)
+    try:
+        for i in range(2000):
+            # Every 37th dose arrives late, after newer ones from other patients
+            when = start + timedelta(hours=i - (90 if i % 37 == 0 else 0))
+            written.append((when, i % 3))
+            log.append(event(when), patient=i % 3)
+            if i == 1000:
+                # Index built part way; the rest is kept up to date on append
+                assert log.patient_count(1) == 334
+        for reader in (log, HistoryLog(str(tmp_path), records_per_segment=700)):
+            for patient in (None, 0, 2):
+                mine = [when for when, p in written if patient is None or p == patient]
+                newest = [when.strftime("%Y-%m-%d %H:%M") for when in mine[::-1]]
+                if patient is not None:
+                    assert reader.patient_count(patient) == len(mine)
+                    assert [e["time"] for e in reader.latest(20, 5, patient)] == newest[20:25]
+                for first, last in [(0, 50), (600, 900), (1390, 1420), (1900, 2100)]:
+                    lo, hi = start + timedelta(hours=first), start + timedelta(hours=last)
+                    found = [e["time"] for e in reader.read(lo, hi, patient=patient)]
+                    assert found == [when.strftime("%Y-%m-%d %H:%M") for when in mine if lo <= when <= hi]
+                    found = [e["time"] for e in reader.read(end=hi, patient=patient)]
+                    assert found == [when.strftime("%Y-%m-%d %H:%M") for when in mine if when <= hi]
+            if reader is not log:
+                reader.close()
+    finally:
+        log.close()
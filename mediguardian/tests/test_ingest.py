@@ -0,0 +1,79 @@
+import json
+import struct
+from datetime import datetime, timedelta
+
+import pytest
+
+import ingest
+import recurrence
+
+def scan(when, **fields):
+    base = {"time": when, "patient": 0, "device": "cab-1", "medication": "Aspirin",
+            "shape": None, "color": None, "imprint": None}
+    base.update(fields)
+    return base
+
+def test_binary_round_trip():
+    scans = [
+        scan(datetime(2026, 10, 19, 8, 0, 15), shape="round", color="white", imprint="ASP81"),
+        scan(datetime(2026, 10, 19, 8, 1), patient=4294967295, device="cam-ü"),
+        scan(datetime(2026, 10, 19, 20, 0), patient=12, medication="Metformin", device=None),
+    ]
+    assert ingest.parse_binary(ingest.encode_binary(scans)) == scans
+
+def test_binary_shares_repeated_strings():
+    scans = [scan(datetime(2026, 10, 19, 8, 0), patient=i) for i in range(100)]
+    body = ingest.encode_binary(scans)
+    assert body.count(b"Aspirin") == 1
+    assert len(body) < 100 * ingest.BINARY_RECORD.size + 64
+    assert ingest.parse_batch(body) == scans
+
+def test_binary_accepts_string_and_unix_times():
+    when = datetime(2026, 10, 19, 8, 30)
+    body = ingest.encode_binary([scan("2026-10-19 08:30"), scan(when.timestamp())])
+    assert [s["time"] for s in ingest.parse_binary(body)] == [when, when]
+
+def test_ndjson_matches_binary():
+    scans = [scan(datetime(2026, 10, 19, 8, 0, 5), shape="oval", color="blue")]
+    line = json.dumps(dict(scans[0], time="2026-10-19 08:00:05"))
+    assert ingest.parse_batch(line.encode("utf-8")) == ingest.parse_batch(ingest.encode_binary(scans))
+
+@pytest.mark.parametrize("body", [
+    ingest.BINARY_MAGIC,
+    ingest.BINARY_MAGIC + struct.pack("<H", 2) + struct.pack("<H", 1) + b"A",
+    ingest.encode_binary([scan(datetime(2026, 10, 19, 8, 0))])[:-1],
+    ingest.BINARY_MAGIC + struct.pack("<H", 0) + ingest.BINARY_RECORD.pack(0, 0, 5, 0, 0, 0, 0),
+    ingest.BINARY_MAGIC + struct.pack("<H", 1) + struct.pack("<H", 2) + b"\xff\xfe",
+])
+def test_malformed_binary_is_rejected(body):
+    with pytest.raises(ingest.IngestError) as error:
+        ingest.parse_binary(body)
+    assert error.value.status == 400
+
+def test_batch_limits():
+    with pytest.raises(ingest.IngestError):
+        ingest.parse_batch(b"\n\n")
+    too_many = [scan(datetime(2026, 10, 19, 8, 0))] * (ingest.MAX_BATCH_EVENTS + 1)
+    with pytest.raises(ingest.IngestError) as error:
+        ingest.parse_batch(ingest.encode_binary(too_many))
+    assert error.value.status == 413
+
+def test_slots_are_claimed_once_and_can_be_released():
+    rules = recurrence.compile_all({"Aspirin": {"schedule": ["08:00"]}})
+    now = datetime(2026, 10, 19, 8, 5)
+    slots = ingest.SlotIndex()
+    request = (0, "Aspirin", datetime(2026, 10, 19, 8, 2))
+    slot = datetime(2026, 10, 19, 8, 0)
+    assert slots.claim_many(rules, [request, request], now) == [(slot, "matched"), (slot, "duplicate")]
+    assert slots.claim_many(rules, [(0, "Aspirin", now + timedelta(hours=3))], now) == [(None, "unmatched")]
+    slots.release([(0, "Aspirin", slot)])
+    assert slots.claim_many(rules, [request], now) == [(slot, "matched")]
+
+def test_failed_group_fails_every_batch():
+    def record(scans):
+        return ["taken"] * len(scans)
+    def sync():
+        raise OSError("disk full")
+    ingestor = ingest.ScanIngestor(record, sync)
+    with pytest.raises(OSError):
+        ingestor.submit([scan(datetime(2026, 10, 19, 8, 0))]).result(5)
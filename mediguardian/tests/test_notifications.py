@@ -0,0 +1,46 @@
+import time
+
+import loadtest
+import notifications
+
+# The same target loadtest.py --emergency holds a level to
+EMERGENCY_TARGET_MS = 250
+
+def alert(alert_id, level):
+    return {"id": alert_id, "level": level, "message": f"{level} test", "time": "08:00"}
+
+def test_emergency_latency_stays_low_while_routine_alerts_saturate_the_pool():
+    routine_url, emergency_url = loadtest.start_sinks(routine_latency=0.2)
+    notifier = notifications.Notifier(loadtest.emergency_registry(routine_url, emergency_url))
+    try:
+        # About four times what the shared pool can deliver in one round of the slow sink
+        routine = []
+        for i in range(4 * notifications.WORKERS // loadtest.ROUTINE_CONTACTS + 1):
+            routine += notifier.notify(alert(i, "family"))
+        assert notifier.pool._work_queue.qsize() > 0
+
+        emergencies = []
+        for i in range(20):
+            emergencies += notifier.notify(alert(1000 + i, "emergency"))
+            time.sleep(0.02)
+        results = [future.result(timeout=10) for future in emergencies]
+        assert all(result["success"] for result in results)
+        # The routine backlog was still waiting while every emergency went out
+        assert not all(future.done() for future in routine)
+
+        summary = notifier.latency_summary()
+        assert summary["count"] == 20 * loadtest.EMERGENCY_CONTACTS
+        assert summary["p95_ms"] < EMERGENCY_TARGET_MS
+    finally:
+        notifier.pool.shutdown(wait=False, cancel_futures=True)
+
+def test_malformed_contacts_are_reported_not_delivered():
+    notifier = notifications.Notifier({"transports": {}, "contacts": [
+        {"webhook": "http://127.0.0.1:9/hook", "levels": ["emergency"]},
+        "not a contact",
+        {"name": "Ward", "levels": "emergency"},
+    ]}, emergency_workers=1)
+    assert notifier.contacts == []
+    assert notifier.invalid_contacts == ["contact 0: name is required", "contact 1: not an object",
+                                         "contact 2: levels must be a list of strings"]
+    assert notifier.notify(alert(1, "emergency")) == []
@@ -0,0 +1,71 @@
+from datetime import datetime
+
+import pytest
+
+import recurrence
+
+def rule(spec):
+    return recurrence.compile_rule({"recurrence": spec})
+
+def test_daily_wraps_past_midnight():
+    daily = rule({"type": "daily", "times": ["08:00", "23:59"]})
+    assert daily.next_after(datetime(2026, 10, 19, 23, 58)) == datetime(2026, 10, 19, 23, 59)
+    assert daily.next_after(datetime(2026, 10, 19, 23, 59)) == datetime(2026, 10, 20, 8, 0)
+    assert daily.next_after(datetime(2026, 12, 31, 23, 59, 30)) == datetime(2027, 1, 1, 8, 0)
+
+def test_dose_at_midnight_is_after_the_previous_day():
+    daily = rule({"type": "daily", "times": ["00:00"]})
+    assert daily.next_after(datetime(2026, 10, 19, 23, 59)) == datetime(2026, 10, 20, 0, 0)
+    assert daily.next_after(datetime(2026, 10, 20, 0, 0)) == datetime(2026, 10, 21, 0, 0)
+
+def test_taper_moves_between_steps_and_ends():
+    taper = rule({"type": "taper", "start": "2026-10-19",
+                  "steps": [{"days": 2, "times": ["08:00", "20:00"]}, {"days": 1, "times": ["09:00"]}]})
+    assert taper.next_after(datetime(2026, 10, 18, 12, 0)) == datetime(2026, 10, 19, 8, 0)
+    assert taper.next_after(datetime(2026, 10, 20, 8, 0)) == datetime(2026, 10, 20, 20, 0)
+    assert taper.next_after(datetime(2026, 10, 20, 20, 0)) == datetime(2026, 10, 21, 9, 0)
+    # The last step's last dose ends the regimen
+    assert taper.next_after(datetime(2026, 10, 21, 9, 0)) is None
+    assert taper.end == datetime(2026, 10, 21).date()
+
+def test_cycle_skips_off_days():
+    cycle = rule({"type": "cycle", "start": "2026-10-01", "on_days": 2, "off_days": 3, "times": ["21:00"]})
+    # On: Oct 1-2, off: Oct 3-5, on again Oct 6-7
+    assert cycle.next_after(datetime(2026, 10, 2, 20, 0)) == datetime(2026, 10, 2, 21, 0)
+    assert cycle.next_after(datetime(2026, 10, 2, 21, 0)) == datetime(2026, 10, 6, 21, 0)
+    assert cycle.next_after(datetime(2026, 10, 4, 12, 0)) == datetime(2026, 10, 6, 21, 0)
+    assert not cycle.occurs_at(datetime(2026, 10, 3, 21, 0))
+    assert cycle.occurs_at(datetime(2026, 10, 7, 21, 0))
+    # Before the start date the first cycle day comes next
+    assert cycle.next_after(datetime(2026, 9, 1)) == datetime(2026, 10, 1, 21, 0)
+
+def test_end_date_is_inclusive():
+    daily = rule({"type": "daily", "times": ["08:00"], "end": "2026-10-20"})
+    assert daily.next_after(datetime(2026, 10, 19, 9, 0)) == datetime(2026, 10, 20, 8, 0)
+    assert daily.next_after(datetime(2026, 10, 20, 8, 0)) is None
+
+def test_interval_steps_from_its_anchor():
+    interval = rule({"type": "interval", "every_hours": 8, "start": "2026-10-19 06:00"})
+    assert interval.next_after(datetime(2026, 10, 19, 5, 0)) == datetime(2026, 10, 19, 6, 0)
+    assert interval.next_after(datetime(2026, 10, 19, 22, 0)) == datetime(2026, 10, 20, 6, 0)
+
+def test_upcoming_merges_rules_in_time_order():
+    rules = recurrence.compile_all({
+        "A": {"schedule": ["08:00", "20:00"]},
+        "B": {"recurrence": {"type": "daily", "times": ["12:00"]}}
+    })
+    slots = list(recurrence.upcoming(rules, datetime(2026, 10, 19, 7, 0), datetime(2026, 10, 20, 9, 0)))
+    assert slots == [(datetime(2026, 10, 19, 8, 0), "A"), (datetime(2026, 10, 19, 12, 0), "B"),
+                     (datetime(2026, 10, 19, 20, 0), "A"), (datetime(2026, 10, 20, 8, 0), "A")]
+
+@pytest.mark.parametrize("spec", [
+    {"type": "interval", "every_minutes": "soon", "start": "2026-10-19 06:00"},
+    {"type": "cycle", "start": "2026-10-01", "on_days": None, "times": ["09:00"]},
+    {"type": "taper", "start": "2026-10-19", "steps": ["x"]},
+    {"type": "weekly", "days": 5, "times": ["09:00"]},
+    {"type": "daily", "times": 5},
+    {"type": ["daily"]},
+])
+def test_bad_specs_raise_value_error(spec):
+    with pytest.raises(ValueError):
+        rule(spec)